@@ -48,6 +48,18 @@ class Phenylcarbacid(mb.Compound):
         
         self.energy_minimize()
         
+def site_indices(graph):
+    """Map every site of a topology graph to its row in the atom table.
+
+    Compute it once per topology and pass it to the bond, angle and
+    dihedral table builders, so that they look sites up in constant time.
+    """
+    return {node: i for i, node in enumerate(graph.nodes)}
+
+def _member_labels(connections, site_index, k):
+    return list(str(connection.connection_members[k].name) + '(' +
+                str(site_index[connection.connection_members[k]]) + ')' for connection in connections)
+
 def atomtypes_to_datatables(graph, labels=None, atom_objects = False):
     if not labels:
         labels = []
@@ -67,15 +79,16 @@ def atomtypes_to_datatables(graph, labels=None, atom_objects = False):
         df['atom_id'] = list(node.__hash__() for node in graph.nodes)
     return df
 
-def bondtypes_to_datatables(graph,topology,labels=None,atom_objects = False):
+def bondtypes_to_datatables(graph,topology,labels=None,atom_objects = False,site_index=None):
     df = pd.DataFrame()
     if not labels:
         labels = []
-    list_of_nodes = list(node for node in graph.nodes)
+    if site_index is None:
+        site_index = site_indices(graph)
 
     df['index'] = np.arange(0,len(graph.edges),1)
-    df['Atom1'] = list(str(edge[0].name) + '(' + str(list_of_nodes.index(edge[0])) + ')' for edge in graph.edges)
-    df['Atom2'] = list(str(edge[1].name) + '(' + str(list_of_nodes.index(edge[1])) + ')' for edge in graph.edges)
+    df['Atom1'] = list(str(edge[0].name) + '(' + str(site_index[edge[0]]) + ')' for edge in graph.edges)
+    df['Atom2'] = list(str(edge[1].name) + '(' + str(site_index[edge[1]]) + ')' for edge in graph.edges)
     df['Parameter 1 (k): ' + str(topology.bonds[0].bond_type.parameters['k'].units)] = (
         list(bond.bond_type.parameters['k'].round(3) for bond in topology.bonds))
     df['Parameter 2 (r_eq): ' + str(topology.bonds[0].bond_type.parameters['r_eq'].units)] = (
@@ -87,25 +100,16 @@ def bondtypes_to_datatables(graph,topology,labels=None,atom_objects = False):
         df['atom2_id'] = list(edge[1].__hash__() for edge in graph.edges)
     return df
 
-def angletypes_to_datatables(graph,topology,labels=None,atom_objects=False):
+def angletypes_to_datatables(graph,topology,labels=None,atom_objects=False,site_index=None):
     df = pd.DataFrame()
     if not labels:
         labels = []
-    list_of_nodes = list(node for node in graph.nodes)
+    if site_index is None:
+        site_index = site_indices(graph)
 
     df['index'] = np.arange(0,len(topology.angles),1)
-    df['Atom1'] = list(str(angle.connection_members[0].name) +
-                       '(' + 
-                       str(list_of_nodes.index(angle.connection_members[0])) +
-                       ')' for angle in topology.angles)
-    df['Atom2'] = list(str(angle.connection_members[1].name) +
-                       '(' + 
-                       str(list_of_nodes.index(angle.connection_members[1])) +
-                       ')' for angle in topology.angles)
-    df['Atom3'] = list(str(angle.connection_members[2].name) +
-                       '(' + 
-                       str(list_of_nodes.index(angle.connection_members[2])) +
-                       ')' for angle in topology.angles)
+    for k in range(3):
+        df['Atom' + str(k + 1)] = _member_labels(topology.angles, site_index, k)
     df['Parameter 1 (k): ' + str(topology.angles[0].angle_type.parameters['k'].units)] = (
         list(angle.angle_type.parameters['k'].round(3) for angle in topology.angles))
     df['Parameter 2 (theta_eq): ' + str(topology.angles[0].angle_type.parameters['theta_eq'].units)] = (
@@ -118,29 +122,16 @@ def angletypes_to_datatables(graph,topology,labels=None,atom_objects=False):
         df['atom3_id'] = list(angle.connection_members[2].__hash__() for angle in topology.angles)
     return df
 
-def dihedraltypes_to_datatables(graph,topology,labels=None,atom_objects=False):
+def dihedraltypes_to_datatables(graph,topology,labels=None,atom_objects=False,site_index=None):
     df = pd.DataFrame()
     if not labels:
         labels = []
-    list_of_nodes = list(node for node in graph.nodes)
+    if site_index is None:
+        site_index = site_indices(graph)
 
     df['index'] = np.arange(0,len(topology.dihedrals),1)
-    df['Atom1'] = list(str(dihedral.connection_members[0].name) +
-                       '(' + 
-                       str(list_of_nodes.index(dihedral.connection_members[0])) +
-                       ')' for dihedral in topology.dihedrals)
-    df['Atom2'] = list(str(dihedral.connection_members[1].name) +
-                       '(' + 
-                       str(list_of_nodes.index(dihedral.connection_members[1])) +
-                       ')' for dihedral in topology.dihedrals)
-    df['Atom3'] = list(str(dihedral.connection_members[2].name) +
-                       '(' + 
-                       str(list_of_nodes.index(dihedral.connection_members[2])) +
-                       ')' for dihedral in topology.dihedrals)
-    df['Atom4'] = list(str(dihedral.connection_members[3].name) +
-                       '(' + 
-                       str(list_of_nodes.index(dihedral.connection_members[3])) +
-                       ')' for dihedral in topology.dihedrals)
+    for k in range(4):
+        df['Atom' + str(k + 1)] = _member_labels(topology.dihedrals, site_index, k)
     df['Parameter 1 (c0): ' + str(topology.dihedrals[0].dihedral_type.parameters['c0'].units)] = (
         list(dihedral.dihedral_type.parameters['c0'].round(3) for dihedral in topology.dihedrals))
     df['Parameter 2 (c1): ' + str(topology.dihedrals[0].dihedral_type.parameters['c1'].units)] = (
@@ -160,4 +151,101 @@ def dihedraltypes_to_datatables(graph,topology,labels=None,atom_objects=False):
         df['atom2_id'] = list(dihedral.connection_members[1].__hash__() for dihedral in topology.dihedrals)
         df['atom3_id'] = list(dihedral.connection_members[2].__hash__() for dihedral in topology.dihedrals)
         df['atom4_id'] = list(dihedral.connection_members[3].__hash__() for dihedral in topology.dihedrals)
-    return df
\ No newline at end of file
+    return df
+
+
+def _parameter_columns(name, column):
+    """Columns of one parameter, converted in bulk to the units of its first value.
+
+    Array-valued parameters, such as the terms of a multi-term periodic
+    dihedral, get one column per term, padded with NaN.
+    """
+    present = [row for row, value in enumerate(column) if value is not None]
+    units = column[present[0]].units
+    width = max(np.size(column[row]) for row in present)
+    magnitudes = np.full((len(column), width), np.nan)
+    groups = {}
+    for row in present:
+        groups.setdefault(column[row].units, []).append(row)
+    for value_units, rows in groups.items():
+        block = np.full((len(rows), width), np.nan)
+        for k, row in enumerate(rows):
+            value = np.ravel(column[row].value)
+            block[k, :len(value)] = value
+        magnitudes[rows] = unyt.unyt_array(block, value_units).to_value(units)
+    if all(np.ndim(column[row]) == 0 for row in present):
+        return {name + ' (' + str(units) + ')': magnitudes[:, 0]}
+    return {name + '_' + str(k) + ' (' + str(units) + ')': magnitudes[:, k] for k in range(width)}
+
+
+def _connection_frame(connections, site_index, n_members, type_attr):
+    """Columns of one kind of connection, gathered in one pass and converted per column."""
+    members = np.empty((len(connections), n_members), dtype=np.int64)
+    values = {}
+    for row, connection in enumerate(connections):
+        members[row] = [site_index[site] for site in connection.connection_members]
+        connection_type = getattr(connection, type_attr)
+        if connection_type is None:
+            continue
+        for name, value in connection_type.parameters.items():
+            values.setdefault(name, [None] * len(connections))[row] = value
+    df = pd.DataFrame({'atom' + str(k + 1): members[:, k] for k in range(n_members)})
+    for name, column in values.items():
+        for label, magnitudes in _parameter_columns(name, column).items():
+            df[label] = magnitudes
+    return df
+
+
+def topology_frame(topology):
+    """Return the atoms, bonds, angles and dihedrals of a typed topology as columns.
+
+    The topology is walked once. Atoms get their name, atom type, charge in
+    units of e, mass in amu and position in nm; connections get the rows of
+    their members in the atom table and one column per parameter of their
+    type, converted to the units of its first value. Array-valued
+    parameters get one column per term, e.g. 'k_0' and 'k_1' for a
+    two-term periodic dihedral, with NaN where a connection has fewer
+    terms.
+
+    Returns
+    -------
+    frames : dict of pd.DataFrame
+        Keyed by 'atoms', 'bonds', 'angles' and 'dihedrals'.
+    """
+    sites = list(topology.sites)
+    site_index = {site: i for i, site in enumerate(sites)}
+    names, types, charges, masses, positions = [], [], [], [], []
+    for site in sites:
+        names.append(site.name)
+        types.append(site.atom_type.name if site.atom_type is not None else '')
+        charges.append(site.charge if site.charge is not None else 0 * unyt.C)
+        masses.append(site.mass if site.mass is not None else 0 * unyt.amu)
+        positions.append(site.position)
+    atoms = pd.DataFrame({'index': np.arange(len(sites)),
+                          'name': pd.Categorical(names),
+                          'atom_type': pd.Categorical(types)})
+    # unyt.electron_charge is negative, so charges are divided by the elementary charge.
+    atoms['charge'] = (unyt.unyt_array(charges) / unyt.elementary_charge).to_value('dimensionless') if sites else []
+    atoms['mass'] = unyt.unyt_array(masses).to_value(unyt.amu) if sites else []
+    xyz = unyt.unyt_array(positions).to_value(unyt.nm).reshape(-1, 3) if sites else np.empty((0, 3))
+    atoms['x'], atoms['y'], atoms['z'] = xyz.T
+    return {'atoms': atoms,
+            'bonds': _connection_frame(topology.bonds, site_index, 2, 'bond_type'),
+            'angles': _connection_frame(topology.angles, site_index, 3, 'angle_type'),
+            'dihedrals': _connection_frame(topology.dihedrals, site_index, 4, 'dihedral_type')}
+
+
+def save_topology_frame(frames, prefix, format='parquet'):
+    """Write each table of `topology_frame` to ``<prefix>_<table>.<format>``.
+
+    Atom names and types are categorical, so Parquet and Feather store them
+    dictionary-encoded.
+    """
+    for key, df in frames.items():
+        filename = prefix + '_' + key + '.' + format
+        if format == 'parquet':
+            df.to_parquet(filename, index=False)
+        elif format == 'feather':
+            df.reset_index(drop=True).to_feather(filename)
+        else:
+            raise ValueError('Unknown format ' + repr(format) + ', use parquet or feather.')
@@ -0,0 +1,538 @@
+"""Type large systems by typing each distinct chemical environment once.
+
+Foyer matches every SMARTS definition of a force field against every atom,
+although a brush layer repeats the same few fragments thousands of times.
+`FragmentTyper` instead labels every atom by its bonded environment with
+Weisfeiler-Lehman refinement, so that atoms with the same element and the
+same neighbourhood up to `depth` bonds away share a label. A small
+subsystem holding one example of every label, and of every bonded term, is
+typed with Foyer, and the atom types, charges and bonded parameters found
+there are broadcast to every atom and term of the system with the same
+labels. Labels are hashes of the environments themselves, so results are
+cached across systems: typing a second layer only types the environments
+the first one did not have.
+
+`type_components` splits a system into bonded components and types the
+distinct ones in parallel worker processes.
+
+This relies on every SMARTS definition of the force field looking at most
+`depth` bonds away from the atom it types.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import os
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+
+from pmpc.forcefield import content_hash, load_forcefield, prune_forcefield
+from pmpc.gromacs import Interactions, MoleculeType, from_parmed
+
+
+_PAD = np.iinfo(np.int64).min
+
+
+def _digest(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little', signed=True)
+
+
+def _adjacency(bonds, n):
+    bonds = np.asarray(bonds, dtype=int).reshape(-1, 2)
+    graph = sparse.coo_matrix((np.ones(len(bonds), dtype=np.int8), (bonds[:, 0], bonds[:, 1])), shape=(n, n))
+    graph = (graph + graph.T).tocsr()
+    graph.sort_indices()
+    return graph
+
+
+def _neighbours(graph, fill=-1):
+    """Return the neighbours of every atom as rows of a padded array."""
+    degree = np.diff(graph.indptr)
+    width = degree.max() if len(degree) else 0
+    rows = np.repeat(np.arange(len(degree)), degree)
+    neighbours = np.full((len(degree), width), fill, dtype=np.int64)
+    neighbours[rows, np.arange(len(graph.indices)) - graph.indptr[rows]] = graph.indices
+    return neighbours
+
+
+def environment_labels(elements, bonds, depth=4):
+    """Label every atom by its element and bonded environment.
+
+    Parameters
+    ----------
+    elements : np.ndarray, shape=(n,), dtype=str
+    bonds : np.ndarray, shape=(m, 2), dtype=int
+    depth : int, optional, default=4
+        Number of refinement rounds, i.e. how many bonds away the
+        environment reaches.
+
+    Returns
+    -------
+    labels : np.ndarray, shape=(n,), dtype=int64
+        Hashes that only depend on the environment, so they can be compared
+        between systems.
+    """
+    elements = np.asarray(elements)
+    unique, inverse = np.unique(elements, return_inverse=True)
+    labels = np.array([_digest(element.encode()) for element in unique.tolist()], dtype=np.int64)[inverse]
+    graph = _adjacency(bonds, len(elements))
+    neighbours = _neighbours(graph)
+    for _ in range(depth):
+        around = np.where(neighbours >= 0, labels[neighbours], _PAD)
+        around.sort(axis=1)
+        keys, inverse = np.unique(np.column_stack((labels, around)), axis=0, return_inverse=True)
+        labels = np.array([_digest(key[key != _PAD].tobytes()) for key in keys], dtype=np.int64)[inverse.ravel()]
+    return labels
+
+
+def bonded_terms(bonds, n):
+    """Enumerate the angles, proper dihedrals and improper centers of a graph.
+
+    Returns
+    -------
+    angles : np.ndarray, shape=(a, 3)
+    dihedrals : np.ndarray, shape=(d, 4)
+    centers : np.ndarray, shape=(c, 4)
+        Every atom with three neighbours, followed by the neighbours.
+    """
+    graph = _adjacency(bonds, n)
+    neighbours = _neighbours(graph)
+    width = neighbours.shape[1]
+    centers = np.arange(n)
+
+    angles = []
+    for i in range(width):
+        for j in range(i + 1, width):
+            valid = (neighbours[:, i] >= 0) & (neighbours[:, j] >= 0)
+            angles.append(np.column_stack((neighbours[valid, i], centers[valid], neighbours[valid, j])))
+    angles = np.concatenate(angles) if angles else np.empty((0, 3), dtype=int)
+
+    bonds = np.asarray(bonds, dtype=int).reshape(-1, 2)
+    dihedrals = []
+    for i in range(width):
+        for j in range(width):
+            a = neighbours[bonds[:, 0], i]
+            d = neighbours[bonds[:, 1], j]
+            valid = (a >= 0) & (d >= 0) & (a != bonds[:, 1]) & (d != bonds[:, 0]) & (a != d)
+            dihedrals.append(np.column_stack((a[valid], bonds[valid], d[valid])))
+    dihedrals = np.concatenate(dihedrals) if dihedrals else np.empty((0, 4), dtype=int)
+
+    three = np.flatnonzero(np.diff(graph.indptr) == 3)
+    centers = np.column_stack((three, neighbours[three, :3])) if width >= 3 else np.empty((0, 4), dtype=int)
+    return angles, dihedrals, centers
+
+
+def _canonical(terms, labels):
+    """Orient each chain-like term so that its label tuple is the smaller of both directions."""
+    forward = labels[terms]
+    backward = forward[:, ::-1]
+    flip = np.zeros(len(terms), dtype=bool)
+    undecided = np.ones(len(terms), dtype=bool)
+    for k in range(terms.shape[1]):
+        flip |= undecided & (backward[:, k] < forward[:, k])
+        undecided &= backward[:, k] == forward[:, k]
+    terms = np.where(flip[:, None], terms[:, ::-1], terms)
+    return terms, labels[terms]
+
+
+def _improper_keys(centers, labels):
+    """Key improper centers by their label and the sorted labels of their neighbours."""
+    order = np.argsort(labels[centers[:, 1:]], axis=1, kind='stable')
+    centers = np.column_stack((centers[:, :1], np.take_along_axis(centers[:, 1:], order, axis=1)))
+    return centers, labels[centers]
+
+
+def _classes(keys):
+    """Group rows of keys, returning the row of every class and the class of every row."""
+    if not len(keys):
+        return np.empty((0,) + keys.shape[1:], dtype=keys.dtype), np.empty(0, dtype=int), np.empty(0, dtype=int)
+    unique, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    return unique, first, inverse.ravel()
+
+
+def _load_forcefield(forcefield):
+    if isinstance(forcefield, (str, os.PathLike, list, tuple)):
+        return load_forcefield(forcefield)
+    return forcefield
+
+
+class FragmentTyper(object):
+    """Foyer typing that types every distinct environment once.
+
+    Parameters
+    ----------
+    forcefield : foyer.Forcefield, str or list of str
+        The force field, or the XML files to load it from with
+        `load_forcefield`.
+    depth : int, optional, default=4
+        Reach of the environments, in bonds. It must be at least as large as
+        the reach of any SMARTS definition of the force field.
+    context : int, optional, default=4
+        Number of bonds of environment kept around every example atom in
+        the subsystem typed by Foyer. Bonds cut at the edge of the subsystem
+        are capped with hydrogens.
+    apply_kwargs : dict, optional, default=None
+        Passed on to ``forcefield.apply``. Bonds, angles and dihedrals left
+        without parameters raise a ValueError unless the matching
+        ``assert_bond_params``, ``assert_angle_params`` or
+        ``assert_dihedral_params`` is False, as in Foyer.
+    prune : bool, optional, default=True
+        Drop the rules that cannot match a subsystem with `prune_forcefield`
+        before typing it. The last `Pruned` report is kept in `pruned`.
+    """
+    def __init__(self, forcefield, depth=4, context=4, apply_kwargs=None, prune=True):
+        self.forcefield = _load_forcefield(forcefield)
+        self.prune = prune
+        self.pruned = None
+        self.depth = depth
+        self.context = context
+        self.apply_kwargs = apply_kwargs or {}
+        self.atoms = {}
+        self.atomtypes = {}
+        self.terms = {'bonds': {}, 'angles': {}, 'dihedrals': {}, 'impropers': {}}
+        self.n_typed = 0
+
+    def _subsystem(self, template, graph, needed):
+        """Build a Template of the needed atoms and their context, capped with hydrogens."""
+        import mbuild as mb
+        from pmpc.template import Template, stamp
+
+        keep = np.zeros(len(template.names), dtype=bool)
+        keep[needed] = True
+        for _ in range(self.context):
+            keep |= (graph @ keep.astype(np.int8)) > 0
+        kept = np.flatnonzero(keep)
+        local = np.full(len(keep), -1)
+        local[kept] = np.arange(len(kept))
+
+        bonds = np.asarray(template.bonds)
+        inner = keep[bonds[:, 0]] & keep[bonds[:, 1]]
+        cut = keep[bonds[:, 0]] ^ keep[bonds[:, 1]]
+        inside = np.where(keep[bonds[cut, 0]], bonds[cut, 0], bonds[cut, 1])
+        outside = np.where(keep[bonds[cut, 0]], bonds[cut, 1], bonds[cut, 0])
+        direction = template.xyz[outside] - template.xyz[inside]
+        caps = template.xyz[inside] + 0.1 * direction / np.linalg.norm(direction, axis=1, keepdims=True)
+
+        n_caps = len(caps)
+        sub = Template(np.concatenate((template.names[kept], np.full(n_caps, 'H'))),
+                       np.concatenate((template.elements[kept], np.full(n_caps, 'H'))),
+                       np.concatenate((template.xyz[kept], caps)),
+                       np.concatenate((local[bonds[inner]],
+                                       np.column_stack((local[inside], len(kept) + np.arange(n_caps))))))
+        compound = mb.Compound()
+        stamp(compound, sub)
+        return compound, sub, kept
+
+    def _learn(self, template, graph, labels, needed, examples):
+        """Type a subsystem around `needed` and record what it teaches."""
+        compound, sub, kept = self._subsystem(template, graph, needed)
+        forcefield = self.forcefield
+        if self.prune:
+            self.pruned = prune_forcefield(forcefield, sub.elements, sub.bonds)
+            forcefield = self.pruned.forcefield
+        structure = forcefield.apply(compound, **self.apply_kwargs)
+        atomtypes, molecule = from_parmed(structure)
+        self.n_typed += len(structure.atoms)
+        for atomtype in atomtypes:
+            self.atomtypes[atomtype.name] = atomtype
+
+        local = {atom: i for i, atom in enumerate(kept.tolist())}
+        for atom in needed.tolist():
+            i = local[atom]
+            self.atoms[int(labels[atom])] = (molecule.types[i], float(molecule.charges[i]), float(molecule.masses[i]))
+
+        found = {}
+        for section in ('bonds', 'angles', 'dihedrals'):
+            for interactions in getattr(molecule, section):
+                for row, indices in enumerate(np.asarray(interactions.indices).tolist()):
+                    improper = section == 'dihedrals' and interactions.funct in (2, 4)
+                    key = frozenset(indices) if improper else tuple(indices)
+                    params = None if interactions.params is None else interactions.params[row]
+                    if improper:
+                        found.setdefault(('impropers', key), []).append((interactions.funct, indices, params))
+                    else:
+                        found.setdefault((section, key), []).append((interactions.funct, params))
+                        found.setdefault((section, key[::-1]), []).append((interactions.funct, params))
+
+        learned = {}
+        missing = {}
+        for section, (keys, rows) in examples.items():
+            for key, row in zip(keys, rows):
+                indices = [local[atom] for atom in row.tolist()]
+                if section == 'impropers':
+                    entries = found.get(('impropers', frozenset(indices)), [])
+                    # Store the order Foyer chose as positions in the canonical row.
+                    entries = [(funct, [indices.index(i) for i in order], params)
+                               for funct, order, params in entries]
+                else:
+                    entries = found.get((section, tuple(indices)), [])
+                    if not entries:
+                        missing.setdefault(section, []).append(indices)
+                learned[section, key] = entries
+
+        # Like Foyer, terms without parameters are an error unless the
+        # matching assert_*_params option of apply is turned off.
+        for section, terms in missing.items():
+            option = 'assert_{}_params'.format(section[:-1])
+            if self.apply_kwargs.get(option, True):
+                raise ValueError('Parameters are missing for {} distinct {}, e.g. between atom types {}. '
+                                 'Pass {}=False in apply_kwargs to leave them out.'.format(
+                                     len(terms), section, '-'.join(molecule.types[i] for i in terms[0]), option))
+        for (section, key), entries in learned.items():
+            self.terms[section][key] = entries
+
+    def type(self, template, residues=None, resids=None, name='RES', nrexcl=3):
+        """Type a system given as arrays.
+
+        Parameters
+        ----------
+        template : Template
+            Names, elements, positions and bonds of the whole system, e.g.
+            from `layer_arrays`.
+        residues : np.ndarray, shape=(n,), dtype=str, optional, default=None
+        resids : np.ndarray, shape=(n,), dtype=int, optional, default=None
+        name : str, optional, default='RES'
+        nrexcl : int, optional, default=3
+
+        Returns
+        -------
+        atomtypes : list of AtomType
+        molecule : MoleculeType
+            The whole system, ready for `write_top` or `split_molecules`.
+        """
+        n = len(template.names)
+        bonds = np.asarray(template.bonds, dtype=int).reshape(-1, 2)
+        labels = environment_labels(template.elements, bonds, depth=self.depth)
+        graph = _adjacency(bonds, n)
+        angles, dihedrals, centers = bonded_terms(bonds, n)
+
+        sections = {}
+        for section, terms in (('bonds', bonds), ('angles', angles), ('dihedrals', dihedrals)):
+            terms, keys = _canonical(terms, labels)
+            sections[section] = (terms,) + _classes(keys)
+        centers, keys = _improper_keys(centers, labels)
+        sections['impropers'] = (centers,) + _classes(keys)
+
+        # Type a subsystem around one example of everything not seen before.
+        atom_classes, atom_first, atom_inverse = _classes(labels[:, None])
+        needed = [atom_first[[int(label) not in self.atoms for label in atom_classes[:, 0]]]]
+        examples = {}
+        for section, (terms, keys, first, _) in sections.items():
+            new = [k for k, key in enumerate(map(tuple, keys.tolist())) if key not in self.terms[section]]
+            examples[section] = ([tuple(keys[k].tolist()) for k in new], terms[first[new]])
+            needed.append(terms[first[new]].ravel())
+        needed = np.unique(np.concatenate(needed)).astype(int)
+        if len(needed):
+            self._learn(template, graph, labels, needed, examples)
+
+        types, charges, masses = zip(*[self.atoms[int(label)] for label in atom_classes[:, 0]])
+        types = np.array(types)[atom_inverse]
+        charges = np.array(charges)[atom_inverse]
+        masses = np.array(masses)[atom_inverse]
+
+        out = {'bonds': [], 'angles': [], 'dihedrals': []}
+        for section, (terms, keys, _, inverse) in sections.items():
+            order = np.argsort(inverse, kind='stable')
+            groups = np.split(terms[order], np.cumsum(np.bincount(inverse, minlength=len(keys)))[:-1])
+            rows = {}
+            for key, group in zip(map(tuple, keys.tolist()), groups):
+                for entry in self.terms[section][key]:
+                    funct, params = entry[0], entry[-1]
+                    chosen = group[:, entry[1]] if section == 'impropers' else group
+                    rows.setdefault(funct, []).append((chosen, params))
+            target = 'dihedrals' if section == 'impropers' else section
+            for funct, blocks in rows.items():
+                indices = np.concatenate([chosen for chosen, _ in blocks])
+                params = None
+                if blocks[0][1] is not None:
+                    params = np.concatenate([np.tile(params, (len(chosen), 1)) for chosen, params in blocks])
+                out[target].append(Interactions(indices, funct, params))
+
+        pairs = np.unique(np.sort(dihedrals[:, [0, 3]], axis=1), axis=0) if len(dihedrals) else dihedrals[:, :2]
+        if residues is None:
+            residues = np.full(n, name)
+        if resids is None:
+            resids = np.ones(n, dtype=int)
+        molecule = MoleculeType(name, nrexcl, types, np.asarray(resids), np.asarray(residues),
+                                np.asarray(template.names), charges, masses,
+                                out['bonds'], [Interactions(pairs, 1)], out['angles'], out['dihedrals'])
+        used = [self.atomtypes[t] for t in dict.fromkeys(types.tolist())]
+        return used, molecule
+
+
+def type_layer(layer, forcefield, typer=None, **kwargs):
+    """Type a `Layer` with a `FragmentTyper`.
+
+    Parameters
+    ----------
+    layer : Layer
+    forcefield : foyer.Forcefield, str or list of str
+    typer : FragmentTyper, optional, default=None
+        A typer to reuse, with the environments it has already typed.
+    **kwargs
+        Passed on to `FragmentTyper` when `typer` is None.
+
+    Returns
+    -------
+    atomtypes : list of AtomType
+    molecule : MoleculeType
+        Particles in the order of `layer_arrays`.
+    """
+    from pmpc.graft import layer_arrays
+
+    if typer is None:
+        typer = FragmentTyper(forcefield, **kwargs)
+    template, residues, resids = layer_arrays(layer)
+    return typer.type(template, residues=residues, resids=resids)
+
+
+_TYPERS = {}
+
+
+def _freeze(value):
+    """Turn nested dicts and lists of options into sorted tuples, so that they can key a dict."""
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_freeze(item) for item in value)
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _typer(forcefield, options):
+    """Return the `FragmentTyper` of this process for a force field, creating it once.
+
+    Force fields given as XML files are keyed by the hash of their contents,
+    so every task a worker runs on the same files shares one typer and its
+    cache, and edited files get a new one.
+    """
+    if isinstance(forcefield, (str, os.PathLike, list, tuple)):
+        source = content_hash(forcefield)
+    else:
+        source = id(forcefield)
+    key = (source, _freeze(options))
+    if key not in _TYPERS:
+        _TYPERS[key] = FragmentTyper(forcefield, **options)
+    return _TYPERS[key]
+
+
+def _type_component(forcefield, template, options):
+    return _typer(forcefield, options).type(template)
+
+
+def molecule_components(template):
+    """Split a system into bonded components and group identical ones.
+
+    Components are identical when their atoms, in order, have the same
+    elements and names and when they have the same bonds, as for copies
+    stamped from one template.
+
+    Returns
+    -------
+    groups : list of np.ndarray, shape=(k, n), dtype=int
+        Atoms of every copy of each distinct component, by first appearance.
+    """
+    n = len(template.names)
+    bonds = np.asarray(template.bonds, dtype=int).reshape(-1, 2)
+    labels = csgraph.connected_components(_adjacency(bonds, n), directed=False)[1]
+    order = np.argsort(labels, kind='stable')
+    sizes = np.bincount(labels)
+    members = np.split(order, np.cumsum(sizes)[:-1])
+    bond_owner = labels[bonds[:, 0]]
+    bond_order = np.argsort(bond_owner, kind='stable')
+    owned = np.split(bonds[bond_order], np.cumsum(np.bincount(bond_owner, minlength=len(sizes)))[:-1])
+
+    groups = {}
+    for atoms, own in zip(members, owned):
+        local = np.sort(np.searchsorted(atoms, own), axis=1)
+        local = local[np.lexsort(local.T[::-1])] if len(local) else local
+        key = hashlib.sha1(b'\0'.join((np.asarray(template.elements)[atoms].astype(str).tobytes(),
+                                       np.asarray(template.names)[atoms].astype(str).tobytes(),
+                                       local.astype(np.int64).tobytes()))).digest()
+        groups.setdefault(key, []).append(atoms)
+    return [np.array(copies) for copies in groups.values()]
+
+
+def type_components(template, forcefield, residues=None, resids=None, processes=None, name='RES', nrexcl=3,
+                    **kwargs):
+    """Type the distinct bonded components of a system in parallel.
+
+    The system is split into components, e.g. layers, waters and ions, each
+    distinct component is typed once by a `FragmentTyper` in a worker
+    process, and the results are copied to every copy of the component.
+
+    Parameters
+    ----------
+    template : Template
+        Names, elements, positions and bonds of the whole system.
+    forcefield : str or list of str
+        XML files of the force field. Every worker loads them with
+        `load_forcefield`, from the cache when it exists.
+    residues : np.ndarray, shape=(n,), dtype=str, optional, default=None
+    resids : np.ndarray, shape=(n,), dtype=int, optional, default=None
+    processes : int, optional, default=None
+        Number of worker processes, see `ProcessPoolExecutor`.
+    name : str, optional, default='RES'
+    nrexcl : int, optional, default=3
+    **kwargs
+        Passed on to `FragmentTyper`.
+
+    Returns
+    -------
+    atomtypes : list of AtomType
+    molecule : MoleculeType
+        The whole system with atoms in their original order, and the terms
+        of each distinct component in turn.
+    """
+    n = len(template.names)
+    groups = molecule_components(template)
+    bonds = np.asarray(template.bonds, dtype=int).reshape(-1, 2)
+    local = np.empty(n, dtype=int)
+    fragments = []
+    for copies in groups:
+        atoms = copies[0]
+        local[atoms] = np.arange(len(atoms))
+        inside = np.isin(bonds[:, 0], atoms)
+        fragments.append(template._replace(names=np.asarray(template.names)[atoms],
+                                           elements=np.asarray(template.elements)[atoms],
+                                           xyz=np.asarray(template.xyz)[atoms],
+                                           bonds=local[bonds[inside]], parts=None))
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = list(executor.map(_type_component, [forcefield] * len(groups), fragments,
+                                    [kwargs] * len(groups)))
+
+    types = np.empty(n, dtype=object)
+    charges = np.empty(n)
+    masses = np.empty(n)
+    atomtypes = {}
+    sections = {'bonds': {}, 'pairs': {}, 'angles': {}, 'dihedrals': {}}
+    for copies, (used, molecule) in zip(groups, results):
+        types[copies] = molecule.types
+        charges[copies] = molecule.charges
+        masses[copies] = molecule.masses
+        atomtypes.update((atomtype.name, atomtype) for atomtype in used)
+        for section, merged in sections.items():
+            for interactions in getattr(molecule, section):
+                indices = copies[:, np.asarray(interactions.indices, dtype=int)]
+                params = interactions.params
+                if params is not None:
+                    params = np.tile(params, (len(copies), 1))
+                merged.setdefault(interactions.funct, []).append((indices.reshape(-1, indices.shape[-1]), params))
+
+    merged = {}
+    for section, functs in sections.items():
+        merged[section] = [Interactions(np.concatenate([indices for indices, _ in blocks]), funct,
+                                        None if blocks[0][1] is None
+                                        else np.concatenate([params for _, params in blocks]))
+                           for funct, blocks in functs.items()]
+    if residues is None:
+        residues = np.full(n, name)
+    if resids is None:
+        resids = np.ones(n, dtype=int)
+    types = types.astype(str)
+    molecule = MoleculeType(name, nrexcl, types, np.asarray(resids), np.asarray(residues),
+                            np.asarray(template.names), charges, masses, merged['bonds'], merged['pairs'],
+                            merged['angles'], merged['dihedrals'])
+    return [atomtypes[t] for t in dict.fromkeys(types.tolist())], molecule
@@ -4,8 +4,8 @@ import mbuild as mb
 
 from mbuild.lib.moieties.silane import Silane
 from mbuild.lib.moieties.ch3 import CH3
-from mpc import MPC
-from initiator import Initiator
+from pmpc.chain import PMPCChain
+from pmpc.initiator import Initiator
 
 
 class Brush(mb.Compound):
@@ -16,10 +16,10 @@ class Brush(mb.Compound):
         # Add parts
         self.add(Silane(), label='silane')
         self.add(Initiator(), label='initiator')
-        chain = mb.recipes.Polymer()
-        chain.add_monomer(MPC(alpha=alpha),indices=[1, 37], separation = .2, replace=False, orientation=[[0,1,0],[0,-1,0]])
-        chain.build(n = chain_length)
-        self.add(chain, label='pmpc')
+        # Same chain as mb.recipes.Polymer().add_monomer(MPC(alpha=alpha), indices=[1, 37],
+        # separation=.2, replace=False, orientation=[[0,1,0],[0,-1,0]]).build(n=chain_length)
+        # but placed in one batch from the cached repeat unit.
+        self.add(PMPCChain(chain_length=chain_length, alpha=alpha), label='pmpc')
         # self.add(CH3(), label='methyl')
 
         self.add(mb.Port(anchor=list(self['pmpc'].particles())[1]), label='pmpc_up')
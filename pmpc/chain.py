@@ -0,0 +1,190 @@
+"""Vectorized growth of pMPC chains from a rigid repeat unit.
+
+`mb.recipes.Polymer.build` attaches one monomer at a time with
+`force_overlap`, moving a copy of the whole monomer for every step. Every
+repeat unit of the chain is an identical rigid copy, so unit ``k`` is simply
+the transform that maps a monomer onto its successor applied ``k`` times.
+That transform is measured once from a reference dimer built with
+`mb.recipes.Polymer`, after which a chain of any length is placed with a
+single batched matrix product.
+"""
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+from numpy import pi
+
+import mbuild as mb
+
+from pmpc.mpc import MPC
+from pmpc.template import Template, fit_transform, stamp, template_from_compound
+
+
+RepeatUnit = namedtuple('RepeatUnit', ['monomer', 'rotation', 'translation', 'link', 'extras', 'extra_bonds'])
+RepeatUnit.__doc__ = """The rigid repeat unit of a chain and how copies are joined.
+
+Parameters
+----------
+monomer : Template
+    The first monomer of the chain.
+rotation, translation : np.ndarray, shape=(3, 3) and (3,)
+    The transform that maps a monomer onto the next monomer of the chain.
+link : tuple of int
+    Local indices ``(a, b)`` of the bond between atom ``a`` of a monomer and
+    atom ``b`` of the monomer before it.
+extras : Template
+    Particles that are not part of a monomer (the end caps), with positions
+    given in the frame of the monomer they are bonded to.
+extra_bonds : np.ndarray, shape=(m, 2)
+    Bonds involving extras, indexed as in a dimer: ``[0, n)`` is the first
+    monomer, ``[n, 2n)`` the last monomer and ``2n`` onwards the extras.
+"""
+
+
+def _polymer(alpha, n):
+    """Build a chain the way `mb.recipes.Polymer` does."""
+    chain = mb.recipes.Polymer()
+    chain.add_monomer(MPC(alpha=alpha), indices=[1, 37], separation=.2, replace=False,
+                      orientation=[[0, 1, 0], [0, -1, 0]])
+    chain.build(n=n)
+    return chain
+
+
+@lru_cache(maxsize=None)
+def repeat_unit(alpha=pi / 4):
+    """Measure the repeat unit of a pMPC chain from a reference dimer.
+
+    Parameters
+    ----------
+    alpha : float, optional, default=pi/4
+        Rotation of the monomer around the z axis, see `MPC`.
+
+    Returns
+    -------
+    unit : RepeatUnit
+    """
+    dimer = template_from_compound(_polymer(alpha, n=2))
+    n_atoms = MPC(alpha=alpha).n_particles
+    first = slice(0, n_atoms)
+    second = slice(n_atoms, 2 * n_atoms)
+    rotation, translation = fit_transform(dimer.xyz[first], dimer.xyz[second])
+
+    bonds = np.sort(dimer.bonds, axis=1)
+    intra = bonds[bonds[:, 1] < n_atoms]
+    link = bonds[(bonds[:, 0] < n_atoms) & (bonds[:, 1] >= n_atoms) & (bonds[:, 1] < 2 * n_atoms)]
+    if len(link) != 1:
+        raise ValueError('Expected one bond between consecutive monomers, found {}.'.format(len(link)))
+    link = (int(link[0, 1] - n_atoms), int(link[0, 0]))
+    extra_bonds = bonds[bonds[:, 1] >= 2 * n_atoms]
+
+    # Express the extras in the frame of the monomer they are attached to.
+    extra_xyz = dimer.xyz[2 * n_atoms:].copy()
+    for i, j in extra_bonds:
+        if n_atoms <= i < 2 * n_atoms:
+            extra_xyz[j - 2 * n_atoms] = (dimer.xyz[j] - translation) @ rotation
+
+    monomer = Template(dimer.names[first], dimer.elements[first], dimer.xyz[first], intra)
+    extras = Template(dimer.names[2 * n_atoms:], dimer.elements[2 * n_atoms:], extra_xyz,
+                      np.empty((0, 2), dtype=int))
+    return RepeatUnit(monomer, rotation, translation, link, extras, extra_bonds)
+
+
+def chain_frames(unit, n):
+    """Return the rotation and translation that place each unit of a chain.
+
+    Parameters
+    ----------
+    unit : RepeatUnit
+    n : int
+        Number of monomers.
+
+    Returns
+    -------
+    rotations : np.ndarray, shape=(n, 3, 3)
+    translations : np.ndarray, shape=(n, 3)
+    """
+    rotations = np.empty((n, 3, 3))
+    translations = np.empty((n, 3))
+    rotations[0] = np.eye(3)
+    translations[0] = 0
+    for k in range(1, n):
+        rotations[k] = rotations[k - 1] @ unit.rotation
+        translations[k] = rotations[k - 1] @ unit.translation + translations[k - 1]
+    return rotations, translations
+
+
+def place_chain(unit, rotations, translations):
+    """Place every atom of a chain from per-unit frames.
+
+    Parameters
+    ----------
+    unit : RepeatUnit
+    rotations : np.ndarray, shape=(n, 3, 3)
+    translations : np.ndarray, shape=(n, 3)
+
+    Returns
+    -------
+    xyz : np.ndarray, shape=(n * n_atoms + n_extras, 3)
+        Monomer positions in chain order followed by the extras.
+    """
+    n_atoms = len(unit.monomer.names)
+    monomers = np.einsum('kij,aj->kai', rotations, unit.monomer.xyz) + translations[:, None, :]
+
+    extras = unit.extras.xyz.copy()
+    for i, j in unit.extra_bonds:
+        if i < 2 * n_atoms:
+            frame = -1 if i >= n_atoms else 0
+            extras[j - 2 * n_atoms] = extras[j - 2 * n_atoms] @ rotations[frame].T + translations[frame]
+    return np.vstack((monomers.reshape(-1, 3), extras))
+
+
+def chain_bonds(unit, n):
+    """Return the bonds of an `n`-mer as index offsets of the repeat unit."""
+    n_atoms = len(unit.monomer.names)
+    offsets = np.arange(n) * n_atoms
+    intra = unit.monomer.bonds[None, :, :] + offsets[:, None, None]
+    a, b = unit.link
+    links = np.column_stack((offsets[1:] + a, offsets[:-1] + b))
+
+    # Map dimer indices onto the first monomer, the last monomer and the extras.
+    extra_bonds = unit.extra_bonds + np.where(unit.extra_bonds >= n_atoms, (n - 2) * n_atoms, 0)
+    return np.vstack((intra.reshape(-1, 2), links, extra_bonds))
+
+
+@lru_cache(maxsize=None)
+def chain_template(chain_length=4, alpha=pi / 4):
+    """Build the particle arrays of a pMPC chain.
+
+    The result matches the chain `mb.recipes.Polymer` builds from
+    `MPC(alpha=alpha)` with ``n=chain_length``, particle for particle.
+
+    Parameters
+    ----------
+    chain_length : int, optional, default=4
+        Number of monomers.
+    alpha : float, optional, default=pi/4
+        Rotation of the monomer around the z axis, see `MPC`.
+
+    Returns
+    -------
+    template : Template
+        A read-only template shared by every caller.
+    """
+    if chain_length < 1:
+        raise ValueError('chain_length must be 1 or more')
+    unit = repeat_unit(alpha)
+    xyz = place_chain(unit, *chain_frames(unit, chain_length))
+    names = np.concatenate((np.tile(unit.monomer.names, chain_length), unit.extras.names))
+    elements = np.concatenate((np.tile(unit.monomer.elements, chain_length), unit.extras.elements))
+    bonds = chain_bonds(unit, chain_length)
+    for array in (names, elements, xyz, bonds):
+        array.setflags(write=False)
+    return Template(names, elements, xyz, bonds)
+
+
+class PMPCChain(mb.Compound):
+    """A linear pMPC chain grown from the cached repeat unit."""
+    def __init__(self, chain_length=4, alpha=pi / 4):
+        super(PMPCChain, self).__init__()
+
+        stamp(self, chain_template(chain_length, alpha))
@@ -0,0 +1,272 @@
+"""On-disk library of pMPC brush conformations.
+
+`Brush` always places the rigid `mpc.pdb` geometry along a straight line, so
+every brush of a layer starts out in the same stretched conformation.
+`sample_conformers` grows brushes with random torsions around the bonds
+that join consecutive repeat units (and the chain to the initiator), while
+rejecting conformations that overlap themselves or cross the grafting
+plane. `ConformerLibrary` stores such conformations per chain length and
+force field in an uncompressed ``.npz`` file whose arrays are memory-mapped
+on load, so that layers can draw from it at build time. Only sampling needs
+mbuild, so a library can be read without it.
+"""
+import os
+import struct
+import zipfile
+
+import numpy as np
+from numpy import pi
+from scipy import sparse
+
+from pmpc.template import fit_transform, rotation_matrix, template_from_compound
+
+
+def _near(bonds, n_particles, depth=3):
+    """Sparse boolean matrix of particle pairs at most `depth` bonds apart."""
+    ones = np.ones(len(bonds), dtype=bool)
+    adjacency = sparse.coo_matrix((ones, (bonds[:, 0], bonds[:, 1])), shape=(n_particles, n_particles))
+    adjacency = (adjacency + adjacency.T).tocsr().astype(np.int32)
+    near = adjacency
+    step = adjacency
+    for _ in range(depth - 1):
+        step = step @ adjacency
+        near = near + step
+    return near > 0
+
+
+def _grow(rng, units, near, fixed, template, anchor, normal, cutoff, max_tries, chunk=8):
+    """Place the units of one chain, or return None when a unit cannot be placed."""
+    n = len(units)
+    rotations = np.empty((n, 3, 3))
+    translations = np.empty((n, 3))
+    placed = [fixed]
+    placed_xyz = [template.xyz[fixed]]
+    for k, (xyz, rows, previous, step, point, axis) in enumerate(units):
+        if previous is None:
+            previous = (rotations[k - 1], translations[k - 1])
+        others = np.concatenate(placed)
+        others_xyz = np.concatenate(placed_xyz)
+        checked = ~near[rows][:, others].toarray()
+
+        for start in range(0, max_tries, chunk):
+            q = rotation_matrix(rng.uniform(0, 2 * pi, min(chunk, max_tries - start)), axis)
+            r = previous[0] @ step[0] @ q
+            t = ((point - q @ point) @ step[0].T + step[1]) @ previous[0].T + previous[1]
+            candidates = xyz @ np.swapaxes(r, 1, 2) + t[:, None, :]
+
+            above = ((candidates - anchor) @ normal).min(axis=1) > 0
+            d2 = ((candidates[:, :, None, :] - others_xyz[None, None]) ** 2).sum(axis=-1)
+            clear = ~((d2 < cutoff ** 2) & checked).any(axis=(1, 2))
+            accepted = np.flatnonzero(above & clear)
+            if len(accepted):
+                rotations[k] = r[accepted[0]]
+                translations[k] = t[accepted[0]]
+                placed.append(rows)
+                placed_xyz.append(candidates[accepted[0]])
+                break
+        else:
+            return None
+    return rotations, translations
+
+
+def sample_conformers(chain_length, n_conformers, alpha=pi / 4, seed=None, cutoff=0.2, max_tries=100,
+                      max_restarts=100):
+    """Grow brush conformations with random backbone torsions.
+
+    Each repeat unit is rotated by a random angle around the bond that joins
+    it to the previous unit, or to the initiator for the first unit, which
+    changes only the torsions around that bond. Heavy atoms more than three
+    bonds apart must stay `cutoff` apart, and no chain atom may cross the
+    plane of the silicon atom that binds to the surface. Up to `max_tries`
+    angles are tried per unit before the conformation is restarted.
+
+    Parameters
+    ----------
+    chain_length : int
+        Number of monomers per brush.
+    n_conformers : int
+        Number of conformations to generate.
+    alpha : float, optional, default=pi/4
+        Passed on to `Brush`.
+    seed : int, optional, default=None
+        Seed of the random number generator.
+    cutoff : float, optional, default=0.2
+        Minimum distance between non-bonded heavy atoms, in nm.
+    max_tries : int, optional, default=100
+        Number of torsions tried per unit.
+    max_restarts : int, optional, default=100
+        Number of times a conformation may be restarted before giving up.
+
+    Returns
+    -------
+    xyz : np.ndarray, shape=(n_conformers, n_particles, 3)
+        Positions of every particle of ``Brush(chain_length, alpha)``, in
+        the frame of that brush.
+    """
+    from pmpc.brush import Brush
+    from pmpc.chain import chain_template, place_chain, repeat_unit
+
+    rng = np.random.default_rng(seed)
+    brush = Brush(chain_length=chain_length, alpha=alpha)
+    template = template_from_compound(brush, parts=['silane', 'initiator', 'pmpc'])
+    unit = repeat_unit(alpha)
+    n_atoms = len(unit.monomer.names)
+
+    # The chain was moved into place rigidly, so one transform maps it from
+    # its own frame into the frame of the brush.
+    chain = np.flatnonzero(template.parts == 'pmpc')
+    chain_frame = fit_transform(chain_template(chain_length, alpha).xyz, template.xyz[chain])
+
+    # The first unit turns around its bond to the initiator, every other unit
+    # around its bond to the previous unit. Axes are in the frame of the unit.
+    bond = template.bonds[np.isin(template.bonds, chain).sum(axis=1) == 1][0]
+    first = int(np.flatnonzero(chain == bond[np.isin(bond, chain)][0])[0])
+    initiator = (template.xyz[bond[~np.isin(bond, chain)][0]] - chain_frame[1]) @ chain_frame[0]
+    first_point = unit.monomer.xyz[first]
+    first_axis = (first_point - initiator) / np.linalg.norm(first_point - initiator)
+
+    a, b = unit.link
+    link_point = unit.monomer.xyz[a]
+    previous = (unit.monomer.xyz[b] - unit.translation) @ unit.rotation
+    link_axis = (link_point - previous) / np.linalg.norm(link_point - previous)
+
+    heavy = unit.monomer.elements != 'H'
+    monomer = unit.monomer.xyz[heavy]
+    units = [(monomer, chain[k * n_atoms:(k + 1) * n_atoms][heavy],
+              chain_frame if k == 0 else None,
+              (np.eye(3), np.zeros(3)) if k == 0 else (unit.rotation, unit.translation),
+              first_point if k == 0 else link_point,
+              first_axis if k == 0 else link_axis)
+             for k in range(chain_length)]
+
+    anchor = brush['down'].anchor.pos
+    normal = anchor - brush['down'].center
+    normal /= np.linalg.norm(normal)
+    near = _near(template.bonds, len(template.names))
+    fixed = np.flatnonzero((template.parts != 'pmpc') & (template.elements != 'H'))
+
+    conformers = np.empty((n_conformers,) + template.xyz.shape)
+    for c in range(n_conformers):
+        for _ in range(max_restarts):
+            frames = _grow(rng, units, near, fixed, template, anchor, normal, cutoff, max_tries)
+            if frames is not None:
+                break
+        else:
+            raise RuntimeError('Could not grow a conformation of a {}-mer without overlaps '
+                               'in {} attempts.'.format(chain_length, max_restarts))
+        xyz = template.xyz.copy()
+        xyz[chain] = place_chain(unit, *frames)
+        conformers[c] = xyz
+    return conformers
+
+
+def _memmap_npz(filename):
+    """Memory-map every array of an uncompressed ``.npz`` file."""
+    arrays = {}
+    with zipfile.ZipFile(filename) as archive, open(filename, 'rb') as handle:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('{} is compressed and cannot be memory-mapped.'.format(filename))
+            handle.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', handle.read(4))
+            handle.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(handle)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(handle)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(handle)
+            arrays[info.filename[:-len('.npy')]] = np.memmap(
+                filename, dtype=dtype, mode='r', offset=handle.tell(), shape=shape,
+                order='F' if fortran_order else 'C')
+    return arrays
+
+
+class ConformerLibrary(object):
+    """Brush conformations stored in an uncompressed ``.npz`` file.
+
+    Conformations are keyed by chain length, the `alpha` of the brush they
+    were grown for, and force field. The force field
+    is only a label: conformations generated by `generate` are not relaxed
+    and are filed under ``forcefield=None``, while conformations taken from
+    simulations can be filed under the force field they were relaxed with.
+    Arrays are stored as float32 and memory-mapped, so opening a library and
+    drawing from it only reads the conformations that are used.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the library. It is created on the first `add`.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._arrays = _memmap_npz(filename) if os.path.exists(filename) else {}
+
+    @staticmethod
+    def key(chain_length, forcefield=None, alpha=pi / 4):
+        """Name of the array holding the conformations of a chain length."""
+        key = 'L{}_a{:g}'.format(chain_length, alpha)
+        if forcefield is None:
+            return key
+        return '{}_{}'.format(key, forcefield)
+
+    def keys(self):
+        return list(self._arrays)
+
+    def __contains__(self, key):
+        return key in self._arrays
+
+    def conformers(self, chain_length, forcefield=None, alpha=pi / 4):
+        """Return the memory-mapped conformations of a chain length.
+
+        Returns
+        -------
+        xyz : np.memmap, shape=(n_conformers, n_particles, 3), dtype=float32
+        """
+        key = self.key(chain_length, forcefield, alpha)
+        if key not in self._arrays:
+            raise KeyError('No conformers for chain_length={}, forcefield={} and alpha={:g} in {}.'.format(
+                chain_length, forcefield, alpha, self.filename))
+        return self._arrays[key]
+
+    def add(self, chain_length, xyz, forcefield=None, alpha=pi / 4):
+        """Append conformations to the library and rewrite the file.
+
+        Parameters
+        ----------
+        chain_length : int
+        xyz : np.ndarray, shape=(n_conformers, n_particles, 3)
+            Positions in the frame of ``Brush(chain_length, alpha)``.
+        forcefield : str, optional, default=None
+        alpha : float, optional, default=pi/4
+        """
+        key = self.key(chain_length, forcefield, alpha)
+        xyz = np.asarray(xyz, dtype=np.float32)
+        arrays = {name: np.asarray(array) for name, array in self._arrays.items()}
+        if key in arrays:
+            xyz = np.concatenate((arrays[key], xyz))
+        arrays[key] = xyz
+
+        self._arrays = {}
+        temporary = self.filename + '.tmp.npz'
+        np.savez(temporary, **arrays)
+        os.replace(temporary, self.filename)
+        self._arrays = _memmap_npz(self.filename)
+
+    def generate(self, chain_length, n_conformers, forcefield=None, alpha=pi / 4, **kwargs):
+        """Generate conformations with `sample_conformers` and add them.
+
+        Extra keyword arguments are passed on to `sample_conformers`.
+        """
+        self.add(chain_length, sample_conformers(chain_length, n_conformers, alpha=alpha, **kwargs),
+                 forcefield, alpha)
+
+    def sample(self, chain_length, n, forcefield=None, seed=None, alpha=pi / 4):
+        """Draw `n` conformations at random, with replacement.
+
+        Returns
+        -------
+        xyz : np.ndarray, shape=(n, n_particles, 3)
+        """
+        conformers = self.conformers(chain_length, forcefield, alpha)
+        picks = np.random.default_rng(seed).integers(len(conformers), size=n)
+        return np.asarray(conformers[picks], dtype=float)
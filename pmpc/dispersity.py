@@ -0,0 +1,106 @@
+"""Chain length distributions of polydisperse brushes.
+
+Brushes grown by surface-initiated ATRP are not all the same length. The
+distributions here draw a degree of polymerization for every grafted chain;
+`chain_lengths` also accepts a fixed length or explicit per-chain lengths,
+so that callers can take any of the three.
+"""
+import numpy as np
+
+
+class SchulzZimm(object):
+    """Schulz-Zimm distribution of chain lengths.
+
+    The number distribution of lengths is a gamma distribution of shape
+    ``1 / (pdi - 1)``, which has a number average `mn` and a dispersity
+    ``Mw / Mn`` of `pdi`. Draws are rounded to the nearest positive integer.
+
+    Parameters
+    ----------
+    mn : float
+        Number-average chain length.
+    pdi : float
+        Dispersity, larger than 1.
+    """
+    def __init__(self, mn, pdi):
+        if pdi <= 1:
+            raise ValueError('The dispersity of a Schulz-Zimm distribution must exceed 1, got {}.'.format(pdi))
+        self.mn = mn
+        self.pdi = pdi
+
+    def sample(self, n, seed=None):
+        """Draw `n` chain lengths.
+
+        Returns
+        -------
+        lengths : np.ndarray, shape=(n,), dtype=int
+        """
+        shape = 1 / (self.pdi - 1)
+        lengths = np.random.default_rng(seed).gamma(shape, self.mn / shape, size=n)
+        return np.maximum(np.rint(lengths), 1).astype(int)
+
+
+class Poisson(object):
+    """Poisson distribution of chain lengths.
+
+    Living polymerizations with fast initiation give one monomer plus a
+    Poisson number of further monomers, with a dispersity close to
+    ``1 + 1 / mn``.
+
+    Parameters
+    ----------
+    mn : float
+        Number-average chain length, at least 1.
+    """
+    def __init__(self, mn):
+        if mn < 1:
+            raise ValueError('The average chain length must be at least 1, got {}.'.format(mn))
+        self.mn = mn
+
+    @property
+    def pdi(self):
+        return 1 + (self.mn - 1) / self.mn ** 2
+
+    def sample(self, n, seed=None):
+        """Draw `n` chain lengths.
+
+        Returns
+        -------
+        lengths : np.ndarray, shape=(n,), dtype=int
+        """
+        return 1 + np.random.default_rng(seed).poisson(self.mn - 1, size=n)
+
+
+def chain_lengths(chain_length, n, seed=None):
+    """Return the length of each of `n` chains.
+
+    Parameters
+    ----------
+    chain_length : int, sequence of int, SchulzZimm or Poisson
+        A length shared by every chain, one length per chain, or a
+        distribution to draw the lengths from.
+    n : int
+        Number of chains.
+    seed : int, optional, default=None
+        Seed of the draws from a distribution.
+
+    Returns
+    -------
+    lengths : np.ndarray, shape=(n,), dtype=int
+    """
+    if hasattr(chain_length, 'sample'):
+        return np.asarray(chain_length.sample(n, seed=seed), dtype=int)
+    if np.ndim(chain_length) == 0:
+        return np.full(n, int(chain_length))
+    lengths = np.asarray(chain_length, dtype=int)
+    if lengths.shape != (n,):
+        raise ValueError('Expected {} chain lengths, got {}.'.format(n, len(lengths)))
+    if lengths.min() < 1:
+        raise ValueError('Chain lengths must be at least 1.')
+    return lengths
+
+
+def dispersity(lengths):
+    """Return the dispersity ``Mw / Mn`` of a set of chain lengths."""
+    lengths = np.asarray(lengths, dtype=float)
+    return (lengths ** 2).mean() / lengths.mean() ** 2
@@ -0,0 +1,146 @@
+"""Compare how several force field variants type the same structure.
+
+`compare_forcefields` types one structure with every variant in parallel,
+each worker going through the force field cache and a `FragmentTyper`, and
+lines the results up: atom types and charges per atom, and the parameters of
+every bonded term, as arrays with one row per variant. Terms a variant lacks
+are NaN, so differences between variants are found with array comparisons
+instead of loops over atoms.
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from pmpc.atomtyping import _type_component
+
+
+Comparison = namedtuple('Comparison', ['variants', 'types', 'charges', 'net_charge', 'terms'])
+Comparison.__doc__ = """Typing results of several force field variants, aligned.
+
+Parameters
+----------
+variants : list of str
+types : np.ndarray, shape=(v, n), dtype=str
+charges : np.ndarray, shape=(v, n)
+net_charge : np.ndarray, shape=(v,)
+terms : dict
+    Keyed by ``(section, funct)``, e.g. ``('dihedrals', 9)``. Each value
+    holds the term indices, shape=(k, m), whether each variant has each
+    term, shape=(v, k), and their parameters, shape=(v, k, p), NaN where a
+    variant lacks the term. Terms repeated on the same atoms, such as the
+    periodic dihedrals of one torsion, are told apart by a last index column
+    counting the repeats.
+"""
+
+
+def _ranked(indices, orient):
+    """Orient the rows of a term table and append how often each row was seen before."""
+    indices = np.asarray(indices, dtype=int).reshape(len(indices), -1)
+    if orient and len(indices):
+        flip = indices[:, 0] > indices[:, -1]
+        indices = np.where(flip[:, None], indices[:, ::-1], indices)
+    if not len(indices):
+        return np.empty((0, indices.shape[1] + 1), dtype=int)
+    _, inverse = np.unique(indices, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    order = np.argsort(inverse, kind='stable')
+    first = np.searchsorted(inverse[order], inverse[order])
+    rank = np.empty(len(indices), dtype=int)
+    rank[order] = np.arange(len(indices)) - first
+    return np.column_stack((indices, rank))
+
+
+def align(variants, molecules):
+    """Line up the `MoleculeType` each variant gave the same structure.
+
+    Returns
+    -------
+    comparison : Comparison
+    """
+    types = np.array([molecule.types for molecule in molecules]).astype(str)
+    charges = np.array([molecule.charges for molecule in molecules], dtype=float)
+    tables = {}
+    for v, molecule in enumerate(molecules):
+        for section in ('bonds', 'pairs', 'angles', 'dihedrals'):
+            for interactions in getattr(molecule, section):
+                # Impropers name their central atom first, every other term reads both ways.
+                keys = _ranked(interactions.indices, orient=interactions.funct not in (2, 4))
+                tables.setdefault((section, interactions.funct), []).append((v, keys, interactions.params))
+
+    terms = {}
+    for key, entries in tables.items():
+        indices, inverse = np.unique(np.concatenate([keys for _, keys, _ in entries]), axis=0,
+                                     return_inverse=True)
+        inverse = inverse.ravel()
+        width = max((params.shape[1] for _, _, params in entries if params is not None), default=0)
+        present = np.zeros((len(variants), len(indices)), dtype=bool)
+        params = np.full((len(variants), len(indices), width), np.nan)
+        start = 0
+        for v, keys, values in entries:
+            rows = inverse[start:start + len(keys)]
+            start += len(keys)
+            present[v, rows] = True
+            if values is not None:
+                params[v, rows] = values
+        terms[key] = (indices, present, params)
+    return Comparison(list(variants), types, charges, charges.sum(axis=1), terms)
+
+
+def compare_forcefields(template, variants, processes=None, **kwargs):
+    """Type one structure with several force fields and align the results.
+
+    Parameters
+    ----------
+    template : Template
+        Names, elements, positions and bonds of the structure.
+    variants : dict
+        XML files of each force field, keyed by a name for the variant.
+    processes : int, optional, default=None
+        Number of worker processes, see `ProcessPoolExecutor`.
+    **kwargs
+        Passed on to `FragmentTyper`.
+
+    Returns
+    -------
+    comparison : Comparison
+    """
+    names = list(variants)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = list(executor.map(_type_component, [variants[name] for name in names],
+                                    [template] * len(names), [kwargs] * len(names)))
+    return align(names, [molecule for _, molecule in results])
+
+
+def differences(comparison, reference=0, atol=1e-6):
+    """Find where each variant differs from a reference variant.
+
+    Returns
+    -------
+    atoms : np.ndarray, shape=(v, n), dtype=bool
+        Atoms whose type or charge differs from the reference.
+    terms : dict
+        Keyed like ``comparison.terms``, boolean arrays of shape (v, k) that
+        mark terms whose parameters differ from the reference, or that only
+        one of the two has.
+    """
+    atoms = ((comparison.types != comparison.types[reference])
+             | ~np.isclose(comparison.charges, comparison.charges[reference], rtol=0, atol=atol))
+    terms = {}
+    for key, (_, present, params) in comparison.terms.items():
+        same = np.isclose(params, params[reference], rtol=0, atol=atol, equal_nan=True).all(axis=2)
+        terms[key] = (present != present[reference]) | ~same
+    return atoms, terms
+
+
+def charge_report(comparison, atol=1e-4):
+    """Return the net charge of each variant and whether it is a whole number.
+
+    Returns
+    -------
+    report : list of tuple
+        ``(variant, net_charge, integral)`` for every variant.
+    """
+    net = comparison.net_charge
+    integral = np.abs(net - np.rint(net)) < atol
+    return list(zip(comparison.variants, net.tolist(), integral.tolist()))
@@ -0,0 +1,381 @@
+"""Load Foyer force fields once and keep them compiled.
+
+Parsing ``charge_neutral_oplsaa_imodels.xml`` and turning every SMARTS
+definition into a syntax tree takes seconds, and Foyer repeats the SMARTS
+parsing every time a force field is applied. `load_forcefield` does the
+work once per set of XML files: the parsed force field and the syntax tree
+of every atom type are pickled to a cache file named after the hash of the
+XML contents, and kept in memory for later calls in the same process.
+Editing an XML file changes its hash, so stale caches are never read.
+
+`prune_forcefield` drops the rules that cannot match a given system, such
+as those for elements it lacks, before Foyer tries them, and
+`TypingProfiler` times every rule Foyer does try.
+"""
+from collections import Counter, namedtuple
+import copy
+import csv
+import hashlib
+import json
+import os
+import pickle
+import re
+import tempfile
+import time
+import warnings
+
+import numpy as np
+
+
+CACHE_DIR = os.environ.get('PMPC_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'pmpc'))
+
+_LOADED = {}
+
+
+def _files(forcefield_files):
+    if isinstance(forcefield_files, (str, os.PathLike)):
+        return [os.fspath(forcefield_files)]
+    return [os.fspath(f) for f in forcefield_files]
+
+
+def content_hash(forcefield_files):
+    """Hash the contents of force field files and the Foyer version reading them."""
+    try:
+        from foyer import __version__ as version
+    except ImportError:
+        version = ''
+    digest = hashlib.sha256(version.encode())
+    for filename in _files(forcefield_files):
+        with open(filename, 'rb') as xml:
+            contents = xml.read()
+        digest.update(hashlib.sha256(contents).digest())
+    return digest.hexdigest()
+
+
+class CompiledParser(object):
+    """A SMARTS parser that returns syntax trees parsed ahead of time.
+
+    Foyer builds a `SMARTSGraph` from ``forcefield.parser.parse(smarts)`` for
+    every atom type each time a force field is applied. Replacing the parser
+    with this one hands out the stored trees instead, and falls back to the
+    wrapped parser for SMARTS strings it has not seen. The `SMARTSGraph`
+    built around each tree is not cached: Foyer still rebuilds it on every
+    apply, because it holds the type map of the structure being typed.
+
+    Parameters
+    ----------
+    parser : foyer.smarts.SMARTS
+    trees : dict, optional, default=None
+        Syntax trees keyed by SMARTS string.
+    """
+    def __init__(self, parser, trees=None):
+        self.parser = parser
+        self.trees = {} if trees is None else trees
+
+    def parse(self, smarts_string):
+        tree = self.trees.get(smarts_string)
+        if tree is None:
+            tree = self.trees[smarts_string] = self.parser.parse(smarts_string)
+        return tree
+
+    def __getattr__(self, name):
+        if name == 'parser':
+            raise AttributeError(name)
+        return getattr(self.parser, name)
+
+
+def compile_forcefield(forcefield):
+    """Parse the SMARTS of every atom type of a Foyer force field in place."""
+    if not isinstance(forcefield.parser, CompiledParser):
+        forcefield.parser = CompiledParser(forcefield.parser)
+    for smarts in forcefield.atomTypeDefinitions.values():
+        if smarts:
+            forcefield.parser.parse(smarts)
+    return forcefield
+
+
+def load_forcefield(forcefield_files, cache_dir=None):
+    """Load a compiled Foyer force field, from the cache when possible.
+
+    Parameters
+    ----------
+    forcefield_files : str or list of str
+        XML files of the force field.
+    cache_dir : str, optional, default=None
+        Directory of the cache files, `CACHE_DIR` by default, which the
+        ``PMPC_CACHE`` environment variable sets. Use False to skip the
+        disk cache.
+
+    Returns
+    -------
+    forcefield : foyer.Forcefield
+        Shared between calls with the same files, so it should not be
+        modified.
+    """
+    key = content_hash(forcefield_files)
+    if key in _LOADED:
+        return _LOADED[key]
+
+    forcefield = None
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    path = os.path.join(cache_dir, 'forcefield-{}.pkl'.format(key)) if cache_dir is not False else None
+    if path is not None and os.path.exists(path):
+        try:
+            with open(path, 'rb') as cache:
+                forcefield = pickle.load(cache)
+        except Exception as error:
+            warnings.warn('Ignoring unreadable force field cache {}: {}'.format(path, error))
+
+    if forcefield is None:
+        import foyer
+        forcefield = compile_forcefield(foyer.Forcefield(forcefield_files=_files(forcefield_files)))
+        if path is not None:
+            _dump(forcefield, path)
+
+    _LOADED[key] = forcefield
+    return forcefield
+
+
+def _dump(forcefield, path):
+    """Pickle a force field atomically, so that concurrent workers never read half a file."""
+    temporary = None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(handle, 'wb') as cache:
+            pickle.dump(forcefield, cache, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)
+    except Exception as error:
+        warnings.warn('Could not cache force field to {}: {}'.format(path, error))
+        if temporary is not None and os.path.exists(temporary):
+            os.remove(temporary)
+
+
+Pruned = namedtuple('Pruned', ['forcefield', 'n_rules', 'by_element', 'by_neighbours'])
+Pruned.__doc__ = """A force field without the rules that cannot match a system.
+
+Parameters
+----------
+forcefield : foyer.Forcefield
+    A shallow copy of the force field with fewer atom type definitions.
+n_rules : int
+    Number of SMARTS rules of the original force field.
+by_element : list of str
+    Atom types dropped because the system lacks an element their rule needs.
+by_neighbours : list of str
+    Atom types dropped because no atom of their element has the number of
+    neighbours their rule asks for.
+"""
+
+_BRACKET = re.compile(r'\[([^\]]*)\]')
+_BARE = re.compile(r'Cl|Br|Si|Na|Mg|Ca|Li|Zn|Al|[BCNOSPFIHK]|[bcnosp]')
+_ELEMENT = re.compile(r'^(?:[A-Z][a-z]?|[bcnosp])$')
+
+
+def _strip_recursive(smarts):
+    """Remove recursive ``$(...)`` environments, which only ever restrict a match further."""
+    out, depth, i = [], 0, 0
+    while i < len(smarts):
+        if smarts.startswith('$(', i) or (depth and smarts[i] == '('):
+            depth += 1
+            i += 2 if smarts[i] == '$' else 1
+            continue
+        if depth:
+            depth -= smarts[i] == ')'
+        else:
+            out.append(smarts[i])
+        i += 1
+    return ''.join(out)
+
+
+def rule_requirements(smarts):
+    """Return what a SMARTS rule needs from a system to match anything.
+
+    Only plain, non-negated element and ``X`` primitives are read, so rules
+    with alternatives or custom types are never pruned by mistake.
+
+    Returns
+    -------
+    element : str or None
+        Element of the atom the rule types.
+    degree : int or None
+        Number of neighbours of that atom.
+    elements : set of str
+        Elements that must be present for the rule to match.
+    """
+    smarts = _strip_recursive(smarts)
+    atoms = []
+    position = 0
+    for match in _BRACKET.finditer(smarts):
+        atoms.extend(('bare', token) for token in _BARE.findall(smarts[position:match.start()]))
+        atoms.append(('bracket', match.group(1)))
+        position = match.end()
+    atoms.extend(('bare', token) for token in _BARE.findall(smarts[position:]))
+
+    elements = set()
+    first = (None, None)
+    for k, (kind, token) in enumerate(atoms):
+        element, degree = None, None
+        if kind == 'bare':
+            element = token.capitalize()
+        elif ',' not in token:
+            for primitive in re.split('[;&]', token):
+                if _ELEMENT.match(primitive):
+                    element = primitive.capitalize()
+                elif re.match(r'^X\d+$', primitive):
+                    degree = int(primitive[1:])
+        if element is not None:
+            elements.add(element)
+        if k == 0:
+            first = (element, degree)
+    return first[0], first[1], elements
+
+
+def environment_histogram(elements, bonds):
+    """Count the atoms of each element and number of neighbours.
+
+    Returns
+    -------
+    histogram : Counter
+        Keyed by ``(element, degree)``.
+    """
+    elements = np.asarray(elements)
+    bonds = np.asarray(bonds, dtype=int).reshape(-1, 2)
+    degree = np.bincount(bonds.ravel(), minlength=len(elements))
+    return Counter(zip([e.capitalize() for e in elements.tolist()], degree.tolist()))
+
+
+def prune_forcefield(forcefield, elements, bonds):
+    """Drop the atom type rules that cannot match a system.
+
+    Foyer tries the SMARTS of every atom type on every atom. A rule for
+    phosphorus cannot match a system without phosphorus, and a rule for a
+    carbon with four neighbours cannot match a system whose carbons all have
+    three, so dropping these rules leaves the typing unchanged.
+
+    Parameters
+    ----------
+    forcefield : foyer.Forcefield
+    elements : np.ndarray, shape=(n,), dtype=str
+    bonds : np.ndarray, shape=(m, 2), dtype=int
+
+    Returns
+    -------
+    pruned : Pruned
+    """
+    histogram = environment_histogram(elements, bonds)
+    present = {element for element, _ in histogram}
+    type_elements = getattr(forcefield, 'atomTypeElements', {})
+    definitions = {}
+    by_element, by_neighbours = [], []
+    rules = {name: smarts for name, smarts in forcefield.atomTypeDefinitions.items() if smarts}
+    for name, smarts in rules.items():
+        element, degree, needed = rule_requirements(smarts)
+        if type_elements.get(name):
+            if type_elements[name].capitalize() != element:
+                degree = None
+            element = type_elements[name].capitalize()
+            needed = needed | {element}
+        if not needed <= present:
+            by_element.append(name)
+        elif degree is not None and (element, degree) not in histogram:
+            by_neighbours.append(name)
+        else:
+            definitions[name] = smarts
+    pruned = copy.copy(forcefield)
+    pruned.atomTypeDefinitions = definitions
+    return Pruned(pruned, len(rules), by_element, by_neighbours)
+
+
+def _node_elements(graph):
+    """Element symbols of the atoms of a Foyer topology graph, or None when they cannot be read."""
+    elements = []
+    for _, data in graph.nodes(data=True):
+        atom = data.get('atom_data', data.get('atom'))
+        element = getattr(atom, 'element', None)
+        if not isinstance(element, str):
+            element = getattr(atom, 'element_name', None)
+        if not isinstance(element, str):
+            return None
+        elements.append(element.capitalize())
+    return Counter(elements)
+
+
+class TypingProfiler(object):
+    """Record how long each SMARTS rule takes while Foyer types a system.
+
+    Used as a context manager around ``forcefield.apply``; every call of
+    ``SMARTSGraph.find_matches`` in between is timed and counted under the
+    atom type of its rule. Foyer only tries a rule on the atoms of the
+    element the rule types, so those atoms are counted as its candidates;
+    rules without a plain element count every atom.
+
+    Parameters
+    ----------
+    smarts_graph : type, optional, default=None
+        The class whose ``find_matches`` to time, Foyer's `SMARTSGraph` by
+        default.
+
+    Examples
+    --------
+    >>> with TypingProfiler() as profiler:
+    ...     forcefield.apply(compound)
+    >>> profiler.to_csv('typing.csv')
+    """
+    fields = ['name', 'smarts', 'calls', 'candidates', 'matches', 'time']
+
+    def __init__(self, smarts_graph=None):
+        if smarts_graph is None:
+            from foyer.smarts_graph import SMARTSGraph as smarts_graph
+        self.smarts_graph = smarts_graph
+        self.stats = {}
+
+    def __enter__(self):
+        find_matches = self._find_matches = self.smarts_graph.find_matches
+        stats = self.stats
+        counted = {}
+
+        def timed(rule, graph, *args, **kwargs):
+            # find_matches is a generator, so it has to be consumed to be timed.
+            start = time.perf_counter()
+            matches = list(find_matches(rule, graph, *args, **kwargs))
+            elapsed = time.perf_counter() - start
+            name = getattr(rule, 'name', None)
+            smarts = getattr(rule, 'smarts_string', None)
+            entry = stats.setdefault(name, {'name': name, 'smarts': smarts,
+                                            'calls': 0, 'candidates': 0, 'matches': 0, 'time': 0.0})
+            entry['calls'] += 1
+            if id(graph) not in counted:
+                counted.clear()
+                counted[id(graph)] = (graph, _node_elements(graph))
+            elements = counted[id(graph)][1]
+            element = rule_requirements(smarts)[0] if smarts else None
+            if elements is None or element is None:
+                entry['candidates'] += len(graph)
+            else:
+                entry['candidates'] += elements[element]
+            entry['matches'] += len(matches)
+            entry['time'] += elapsed
+            return matches
+
+        self.smarts_graph.find_matches = timed
+        return self
+
+    def __exit__(self, *exc):
+        self.smarts_graph.find_matches = self._find_matches
+        return False
+
+    def report(self, sort='time'):
+        """Return one record per atom type, largest `sort` first."""
+        return sorted(self.stats.values(), key=lambda entry: entry[sort], reverse=True)
+
+    def to_json(self, filename, sort='time'):
+        with open(filename, 'w') as out:
+            json.dump(self.report(sort), out, indent=2)
+
+    def to_csv(self, filename, sort='time'):
+        with open(filename, 'w', newline='') as out:
+            writer = csv.DictWriter(out, fieldnames=self.fields)
+            writer.writeheader()
+            writer.writerows(self.report(sort))
@@ -0,0 +1,542 @@
+"""Bulk grafting of rigid copies onto the ports of a surface.
+
+`mb.Pattern.apply_to_compound`, which `mb.lib.recipes.Monolayer` uses,
+clones the guest and calls `force_overlap` once per port. Every copy is the
+same rigid body, so the transform that `force_overlap` would compute can be
+fitted for all ports at once from the port geometries, and the grafted
+positions are then placed with one batched matrix product. The arrays are
+handled without mbuild, which is only imported to read or build compounds.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from pmpc.spatial import CellList
+from pmpc.template import Template, fit_transform, rotation_matrix, stamp, template_from_compound
+
+
+Graft = namedtuple('Graft', ['name', 'template', 'xyz', 'sites', 'anchor'])
+Graft.__doc__ = """Copies of one template grafted onto a surface.
+
+Parameters
+----------
+name : str
+    Name given to each copy when it is turned into a Compound.
+template : Template
+    The grafted species.
+xyz : np.ndarray, shape=(k, n, 3)
+    Positions of every copy.
+sites : np.ndarray, shape=(k,)
+    Index of the port each copy is grafted to.
+anchor : int
+    Index of the template particle bonded to the surface.
+"""
+
+Layer = namedtuple('Layer', ['surface', 'sites', 'grafts', 'box', 'up', 'anchors'])
+Layer.__new__.__defaults__ = (None, None)
+Layer.__doc__ = """A grafted surface stored as arrays.
+
+Parameters
+----------
+surface : Template
+    The surface particles.
+sites : np.ndarray, shape=(p,)
+    Index of the surface particle anchoring each port.
+grafts : list of Graft
+    Everything attached to the ports.
+box : np.ndarray, shape=(3,)
+    Box lengths of the surface in nm.
+up : np.ndarray, shape=(p, 4, 3), optional, default=None
+anchors : np.ndarray, shape=(p, 3), optional, default=None
+    Port geometry, see `port_frames`, kept so that copies can be grafted
+    onto the layer later.
+"""
+
+
+def port_frames(ports):
+    """Return the ghost particle positions of a list of ports.
+
+    Parameters
+    ----------
+    ports : list of mb.Port
+
+    Returns
+    -------
+    up : np.ndarray, shape=(p, 4, 3)
+        Positions of the 'up' sub-ports.
+    anchors : np.ndarray, shape=(p, 3)
+        Positions of the port anchors.
+    """
+    up = np.array([port['up'].xyz_with_ports for port in ports]).reshape(-1, 4, 3)
+    anchors = np.array([port.anchor.pos for port in ports]).reshape(-1, 3)
+    return up, anchors
+
+
+def overlap_transforms(port, up, anchors):
+    """Batched equivalent of ``mb.force_overlap(guest, port, host_port)``.
+
+    Like `force_overlap`, either sub-port of `port` is matched onto the 'up'
+    sub-port of each host port, whichever places the two anchors further
+    apart.
+
+    Parameters
+    ----------
+    port : mb.Port
+        The port of the guest compound.
+    up : np.ndarray, shape=(p, 4, 3)
+        'up' sub-ports of the host ports, see `port_frames`.
+    anchors : np.ndarray, shape=(p, 3)
+        Anchor positions of the host ports.
+
+    Returns
+    -------
+    rotations : np.ndarray, shape=(p, 3, 3)
+    translations : np.ndarray, shape=(p, 3)
+    """
+    anchor = port.anchor.pos
+    rotation_up, translation_up = fit_transform(port['up'].xyz_with_ports, up)
+    rotation_down, translation_down = fit_transform(port['down'].xyz_with_ports, up)
+    distance_up = np.linalg.norm(rotation_up @ anchor + translation_up - anchors, axis=1)
+    distance_down = np.linalg.norm(rotation_down @ anchor + translation_down - anchors, axis=1)
+
+    use_down = distance_down - distance_up > 0
+    rotations = np.where(use_down[:, None, None], rotation_down, rotation_up)
+    translations = np.where(use_down[:, None], translation_down, translation_up)
+    return rotations, translations
+
+
+def choose_sites(pattern, host, scale=True):
+    """Pick the port closest to each point of a pattern.
+
+    Ports are taken in the order of ``host.available_ports()`` and every
+    port is used at most once, exactly as `mb.Pattern.apply_to_compound`
+    does. Like that method, the pattern is scaled in place when `scale`
+    is True.
+
+    Parameters
+    ----------
+    pattern : mb.Pattern
+    host : mb.Compound
+    scale : bool, optional, default=True
+        Scale the points to the lengths of the host's bounding box and
+        shift them by its mins.
+
+    Returns
+    -------
+    sites : np.ndarray, shape=(len(pattern),)
+        Indices into ``host.available_ports()``.
+    """
+    ports = host.available_ports()
+    if len(ports) < len(pattern.points):
+        raise ValueError('Not enough ports for pattern.')
+    if scale:
+        box = host.get_boundingbox()
+        pattern.scale(box.lengths)
+        pattern.points += box.mins
+
+    positions = np.array([port['up']['middle'].pos for port in ports])
+    sites = np.empty(len(pattern.points), dtype=int)
+    for i, point in enumerate(pattern.points):
+        sites[i] = np.argmin(host.min_periodic_distance(point, positions))
+        positions[sites[i]] = np.inf
+    return sites
+
+
+def graft(guest, port_name, sites, up, anchors, parts=None, xyz=None):
+    """Place copies of `guest` on the given host ports.
+
+    Parameters
+    ----------
+    guest : mb.Compound
+        The compound to copy.
+    port_name : str
+        Label of the port of `guest` that attaches to the host.
+    sites : np.ndarray, shape=(k,)
+        Indices of the host ports to use.
+    up : np.ndarray, shape=(p, 4, 3)
+    anchors : np.ndarray, shape=(p, 3)
+        Host port geometry, see `port_frames`.
+    parts : list of str, optional, default=None
+        Child labels of `guest` to record, see `template_from_compound`.
+    xyz : np.ndarray, shape=(k, n, 3), optional, default=None
+        Positions of each copy in the frame of `guest`, e.g. conformations
+        drawn from a `ConformerLibrary`. By default every copy has the
+        positions of `guest`.
+
+    Returns
+    -------
+    graft : Graft
+    """
+    template = template_from_compound(guest, parts=parts)
+    if xyz is None:
+        xyz = template.xyz
+    elif np.shape(xyz) != (len(sites),) + template.xyz.shape:
+        raise ValueError('Expected positions of shape {}, got {}.'.format(
+            (len(sites),) + template.xyz.shape, np.shape(xyz)))
+    port = guest[port_name]
+    anchor = list(guest.particles()).index(port.anchor)
+
+    rotations, translations = overlap_transforms(port, up[sites], anchors[sites])
+    xyz = xyz @ np.swapaxes(rotations, 1, 2) + translations[:, None, :]
+    return Graft(guest.name, template, xyz, np.asarray(sites, dtype=int), anchor)
+
+
+def graft_layer(host, pattern, guest, backfill=None, guest_port_name='down',
+                backfill_port_name='up', parts=None, conformers=None, groups=None):
+    """Graft `guest` onto `host` following `pattern`, backfilling the rest.
+
+    This produces the same arrangement as
+    ``pattern.apply_to_compound(guest, guest_port_name, host, backfill, backfill_port_name)``
+    without cloning or moving any Compound.
+
+    Several guests, e.g. chains of different lengths, can be grafted by
+    giving a list of compounds and the index of the compound to use at each
+    point in `groups`. Each guest is fitted once and gives one Graft.
+
+    Parameters
+    ----------
+    host : mb.Compound
+        The surface, with one available port per grafting site.
+    pattern : mb.Pattern
+        Grafting points, scaled to the host in place.
+    guest : mb.Compound or list of mb.Compound
+        The grafted chain, or one chain per group.
+    backfill : mb.Compound, optional, default=None
+        Compound attached to every port `pattern` leaves free.
+    guest_port_name, backfill_port_name : str
+        Labels of the ports of `guest` and `backfill` that attach to the host.
+    parts : list of str, optional, default=None
+        Child labels of `guest` to record, see `template_from_compound`.
+    conformers : np.ndarray, shape=(len(pattern), n, 3), optional, default=None
+        Positions of each grafted copy of `guest` in its own frame. With
+        `groups`, a list with the positions of the copies of each guest.
+    groups : np.ndarray, shape=(len(pattern),), optional, default=None
+        Index into `guest` of the compound grafted at each point of `pattern`.
+
+    Returns
+    -------
+    layer : Layer
+    """
+    ports = host.available_ports()
+    surface = template_from_compound(host)
+    index = {particle: i for i, particle in enumerate(host.particles())}
+    sites = np.array([index[port.anchor] for port in ports], dtype=int)
+    up, anchors = port_frames(ports)
+
+    chosen = choose_sites(pattern, host)
+    if groups is None:
+        grafts = [graft(guest, guest_port_name, chosen, up, anchors, parts=parts, xyz=conformers)]
+    else:
+        groups = np.asarray(groups, dtype=int)
+        if conformers is None:
+            conformers = [None] * len(guest)
+        grafts = [graft(compound, guest_port_name, chosen[groups == g], up, anchors, parts=parts, xyz=xyz)
+                  for g, (compound, xyz) in enumerate(zip(guest, conformers))]
+    if backfill is not None:
+        free = np.setdiff1d(np.arange(len(ports)), chosen)
+        grafts.append(graft(backfill, backfill_port_name, free, up, anchors))
+
+    box = np.asarray(host.box.lengths if host.box is not None else host.get_boundingbox().lengths)
+    return Layer(surface, sites, grafts, box, up, anchors)
+
+
+def attach(compound, host_particles, layer):
+    """Add the grafts of a layer to a compound as Compounds.
+
+    Parameters
+    ----------
+    compound : mb.Compound
+        Receives one child per grafted copy.
+    host_particles : list of mb.Particle
+        Surface particles, in the order of ``layer.surface``.
+    layer : Layer
+
+    Returns
+    -------
+    copies : list of list of mb.Compound
+        The new children, one list per graft.
+    """
+    return [attach_graft(compound, host_particles, layer, graft) for graft in layer.grafts]
+
+
+def attach_graft(compound, host_particles, layer, graft, indices=None):
+    """Add copies of one graft of a layer to a compound as Compounds.
+
+    Parameters
+    ----------
+    compound : mb.Compound
+    host_particles : list of mb.Particle
+        Surface particles, in the order of ``layer.surface``.
+    layer : Layer
+    graft : Graft
+    indices : np.ndarray, optional, default=None
+        Copies to add, all of them by default.
+
+    Returns
+    -------
+    copies : list of mb.Compound
+    """
+    import mbuild as mb
+
+    if indices is None:
+        indices = range(len(graft.sites))
+    added = []
+    for i in indices:
+        copy = mb.Compound(name=graft.name)
+        particles = stamp(copy, graft.template, xyz=graft.xyz[i])
+        added.append(copy)
+        compound.add(copy)
+        compound.add_bond((particles[graft.anchor], host_particles[layer.sites[graft.sites[i]]]))
+    return added
+
+
+def _key(graft):
+    return graft.name, len(graft.template.names)
+
+
+def stitch(tiles, tile_x, tile_y):
+    """Join layers built tile by tile into one periodic layer.
+
+    Bonds of the surface that cross the periodic boundary of a tile are
+    reconnected to the neighbouring tile, as `mb.lib.recipes.TiledCompound`
+    does, and the particle and port indices of every tile are offset so that
+    the result matches a layer built on the tiled surface in one piece.
+    Grafts with the same name and number of particles are merged.
+
+    Parameters
+    ----------
+    tiles : list of Layer
+        One layer per tile, in ``itertools.product(range(tile_x), range(tile_y))``
+        order. Every tile must have the same surface.
+    tile_x, tile_y : int
+        Number of tiles in the x and y directions.
+
+    Returns
+    -------
+    layer : Layer
+    """
+    if len(tiles) != tile_x * tile_y:
+        raise ValueError('Expected {} tiles, got {}.'.format(tile_x * tile_y, len(tiles)))
+    surface = tiles[0].surface
+    period = tiles[0].box[:2]
+    n_surface = len(surface.names)
+    n_sites = len(tiles[0].sites)
+
+    a, b = np.divmod(np.arange(len(tiles)), tile_y)
+    shifts = np.column_stack((a * period[0], b * period[1], np.zeros(len(tiles))))
+
+    # Bonds that wrap around a single tile point to the image in the next tile.
+    delta = surface.xyz[surface.bonds[:, 1]] - surface.xyz[surface.bonds[:, 0]]
+    wrap = np.round(delta[:, :2] / period).astype(int)
+    partner = (((a[:, None] - wrap[None, :, 0]) % tile_x) * tile_y
+               + (b[:, None] - wrap[None, :, 1]) % tile_y)
+    bonds = np.stack((np.arange(len(tiles))[:, None] * n_surface + surface.bonds[None, :, 0],
+                      partner * n_surface + surface.bonds[None, :, 1]), axis=-1).reshape(-1, 2)
+
+    xyz = np.concatenate([tile.surface.xyz + shift for tile, shift in zip(tiles, shifts)])
+    stitched = Template(np.tile(surface.names, len(tiles)), np.tile(surface.elements, len(tiles)),
+                        xyz, bonds)
+    sites = np.concatenate([tile.sites + t * n_surface for t, tile in enumerate(tiles)])
+
+    grafts = []
+    for key in dict.fromkeys(_key(graft) for tile in tiles for graft in tile.grafts):
+        parts = [(t, graft) for t, tile in enumerate(tiles) for graft in tile.grafts if _key(graft) == key]
+        template, anchor = parts[0][1].template, parts[0][1].anchor
+        grafts.append(Graft(key[0], template,
+                            np.concatenate([graft.xyz + shifts[t] for t, graft in parts]),
+                            np.concatenate([graft.sites + t * n_sites for t, graft in parts]),
+                            anchor))
+
+    box = np.array([tile_x * period[0], tile_y * period[1], tiles[0].box[2]])
+    up = anchors = None
+    if tiles[0].up is not None:
+        up = np.concatenate([tile.up + shift for tile, shift in zip(tiles, shifts)])
+        anchors = np.concatenate([tile.anchors + shift for tile, shift in zip(tiles, shifts)])
+    return Layer(stitched, sites, grafts, box, up, anchors)
+
+
+Clashes = namedtuple('Clashes', ['grafts', 'copies', 'particles'])
+Clashes.__doc__ = """Overlapping particles of different grafted copies.
+
+Every field has shape (m, 2), one row per overlapping pair.
+
+Parameters
+----------
+grafts : np.ndarray
+    Index into ``layer.grafts`` of both particles.
+copies : np.ndarray
+    Index of the copy of that graft.
+particles : np.ndarray
+    Index of the particle in the graft's template.
+"""
+
+
+def _flatten(layer):
+    """Return the grafted positions of a layer as one array, and the owner of each."""
+    shapes = [graft.xyz.shape[:2] for graft in layer.grafts]
+    xyz = np.concatenate([graft.xyz.reshape(-1, 3) for graft in layer.grafts])
+    grafts = np.concatenate([np.full(k * n, g) for g, (k, n) in enumerate(shapes)])
+    copies = np.concatenate([np.repeat(np.arange(k), n) for k, n in shapes])
+    particles = np.concatenate([np.tile(np.arange(n), k) for k, n in shapes])
+    first = np.cumsum([0] + [k for k, _ in shapes[:-1]])
+    return xyz, grafts, copies, particles, first[grafts] + copies
+
+
+def layer_clashes(layer, cutoff=0.15, moved=None):
+    """Find grafted particles of different copies closer than `cutoff`.
+
+    The search uses a `CellList` that is periodic in x and y, so its cost
+    grows linearly with the number of grafted particles.
+
+    Parameters
+    ----------
+    layer : Layer
+    cutoff : float, optional, default=0.15
+        Smallest allowed distance in nm.
+    moved : tuple of (int, np.ndarray), optional, default=None
+        A graft index and some of its copies. Only overlaps involving these
+        copies are searched for.
+
+    Returns
+    -------
+    clashes : Clashes
+    """
+    xyz, grafts, copies, particles, molecules = _flatten(layer)
+    box = np.array([layer.box[0], layer.box[1], 0])
+    cells = CellList(xyz, cutoff, box=box)
+    if moved is None:
+        pairs = cells.query()
+    else:
+        query = np.flatnonzero((grafts == moved[0]) & np.isin(copies, moved[1]))
+        pairs = cells.query(xyz[query])
+        pairs[:, 0] = query[pairs[:, 0]]
+        pairs = np.unique(np.sort(pairs, axis=1), axis=0)
+    pairs = pairs[molecules[pairs[:, 0]] != molecules[pairs[:, 1]]]
+    return Clashes(grafts[pairs], copies[pairs], particles[pairs])
+
+
+def clash_counts(layer, clashes):
+    """Count the overlapping pairs each grafted copy takes part in.
+
+    Returns
+    -------
+    counts : list of np.ndarray
+        One array of shape (k,) per graft of the layer.
+    """
+    return [_counts(clashes, g, len(graft.sites)) for g, graft in enumerate(layer.grafts)]
+
+
+def _counts(clashes, graft, n_copies):
+    """Number of overlapping pairs of each copy of `graft`."""
+    return np.bincount(clashes.copies[clashes.grafts == graft], minlength=n_copies)
+
+
+def _offenders(clashes, graft):
+    """Copies of `graft` to move so that every overlap involving it is lifted."""
+    movable = clashes.grafts == graft
+    side = np.where(movable.all(axis=1), np.argmax(clashes.copies, axis=1), np.argmax(movable, axis=1))
+    rows = np.flatnonzero(movable.any(axis=1))
+    return np.unique(clashes.copies[rows, side[rows]])
+
+
+def resolve_clashes(layer, graft=0, cutoff=0.15, conformers=None, seed=None, max_iterations=50):
+    """Move grafted copies until no two copies overlap.
+
+    Only copies of ``layer.grafts[graft]`` are moved, and only those that
+    overlap: for every overlapping pair the copy of that graft is moved, the
+    later one when both are. A moved copy is spun by a random angle around
+    its bond to the surface, and, given `conformers`, first swapped for a
+    conformation drawn from them. Moves that leave a copy with more overlaps
+    than before are undone. The positions are changed in place.
+
+    Parameters
+    ----------
+    layer : Layer
+    graft : int, optional, default=0
+        Index of the graft whose copies may be moved.
+    cutoff : float, optional, default=0.15
+        Smallest allowed distance in nm, see `layer_clashes`.
+    conformers : np.ndarray, shape=(c, n, 3), optional, default=None
+        Conformations of the graft in the frame of its template, e.g. from
+        `ConformerLibrary.conformers`. Particles at the same position in
+        every conformation are used to place the new conformation where the
+        old one was.
+    seed : int, optional, default=None
+        Seed of the random angles and conformer draws.
+    max_iterations : int, optional, default=50
+        Number of rounds of moves.
+
+    Returns
+    -------
+    clashing : np.ndarray
+        Copies that still overlap after `max_iterations` rounds, empty when
+        every overlap was resolved.
+    """
+    rng = np.random.default_rng(seed)
+    target = layer.grafts[graft]
+    if conformers is not None:
+        conformers = np.asarray(conformers, dtype=float)
+        rigid = np.all(conformers == conformers[:1], axis=(0, 2))
+
+    clashes = layer_clashes(layer, cutoff)
+    clashing = _offenders(clashes, graft)
+    for _ in range(max_iterations):
+        if not len(clashing):
+            break
+        before = _counts(clashes, graft, len(target.sites))[clashing]
+        old = target.xyz[clashing]
+
+        xyz = old
+        if conformers is not None:
+            rotations, translations = fit_transform(conformers[0, rigid], xyz[:, rigid])
+            xyz = (conformers[rng.integers(len(conformers), size=len(clashing))]
+                   @ np.swapaxes(rotations, 1, 2) + translations[:, None, :])
+        anchors = xyz[:, target.anchor]
+        axes = anchors - layer.surface.xyz[layer.sites[target.sites[clashing]]]
+        rotations = rotation_matrix(rng.uniform(0, 2 * np.pi, len(clashing)), axes)
+        target.xyz[clashing] = (xyz - anchors[:, None]) @ np.swapaxes(rotations, 1, 2) + anchors[:, None]
+
+        # Moves that add overlaps are undone.
+        clashes = layer_clashes(layer, cutoff, moved=(graft, clashing))
+        worse = _counts(clashes, graft, len(target.sites))[clashing] > before
+        if worse.any():
+            target.xyz[clashing[worse]] = old[worse]
+            clashes = layer_clashes(layer, cutoff, moved=(graft, clashing))
+        clashing = _offenders(clashes, graft)
+    return clashing
+
+
+def layer_arrays(layer):
+    """Return the particles and bonds of a whole layer as one set of arrays.
+
+    Particles are in the order `PMPCLayer` adds them: the surface, then every
+    copy of each graft in turn. Bonds include the bonds of every copy and the
+    bond of each copy to its surface site.
+
+    Returns
+    -------
+    template : Template
+    residues : np.ndarray, shape=(n,), dtype=str
+        'tiled_surface' for surface particles, the graft name otherwise.
+    resids : np.ndarray, shape=(n,), dtype=int
+        One-based index of the surface or copy each particle belongs to.
+    """
+    surface = layer.surface
+    names, elements, xyz, bonds = [surface.names], [surface.elements], [surface.xyz], [surface.bonds]
+    residues, resids = [np.full(len(surface.names), 'tiled_surface')], [np.ones(len(surface.names), dtype=int)]
+    offset, resid = len(surface.names), 1
+    for graft in layer.grafts:
+        k, n, _ = graft.xyz.shape
+        starts = offset + n * np.arange(k)
+        names.append(np.tile(graft.template.names, k))
+        elements.append(np.tile(graft.template.elements, k))
+        xyz.append(graft.xyz.reshape(-1, 3))
+        bonds.append((starts[:, None, None] + graft.template.bonds[None]).reshape(-1, 2))
+        bonds.append(np.column_stack((starts + graft.anchor, layer.sites[graft.sites])))
+        residues.append(np.full(k * n, graft.name))
+        resids.append(np.repeat(resid + 1 + np.arange(k), n))
+        offset += k * n
+        resid += k
+    template = Template(np.concatenate(names), np.concatenate(elements), np.concatenate(xyz),
+                        np.concatenate(bonds).astype(int))
+    return template, np.concatenate(residues), np.concatenate(resids)
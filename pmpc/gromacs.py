@@ -0,0 +1,428 @@
+"""Streaming GROMACS topology and coordinate writers.
+
+`Compound.save('*.top')` converts the whole system to a ParmEd Structure
+and formats it in memory. The writers here take NumPy arrays, which may be
+memory-mapped, and format them a chunk of rows at a time, so the memory
+they use does not grow with the size of the system. The layout of the
+files follows the files ParmEd writes.
+
+`split_molecules` breaks a system-wide molecule type into its bonded
+fragments and merges identical ones, so that each species is written once
+and counted in [ molecules ].
+"""
+from collections import namedtuple
+import hashlib
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+
+
+KCAL_TO_KJ = 4.184
+
+DEFAULTS = (1, 2, 'yes', 0.5, 0.5)
+
+
+Interactions = namedtuple('Interactions', ['indices', 'funct', 'params'])
+Interactions.__new__.__defaults__ = (None,)
+Interactions.__doc__ = """Bonded interactions of one GROMACS function type.
+
+Parameters
+----------
+indices : np.ndarray, shape=(m, k), dtype=int
+    Zero-based indices of the atoms of each interaction in its molecule.
+funct : int
+    GROMACS function type.
+params : np.ndarray, shape=(m, p), optional, default=None
+    Parameters in GROMACS units. Without parameters, the force field
+    defaults apply.
+"""
+
+MoleculeType = namedtuple('MoleculeType', ['name', 'nrexcl', 'types', 'resids', 'residues', 'names',
+                                           'charges', 'masses', 'bonds', 'pairs', 'angles', 'dihedrals'])
+MoleculeType.__doc__ = """A GROMACS molecule type stored as arrays.
+
+Parameters
+----------
+name : str
+nrexcl : int
+types, residues, names : np.ndarray, shape=(n,), dtype=str
+    Atom type, residue name and atom name of each atom.
+resids : np.ndarray, shape=(n,), dtype=int
+    One-based residue number of each atom.
+charges, masses : np.ndarray, shape=(n,), dtype=float
+bonds, pairs, angles, dihedrals : list of Interactions
+    One section is written per entry.
+"""
+
+AtomType = namedtuple('AtomType', ['name', 'atomic_number', 'mass', 'charge', 'sigma', 'epsilon'])
+AtomType.__doc__ = """A non-bonded atom type, with sigma in nm and epsilon in kJ/mol."""
+
+
+_HEADERS = {
+    'bonds': ';    ai     aj funct         c0         c1         c2         c3\n',
+    'pairs': ';    ai     aj funct         c0         c1         c2         c3\n',
+    'angles': ';    ai     aj     ak funct         c0         c1         c2         c3\n',
+    'dihedrals': ';    ai     aj     ak     al funct         c0         c1         c2         c3'
+                 '         c4         c5\n',
+}
+
+_PARAMETERS = {
+    ('bonds', 1): ' %9.5f %10.6f',
+    ('angles', 1): ' %13.7f %10.6f',
+    ('angles', 5): ' %13.7f %10.6f %9.5f %10.6f',
+    ('dihedrals', 1): ' %12.7f %11.7f %2d',
+    ('dihedrals', 2): ' %12.7f %11.7f',
+    ('dihedrals', 4): ' %12.7f %11.7f %2d',
+    ('dihedrals', 9): ' %12.7f %11.7f %2d',
+    ('dihedrals', 3): ' %13.7f' * 6,
+}
+
+
+def _chunks(n, chunk):
+    for start in range(0, n, chunk):
+        yield slice(start, min(start + chunk, n))
+
+
+def write_section(top, section, interactions, chunk=100000):
+    """Write one bonded section, `chunk` rows at a time.
+
+    Parameters
+    ----------
+    top : file
+    section : str
+        'bonds', 'pairs', 'angles' or 'dihedrals'.
+    interactions : Interactions
+    chunk : int, optional, default=100000
+    """
+    indices = interactions.indices
+    width = indices.shape[1]
+    line = '%7d' + ' %6d' * (width - 1) + ' %5d'
+    if interactions.params is not None:
+        line += _PARAMETERS.get((section, interactions.funct), ' %12.7f' * interactions.params.shape[1])
+    line += '\n'
+
+    top.write('[ {} ]\n'.format(section))
+    top.write(_HEADERS[section])
+    for rows in _chunks(len(indices), chunk):
+        columns = [column.tolist() for column in (np.asarray(indices[rows]) + 1).T]
+        columns.append([interactions.funct] * len(columns[0]))
+        if interactions.params is not None:
+            columns.extend(column.tolist() for column in np.asarray(interactions.params[rows]).T)
+        top.writelines(line % row for row in zip(*columns))
+    top.write('\n')
+
+
+def write_atoms(top, molecule, chunk=100000):
+    """Write the [ atoms ] section of a molecule type, `chunk` atoms at a time."""
+    top.write('[ atoms ]\n')
+    top.write(';   nr       type  resnr residue  atom   cgnr    charge       mass  typeB    chargeB      massB\n')
+    line = '%5d %10s %6d %6s %6s %6d %10.8f %10.6f   ; qtot %.6f\n'
+    total = 0.0
+    for rows in _chunks(len(molecule.names), chunk):
+        number = np.arange(rows.start, rows.stop) + 1
+        charges = np.asarray(molecule.charges[rows], dtype=float)
+        qtot = total + np.cumsum(charges)
+        total = qtot[-1]
+        top.writelines(line % row for row in zip(
+            number.tolist(), np.asarray(molecule.types[rows]).tolist(), np.asarray(molecule.resids[rows]).tolist(),
+            np.asarray(molecule.residues[rows]).tolist(), np.asarray(molecule.names[rows]).tolist(),
+            number.tolist(), charges.tolist(), np.asarray(molecule.masses[rows]).tolist(), qtot.tolist()))
+    top.write('\n')
+
+
+def write_top(filename, atomtypes, moleculetypes, molecules, defaults=DEFAULTS, system='Generic title',
+              chunk=100000):
+    """Write a standalone GROMACS topology.
+
+    Parameters
+    ----------
+    filename : str
+    atomtypes : list of AtomType
+    moleculetypes : list of MoleculeType
+    molecules : list of tuple of (str, int)
+        Name and count of each block of molecules, in the order of the
+        coordinates.
+    defaults : tuple, optional, default=DEFAULTS
+        nbfunc, comb-rule, gen-pairs, fudgeLJ and fudgeQQ.
+    system : str, optional, default='Generic title'
+    chunk : int, optional, default=100000
+        Number of rows formatted at a time.
+    """
+    with open(filename, 'w') as top:
+        top.write(';\n;   File {} was generated by pmpc\n;\n\n'.format(filename))
+        top.write('[ defaults ]\n; nbfunc        comb-rule       gen-pairs       fudgeLJ fudgeQQ\n')
+        top.write('{:<16d}{:<16d}{:<16s}{:<13}{:<12}\n\n'.format(*defaults))
+
+        top.write('[ atomtypes ]\n; name    at.num    mass    charge ptype  sigma      epsilon\n')
+        for atomtype in atomtypes:
+            top.write('%-11s %5d %10.6f %11.8f  A %14.8g %14.8g\n' % atomtype)
+        top.write('\n\n')
+
+        for molecule in moleculetypes:
+            top.write('[ moleculetype ]\n; Name            nrexcl\n')
+            top.write('{:<10s}{:4d}\n\n'.format(molecule.name, molecule.nrexcl))
+            write_atoms(top, molecule, chunk=chunk)
+            for section in ('bonds', 'pairs', 'angles', 'dihedrals'):
+                for interactions in getattr(molecule, section):
+                    if len(interactions.indices):
+                        write_section(top, section, interactions, chunk=chunk)
+
+        top.write('[ system ]\n; Name\n{}\n\n'.format(system))
+        top.write('[ molecules ]\n; Compound       #mols\n')
+        for name, count in molecules:
+            top.write('{:<15s} {:6d}\n'.format(name, count))
+
+
+class GroWriter(object):
+    """Write a .gro file in pieces.
+
+    The number of atoms goes in the header, so it must be known up front.
+    Atoms and residues are numbered across calls to `write`.
+
+    Parameters
+    ----------
+    filename : str
+    n_atoms : int
+    box : array-like, shape=(3,)
+        Box lengths in nm, written when the writer is closed.
+    title : str, optional, default='pmpc'
+    """
+    def __init__(self, filename, n_atoms, box, title='pmpc'):
+        self.gro = open(filename, 'w')
+        self.n_atoms = n_atoms
+        self.box = box
+        self.atom = 0
+        self.residue = 0
+        self.gro.write('{}\n{}\n'.format(title, n_atoms))
+
+    def write(self, xyz, names, residues, resids, chunk=100000):
+        """Write atoms.
+
+        Parameters
+        ----------
+        xyz : np.ndarray, shape=(n, 3)
+            Positions in nm.
+        names, residues : np.ndarray, shape=(n,), dtype=str
+            Atom and residue names.
+        resids : np.ndarray, shape=(n,), dtype=int
+            Residue numbers of the atoms, counted from 1 within this call.
+        chunk : int, optional, default=100000
+        """
+        for rows in _chunks(len(xyz), chunk):
+            number = (np.arange(rows.start, rows.stop) + self.atom + 1) % 100000
+            resid = (np.asarray(resids[rows]) + self.residue) % 100000
+            x, y, z = np.asarray(xyz[rows], dtype=float).T.tolist()
+            self.gro.writelines('%5d%-5s%5s%5d%8.3f%8.3f%8.3f\n' % row for row in zip(
+                resid.tolist(), [name[:5] for name in np.asarray(residues[rows]).tolist()],
+                [name[:5] for name in np.asarray(names[rows]).tolist()], number.tolist(), x, y, z))
+        self.atom += len(xyz)
+        if len(xyz):
+            self.residue += int(np.max(resids))
+
+    def close(self):
+        if self.atom != self.n_atoms:
+            self.gro.close()
+            raise ValueError('Expected {} atoms, {} were written.'.format(self.n_atoms, self.atom))
+        self.gro.write('{:10.5f}{:10.5f}{:10.5f}\n'.format(*self.box))
+        self.gro.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.gro.close()
+
+
+def write_gro(filename, xyz, names, residues, resids, box, title='pmpc', chunk=100000):
+    """Write a .gro file from arrays, `chunk` atoms at a time.
+
+    See `GroWriter.write` for the arguments.
+    """
+    with GroWriter(filename, len(xyz), box, title=title) as gro:
+        gro.write(xyz, names, residues, resids, chunk=chunk)
+
+
+def from_parmed(structure, name='RES', nrexcl=3):
+    """Convert a ParmEd Structure to arrays for `write_top`.
+
+    Every atom goes in one molecule type, as when ParmEd writes a Compound
+    saved by mbuild. Harmonic bonds and angles, Urey-Bradley terms, periodic
+    and improper torsions, harmonic impropers, Ryckaert-Bellemans torsions
+    and 1-4 pairs are converted from ParmEd's units to GROMACS units. Angles
+    with a Urey-Bradley term on their outer atoms become function type 5,
+    and a Urey-Bradley term without such an angle raises a ValueError.
+
+    Parameters
+    ----------
+    structure : parmed.Structure
+    name : str, optional, default='RES'
+    nrexcl : int, optional, default=3
+
+    Returns
+    -------
+    atomtypes : list of AtomType
+    molecule : MoleculeType
+    """
+    atoms = structure.atoms
+    types = {}
+    for atom in atoms:
+        if atom.type not in types:
+            atom_type = atom.atom_type
+            types[atom.type] = AtomType(atom.type, atom.atomic_number, atom.mass, 0.0,
+                                        atom_type.sigma / 10, atom_type.epsilon * KCAL_TO_KJ)
+
+    def table(terms, n, params):
+        indices = np.array([[getattr(term, 'atom{}'.format(k + 1)).idx for k in range(n)] for term in terms],
+                           dtype=int).reshape(-1, n)
+        values = None
+        if params is not None:
+            values = np.array([params(term.type) for term in terms], dtype=float).reshape(len(terms), -1)
+        return indices, values
+
+    indices, params = table(structure.bonds, 2, lambda t: (t.req / 10, 2 * t.k * KCAL_TO_KJ * 100))
+    bonds = Interactions(indices, 1, params)
+    # GROMACS folds Urey-Bradley terms into the angle they span.
+    urey_bradleys = {frozenset((term.atom1.idx, term.atom2.idx)): term.type for term in structure.urey_bradleys}
+    plain = [a for a in structure.angles if frozenset((a.atom1.idx, a.atom3.idx)) not in urey_bradleys]
+    spanned = [a for a in structure.angles if frozenset((a.atom1.idx, a.atom3.idx)) in urey_bradleys]
+    if len(spanned) != len(urey_bradleys):
+        raise ValueError('{} Urey-Bradley terms do not span an angle.'.format(len(urey_bradleys) - len(spanned)))
+    angles = []
+    if plain or not spanned:
+        indices, params = table(plain, 3, lambda t: (t.theteq, 2 * t.k * KCAL_TO_KJ))
+        angles.append(Interactions(indices, 1, params))
+    if spanned:
+        indices, params = table(spanned, 3, lambda t: (t.theteq, 2 * t.k * KCAL_TO_KJ))
+        ub = np.array([(t.req / 10, 2 * t.k * KCAL_TO_KJ * 100)
+                       for t in (urey_bradleys[frozenset((a.atom1.idx, a.atom3.idx))] for a in spanned)])
+        angles.append(Interactions(indices, 5, np.column_stack((params, ub))))
+    pairs = Interactions(table(structure.adjusts, 2, None)[0], 1)
+
+    dihedrals = []
+    proper = [d for d in structure.dihedrals if not d.improper]
+    improper = [d for d in structure.dihedrals if d.improper]
+    for terms, funct in ((improper, 4), (proper, 9)):
+        if terms:
+            indices, params = table(terms, 4, lambda t: (t.phase, t.phi_k * KCAL_TO_KJ, t.per))
+            dihedrals.append(Interactions(indices, funct, params))
+    if structure.impropers:
+        # The central atom comes first, as GROMACS expects for function type 2.
+        indices, params = table(structure.impropers, 4, lambda t: (t.psi_eq, 2 * t.psi_k * KCAL_TO_KJ))
+        dihedrals.append(Interactions(indices, 2, params))
+    if structure.rb_torsions:
+        indices, params = table(structure.rb_torsions, 4,
+                                lambda t: np.array([t.c0, t.c1, t.c2, t.c3, t.c4, t.c5]) * KCAL_TO_KJ)
+        dihedrals.append(Interactions(indices, 3, params))
+
+    molecule = MoleculeType(name, nrexcl,
+                            np.array([atom.type for atom in atoms]),
+                            np.array([atom.residue.idx + 1 for atom in atoms]),
+                            np.array([atom.residue.name for atom in atoms]),
+                            np.array([atom.name for atom in atoms]),
+                            np.array([atom.charge for atom in atoms]),
+                            np.array([atom.mass for atom in atoms]),
+                            [bonds], [pairs], angles, dihedrals)
+    return list(types.values()), molecule
+
+
+def _components(molecule):
+    """Label the atoms of a molecule type by the bonded fragment they belong to."""
+    n = len(molecule.names)
+    bonds = np.concatenate([np.asarray(bonded.indices).reshape(-1, 2) for bonded in molecule.bonds]
+                           + [np.empty((0, 2), dtype=int)])
+    graph = sparse.coo_matrix((np.ones(len(bonds)), (bonds[:, 0], bonds[:, 1])), shape=(n, n))
+    return csgraph.connected_components(graph, directed=False)[1]
+
+
+def split_molecules(molecule):
+    """Split a molecule type into its bonded fragments and merge identical ones.
+
+    Fragments are identical when their atoms, in order, have the same types,
+    names, residue names, charges and masses, and when their bonded terms
+    join the same atoms with the same parameters. Copies stamped from one
+    template, such as the waters and ions of `solvate` or repeated layers,
+    therefore share one molecule type. Atoms joined by a bond always stay in
+    one fragment, so brushes grafted to a surface remain part of it.
+
+    Parameters
+    ----------
+    molecule : MoleculeType
+        E.g. the whole system from `from_parmed`.
+
+    Returns
+    -------
+    moleculetypes : list of MoleculeType
+        One per distinct fragment, named after the residue of its first
+        atom.
+    molecules : list of tuple of (str, int)
+        Name and number of copies of each molecule type, for `write_top`.
+    order : np.ndarray, shape=(n,)
+        Old index of each atom in the new order, in which all copies of a
+        molecule type follow each other. Coordinates must be reordered with
+        it, e.g. ``xyz[order]``.
+    """
+    labels = _components(molecule)
+    n_components = labels.max() + 1 if len(labels) else 0
+    atoms = np.argsort(labels, kind='stable')
+    sizes = np.bincount(labels, minlength=n_components)
+    starts = np.cumsum(sizes) - sizes
+    rank = np.empty(len(labels), dtype=int)
+    rank[atoms] = np.arange(len(labels)) - starts[labels[atoms]]
+
+    # Rows of every bonded term, grouped by fragment.
+    sections = []
+    for section in ('bonds', 'pairs', 'angles', 'dihedrals'):
+        for interactions in getattr(molecule, section):
+            indices = np.asarray(interactions.indices)
+            owner = labels[indices[:, 0]] if len(indices) else np.empty(0, dtype=int)
+            rows = np.argsort(owner, kind='stable')
+            counts = np.bincount(owner, minlength=n_components)
+            sections.append((section, interactions, indices, rows, np.cumsum(counts) - counts, counts))
+
+    groups = {}
+    for c in range(n_components):
+        members = atoms[starts[c]:starts[c] + sizes[c]]
+        digest = hashlib.sha1()
+        for column in (molecule.types, molecule.names, molecule.residues):
+            digest.update('\0'.join(np.asarray(column)[members].tolist()).encode())
+        for column in (molecule.charges, molecule.masses):
+            digest.update(np.asarray(column, dtype=float)[members].tobytes())
+        for section, interactions, indices, rows, first, counts in sections:
+            own = rows[first[c]:first[c] + counts[c]]
+            digest.update('{}{}'.format(section, interactions.funct).encode())
+            digest.update(rank[indices[own]].tobytes())
+            if interactions.params is not None:
+                digest.update(np.asarray(interactions.params, dtype=float)[own].tobytes())
+        groups.setdefault(digest.digest(), []).append(c)
+
+    moleculetypes, molecules, order, names = [], [], [], set()
+    for components in groups.values():
+        c = components[0]
+        members = atoms[starts[c]:starts[c] + sizes[c]]
+        name = base = str(np.asarray(molecule.residues)[members[0]])
+        suffix = 1
+        while name in names:
+            suffix += 1
+            name = '{}{}'.format(base, suffix)
+        names.add(name)
+
+        terms = {'bonds': [], 'pairs': [], 'angles': [], 'dihedrals': []}
+        for section, interactions, indices, rows, first, counts in sections:
+            own = rows[first[c]:first[c] + counts[c]]
+            params = None if interactions.params is None else np.asarray(interactions.params)[own]
+            terms[section].append(Interactions(rank[indices[own]], interactions.funct, params))
+        resids = np.unique(np.asarray(molecule.resids)[members], return_inverse=True)[1] + 1
+        moleculetypes.append(MoleculeType(name, molecule.nrexcl, np.asarray(molecule.types)[members], resids,
+                                          np.asarray(molecule.residues)[members],
+                                          np.asarray(molecule.names)[members],
+                                          np.asarray(molecule.charges)[members],
+                                          np.asarray(molecule.masses)[members], **terms))
+        molecules.append((name, len(components)))
+        order.extend(atoms[starts[k]:starts[k] + sizes[k]] for k in components)
+
+    order = np.concatenate(order) if order else np.empty(0, dtype=int)
+    return moleculetypes, molecules, order
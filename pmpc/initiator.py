@@ -2,17 +2,18 @@ import numpy as np
 
 import mbuild as mb
 
+from pmpc.template import load_template, stamp
+
 
 class Initiator(mb.Compound):
     def __init__(self):
         super(Initiator, self).__init__()
 
-        # Look for data file in same directory as this python module.
-        mb.load('initiator.pdb', compound=self, relative_to_module=self.__module__)
-
-        # Transform the coordinate system such that the two carbon atoms
-        # that are part of the backbone are on the y axis, C_1 at the origin.
-        mb.y_axis_transform(self, new_origin=self[0], point_on_y_axis=self[21])
+        # Look for data file in same directory as this python module. The file
+        # is parsed once per process and the coordinate system is transformed
+        # such that the two carbon atoms that are part of the backbone are on
+        # the y axis, C_1 at the origin.
+        stamp(self, load_template('initiator.pdb', __name__, 0, 21))
 
         # Add bottom port
         self.add(mb.Port(anchor=self[0]), 'down')
@@ -0,0 +1,227 @@
+"""Lazy description of a pMPC brush layer.
+
+`PMPCLayerSpec` records how a layer would be built without building it.
+Sizes and composition follow from the cached surface tile, brush and chain
+templates, and coordinates are only produced when the layer is saved:
+``.gro`` and ``.xyz`` files are written one tile at a time, every other
+format goes through a full `PMPCLayer`.
+"""
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import os
+
+import numpy as np
+from numpy import pi
+
+import mbuild as mb
+from mbuild.lib.surfaces import Betacristobalite
+from pmpc.chain import chain_template
+from pmpc.dispersity import chain_lengths
+from pmpc.gromacs import GroWriter
+from pmpc.pmpc_brush_layer import PMPCLayer, _brush, build_tile, tile_seeds
+from pmpc.template import template_from_compound
+
+
+def _window(executor, arguments, size):
+    """Yield the tiles built from `arguments` in order, with at most `size` pending at a time."""
+    pending = deque()
+    for tile in arguments:
+        if len(pending) == size:
+            yield pending.popleft().result()
+        pending.append(executor.submit(build_tile, *tile))
+    while pending:
+        yield pending.popleft().result()
+
+
+@lru_cache(maxsize=None)
+def _tile():
+    """Return the template, port count and box lengths of one surface tile."""
+    tile = mb.lib.recipes.TiledCompound(Betacristobalite(), n_tiles=(1, 1, 1))
+    return template_from_compound(tile), len(tile.available_ports()), np.asarray(tile.box.lengths)
+
+
+@lru_cache(maxsize=None)
+def _brush_counts(chain_length, alpha):
+    """Return the particle count, bond count and element counts of a brush.
+
+    Only the brush of length 1 is built. Longer brushes differ from it by
+    their chain alone, whose arrays come from `chain_template`.
+    """
+    head = template_from_compound(_brush(1, alpha))
+    short = chain_template(1, alpha)
+    chain = chain_template(chain_length, alpha)
+    n_particles = len(head.names) - len(short.names) + len(chain.names)
+    n_bonds = len(head.bonds) - len(short.bonds) + len(chain.bonds)
+    elements = Counter(head.elements) - Counter(short.elements) + Counter(chain.elements)
+    return n_particles, n_bonds, elements
+
+
+class PMPCLayerSpec(object):
+    """A `PMPCLayer` that is described but not built.
+
+    The layer is laid out like ``PMPCLayer(..., processes=...)``: its
+    `n_chains` brushes are spread as evenly as possible over the surface
+    tiles, each tile with its own random pattern drawn from `seed`. Chain
+    lengths are drawn when the spec is created, so that the counts below and
+    the saved layer agree.
+
+    Parameters
+    ----------
+    n_chains : int
+        Number of brushes.
+    tile_x, tile_y : int, optional, default=1
+        Number of surface tiles in the x and y directions.
+    chain_length : int, sequence of int or distribution, optional, default=4
+        Chain lengths, see `chain_lengths`.
+    alpha : float, optional, default=pi/4
+        Passed on to `Brush`.
+    seed : int, optional, default=None
+        Seed of the layer.
+    conformers : str, optional, default=None
+        Filename of a `ConformerLibrary` to draw brush conformations from.
+    forcefield : str, optional, default=None
+        Force field key of the conformations.
+    processes : int, optional, default=None
+        Number of worker processes used to build tiles. Tiles are built in
+        this process by default. At most `processes` tiles are built ahead
+        of the one being written.
+    """
+    def __init__(self, n_chains, tile_x=1, tile_y=1, chain_length=4, alpha=pi / 4, seed=None,
+                 conformers=None, forcefield=None, processes=None):
+        self.n_chains = n_chains
+        self.tile_x = tile_x
+        self.tile_y = tile_y
+        self.alpha = alpha
+        self.seed = seed
+        self.conformers = conformers
+        self.forcefield = forcefield
+        self.processes = processes
+        self.chain_lengths = chain_lengths(chain_length, n_chains, seed)
+
+        if n_chains > self.n_ports:
+            raise ValueError('Not enough ports for pattern.')
+        counts = np.full(self.n_tiles, n_chains // self.n_tiles)
+        counts[:n_chains % self.n_tiles] += 1
+        self.tile_counts = counts
+
+    @property
+    def n_tiles(self):
+        return self.tile_x * self.tile_y
+
+    @property
+    def n_ports(self):
+        return self.n_tiles * _tile()[1]
+
+    @property
+    def n_backfill(self):
+        return self.n_ports - self.n_chains
+
+    @property
+    def box(self):
+        """Box lengths of the layer in nm."""
+        return _tile()[2] * np.array([self.tile_x, self.tile_y, 1])
+
+    def _brushes(self):
+        lengths, counts = np.unique(self.chain_lengths, return_counts=True)
+        return [(_brush_counts(n, self.alpha), count) for n, count in zip(lengths.tolist(), counts)]
+
+    @property
+    def n_particles(self):
+        surface = len(_tile()[0].names) * self.n_tiles
+        return surface + sum(n * count for (n, _, _), count in self._brushes()) + self.n_backfill
+
+    @property
+    def n_bonds(self):
+        """Bonds of the surface, of the brushes, and between them and the surface."""
+        surface = len(_tile()[0].bonds) * self.n_tiles
+        return surface + sum((n + 1) * count for (_, n, _), count in self._brushes()) + self.n_backfill
+
+    @property
+    def composition(self):
+        """Number of particles of each element, keyed by symbol."""
+        composition = Counter()
+        for element, count in Counter(_tile()[0].elements).items():
+            composition[element] += count * self.n_tiles
+        for (_, _, elements), count in self._brushes():
+            for element, n in elements.items():
+                composition[element] += n * count
+        composition['H'] += self.n_backfill
+        return dict(composition)
+
+    def tiles(self):
+        """Build the layer one tile at a time.
+
+        Yields
+        ------
+        shift : np.ndarray, shape=(3,)
+            Offset of the tile in the layer.
+        layer : Layer
+            The tile, in its own frame.
+        """
+        seeds = tile_seeds(self.seed, self.n_tiles)
+        lengths = np.split(self.chain_lengths, np.cumsum(self.tile_counts)[:-1])
+        arguments = list(zip(self.tile_counts.tolist(), seeds, lengths, [self.alpha] * self.n_tiles,
+                             [self.conformers] * self.n_tiles, [self.forcefield] * self.n_tiles))
+        period = _tile()[2]
+        if self.processes is None:
+            tiles = (build_tile(*tile) for tile in arguments)
+        else:
+            executor = ProcessPoolExecutor(max_workers=self.processes)
+            tiles = _window(executor, arguments, self.processes)
+        try:
+            for t, layer in enumerate(tiles):
+                a, b = divmod(t, self.tile_y)
+                yield np.array([a * period[0], b * period[1], 0]), layer
+        finally:
+            if self.processes is not None:
+                executor.shutdown()
+
+    def build(self):
+        """Build the whole layer as a `PMPCLayer`."""
+        return PMPCLayer(mb.Random2DPattern(self.n_chains, seed=self.seed), tile_x=self.tile_x,
+                         tile_y=self.tile_y, chain_length=self.chain_lengths, alpha=self.alpha,
+                         processes=self.processes or 1, seed=self.seed, conformers=self.conformers,
+                         forcefield=self.forcefield)
+
+    def save(self, filename, **kwargs):
+        """Write the layer to a file.
+
+        ``.gro`` and ``.xyz`` files are written tile by tile, with the
+        surface and the grafts of each tile in turn, so that only one tile is
+        held in memory, plus at most `processes` tiles being built ahead of
+        it. Other formats are written by ``build().save``, with
+        extra keyword arguments passed on.
+        """
+        extension = os.path.splitext(filename)[1].lower()
+        if extension == '.gro':
+            _write_gro(filename, self)
+        elif extension == '.xyz':
+            _write_xyz(filename, self)
+        else:
+            self.build().save(filename, **kwargs)
+
+
+def _records(spec):
+    """Yield the residue name, atom names, elements and positions of each residue."""
+    for shift, layer in spec.tiles():
+        surface = layer.surface
+        yield 'tiled', surface.names, surface.elements, surface.xyz + shift
+        for graft in layer.grafts:
+            for xyz in graft.xyz:
+                yield graft.name, graft.template.names, graft.template.elements, xyz + shift
+
+
+def _write_gro(filename, spec):
+    with GroWriter(filename, spec.n_particles, spec.box, title='PMPCLayer') as gro:
+        for name, names, _, xyz in _records(spec):
+            gro.write(xyz, names, np.full(len(names), name), np.ones(len(names), dtype=int))
+
+
+def _write_xyz(filename, spec):
+    with open(filename, 'w') as xyz_file:
+        xyz_file.write('{}\nPMPCLayer\n'.format(spec.n_particles))
+        for _, names, elements, xyz in _records(spec):
+            labels = np.where(elements != '', elements, names)
+            xyz_file.writelines('{} {:.3f} {:.3f} {:.3f}\n'.format(label, *pos * 10)
+                                for label, pos in zip(labels, xyz))
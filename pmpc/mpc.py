@@ -1,25 +1,30 @@
+from functools import lru_cache
+
 import mbuild as mb
 
+from pmpc.template import load_template, rotation_matrix, stamp
+
+
+@lru_cache(maxsize=None)
+def _positions(alpha):
+    """Positions of the monomer rotated by `alpha` around the z axis."""
+    template = load_template('mpc.pdb', __name__, 37, 1)
+    xyz = template.xyz @ rotation_matrix(alpha, [0, 0, 1]).T
+    xyz.setflags(write=False)
+    return xyz
+
 
 class MPC(mb.Compound):
     """A 2-(methacryloloxy) ethyl phosophorylcholine monomer."""
     def __init__(self, alpha=0):
         super(MPC, self).__init__()
 
-        # Look for data file in same directory as this python module.
-        mb.load('mpc.pdb', compound=self, relative_to_module=self.__module__)
-
-        # Transform the coordinate system of mpc such that the two carbon atoms
-        # that are part of the backbone are on the y axis, c_backbone at the origin.
-        C_top = self[37]
-        # this can be achieved with the following alternative syntax:
-        # C_top = self.labels["atom[37]"]
-        # C_top = self.labels["atom"][37]
-        C_bottom = self[1]
-
-        mb.y_axis_transform(self, new_origin=C_top, point_on_y_axis=C_bottom)
-
-        self.rotate(alpha, around=[0,0,1])
+        # Look for data file in same directory as this python module. The file
+        # is parsed once per process and the coordinate system of mpc is
+        # transformed such that the two carbon atoms that are part of the
+        # backbone are on the y axis, c_backbone (atom 37) at the origin.
+        template = load_template('mpc.pdb', __name__, 37, 1)
+        stamp(self, template, xyz=_positions(alpha))
 
         # # Add top port.
         # self.add(mb.Port(anchor=C_top), label='up')
@@ -1,17 +1,372 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
 from numpy import pi
 
 import mbuild as mb
 from mbuild.lib.atoms import H
 from mbuild.lib.surfaces import Betacristobalite
 from pmpc.brush import Brush
+from pmpc.conformers import ConformerLibrary
+from pmpc.dispersity import chain_lengths
+from pmpc.chain import repeat_unit
+from pmpc.graft import attach, attach_graft, graft, graft_layer, resolve_clashes, stitch
+from pmpc.template import stamp
+
+
+@lru_cache(maxsize=None)
+def _brush(chain_length, alpha):
+    return Brush(chain_length=chain_length, alpha=alpha)
+
+
+def _graft_length(graft, alpha):
+    """Chain length of the brushes of a graft, or None for other grafts."""
+    if graft.template.parts is None:
+        return None
+    unit = repeat_unit(alpha)
+    n_chain = np.count_nonzero(graft.template.parts == 'pmpc')
+    return (n_chain - len(unit.extras.names)) // len(unit.monomer.names)
+
+
+def tile_seeds(seed, n_tiles):
+    """Derive one reproducible seed per tile from a single seed.
+
+    Parameters
+    ----------
+    seed : int or None
+        Seed of the whole layer. None draws fresh entropy.
+    n_tiles : int
+
+    Returns
+    -------
+    seeds : list of int
+        Positive seeds, as `mb.Random2DPattern` ignores a seed of 0.
+    """
+    children = np.random.SeedSequence(seed).spawn(n_tiles)
+    return [int(child.generate_state(1)[0] >> 1) + 1 for child in children]
+
+
+def _library(library):
+    """Open a library given as a ConformerLibrary or a filename."""
+    if library is None or isinstance(library, ConformerLibrary):
+        return library
+    return ConformerLibrary(library)
+
+
+def _conformers(library, lengths, alpha, forcefield, seed):
+    """Draw conformations for each chain length from a library, or None without one."""
+    if library is None:
+        return None
+    library = _library(library)
+    unique, counts = np.unique(lengths, return_counts=True)
+    return [library.sample(n, count, forcefield=forcefield, seed=seed, alpha=alpha)
+            for n, count in zip(unique, counts)]
+
+
+def _graft(host, pattern, lengths, alpha, conformers, forcefield, seed):
+    """Graft one brush per pattern point, built once per distinct chain length."""
+    unique, groups = np.unique(lengths, return_inverse=True)
+    return graft_layer(host, pattern, [_brush(n, alpha) for n in unique.tolist()], backfill=H(),
+                       parts=['silane', 'initiator', 'pmpc'],
+                       conformers=_conformers(conformers, lengths, alpha, forcefield, seed), groups=groups)
+
+
+def build_tile(n_chains, seed, chain_length=4, alpha=pi / 4, conformers=None, forcefield=None):
+    """Graft `n_chains` brushes at random on a single surface tile.
+
+    Parameters
+    ----------
+    n_chains : int
+        Number of brushes on the tile.
+    seed : int
+        Seed of the tile's `mb.Random2DPattern` and conformer draws.
+    chain_length : int, sequence of int or distribution, optional, default=4
+        Chain lengths, see `chain_lengths`.
+    alpha : float, optional, default=pi/4
+        Passed on to `Brush`.
+    conformers : str, optional, default=None
+        Filename of a `ConformerLibrary` to draw brush conformations from.
+    forcefield : str, optional, default=None
+        Force field key of the conformations.
+
+    Returns
+    -------
+    layer : Layer
+    """
+    tile = mb.lib.recipes.TiledCompound(Betacristobalite(), n_tiles=(1, 1, 1))
+    pattern = mb.Random2DPattern(n_chains, seed=seed)
+    return _graft(tile, pattern, chain_lengths(chain_length, n_chains, seed), alpha,
+                  conformers, forcefield, seed)
+
+
+def build_tiles(n_chains, tile_x=1, tile_y=1, chain_length=4, alpha=pi / 4, seed=None, processes=None,
+                conformers=None, forcefield=None):
+    """Build a layer tile by tile in a process pool.
+
+    The chains are spread as evenly as possible over the tiles, each tile
+    gets its own `mb.Random2DPattern` seeded from `tile_seeds`, and the tiles
+    are joined with `stitch`. The same `seed` always yields the same layer,
+    whatever the number of processes.
+
+    Parameters
+    ----------
+    n_chains : int
+        Number of brushes on the whole layer.
+    tile_x, tile_y : int, optional, default=1
+        Number of surface tiles in the x and y directions.
+    chain_length : int, sequence of int or distribution, optional, default=4
+        Chain lengths of the whole layer, see `chain_lengths`. Lengths drawn
+        from a distribution use `seed`.
+    alpha : float, optional, default=pi/4
+        Passed on to `Brush`.
+    seed : int, optional, default=None
+        Seed of the whole layer.
+    processes : int, optional, default=None
+        Number of worker processes, see `ProcessPoolExecutor`.
+    conformers : str, optional, default=None
+        Filename of a `ConformerLibrary` to draw brush conformations from.
+    forcefield : str, optional, default=None
+        Force field key of the conformations.
+
+    Returns
+    -------
+    layer : Layer
+    """
+    n_tiles = tile_x * tile_y
+    counts = np.full(n_tiles, n_chains // n_tiles)
+    counts[:n_chains % n_tiles] += 1
+    seeds = tile_seeds(seed, n_tiles)
+    lengths = np.split(chain_lengths(chain_length, n_chains, seed), np.cumsum(counts)[:-1])
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        tiles = list(executor.map(build_tile, counts.tolist(), seeds, lengths,
+                                  [alpha] * n_tiles, [conformers] * n_tiles, [forcefield] * n_tiles))
+    return stitch(tiles, tile_x, tile_y)
 
 
-class PMPCLayer(mb.lib.recipes.Monolayer):
-    """Create a layer of grafted pMPC brushes on a beta-cristobalite surface."""
-    def __init__(self, pattern, tile_x=1, tile_y=1, chain_length=4, alpha=pi / 4):
+class PMPCLayer(mb.Compound):
+    """Create a layer of grafted pMPC brushes on a beta-cristobalite surface.
+
+    The layer has the same contents as `mb.lib.recipes.Monolayer` built from
+    the same surface, brush, hydrogen backfill and pattern, but every brush
+    and backfill is placed in one batch by `graft_layer` instead of one
+    `force_overlap` per port. The grafted arrays are kept in `layer`.
+
+    When `processes` is given, the surface is instead built tile by tile in
+    a process pool with `build_tiles`: `len(pattern)` brushes are spread over
+    the tiles at random positions drawn from `seed`. Only a
+    `mb.Random2DPattern` can be built this way, since its points are redrawn
+    per tile; any other pattern raises a ValueError.
+
+    `chain_length` is either one length for every brush, one length per
+    point of `pattern`, or a distribution such as `SchulzZimm` or `Poisson`
+    that lengths are drawn from with `seed`. One `Brush` is built per
+    distinct length and all its copies are placed together, so the cost of
+    building brushes grows with the number of distinct lengths only. The
+    length of every brush is kept in `chain_lengths`.
+
+    With `conformers`, a `ConformerLibrary` or its filename, every brush is
+    given a conformation drawn at random from the library entry for its
+    chain length and `forcefield` instead of the straight `Brush` geometry.
+
+    With `clash_cutoff`, brushes that come closer than `clash_cutoff` nm to
+    another brush or backfill are moved with `resolve_clashes` before any
+    Compound is built: only the offending brushes are spun around their bond
+    to the surface, and given a new conformation when `conformers` is given.
+    The brushes still overlapping afterwards are kept in `clashing`, a dict
+    of copy indices by chain length.
+
+    Brushes can be added to and removed from a built layer with
+    `add_brushes` and `remove_brushes`, which swap them with the hydrogen
+    backfill at the same sites and leave the rest of the layer untouched.
+    New brushes go through `resolve_clashes` like the first ones when the
+    layer was built with `clash_cutoff`. The chain length at every port is
+    kept in `site_lengths`, 0 where the port is backfilled, and after either
+    call `chain_lengths` lists the brushes in port order.
+    """
+    def __init__(self, pattern, tile_x=1, tile_y=1, chain_length=4, alpha=pi / 4,
+                 processes=None, seed=None, conformers=None, forcefield=None, clash_cutoff=None):
+        super(PMPCLayer, self).__init__()
+        # The surface is periodic in x and y, as `mb.lib.recipes.Monolayer` sets it.
+        self.periodicity = (True, True, False)
+        self.chain_lengths = chain_lengths(chain_length, len(pattern), seed)
+        self.clashing = None
+        self.alpha = alpha
+        self._options = (conformers, forcefield, clash_cutoff)
+
+        if processes is not None:
+            if not isinstance(pattern, mb.Random2DPattern):
+                raise ValueError('A {} cannot be built with processes, which draw random points per tile. '
+                                 'Use a Random2DPattern or processes=None.'.format(type(pattern).__name__))
+            if isinstance(conformers, ConformerLibrary):
+                conformers = conformers.filename
+            self.layer = build_tiles(len(pattern), tile_x=tile_x, tile_y=tile_y,
+                                     chain_length=self.chain_lengths, alpha=alpha,
+                                     seed=seed, processes=processes,
+                                     conformers=conformers, forcefield=forcefield)
+            self._resolve(clash_cutoff, conformers, alpha, forcefield, seed)
+            tiled_surface = mb.Compound(name='tiled_surface')
+            particles = stamp(tiled_surface, self.layer.surface)
+            tiled_surface.box = mb.Box(lengths=self.layer.box)
+            self.add(tiled_surface, label='tiled_surface')
+            self._host = particles
+            self._copies = attach(self, particles, self.layer)
+            self._index_lengths()
+            return
+
         surface = Betacristobalite()
-        brush = Brush(chain_length=chain_length, alpha=alpha)
-        hydrogen = H()
-        super(PMPCLayer, self).__init__(surface, brush, backfill=hydrogen,
-                                        pattern=pattern, tile_x=tile_x,
-                                        tile_y=tile_y)
+        tiled_surface = mb.lib.recipes.TiledCompound(surface, n_tiles=(tile_x, tile_y, 1))
+        self.add(tiled_surface, label='tiled_surface')
+
+        ports = tiled_surface.available_ports()
+        self.layer = _graft(tiled_surface, pattern, self.chain_lengths, alpha, conformers, forcefield, seed)
+        self._resolve(clash_cutoff, conformers, alpha, forcefield, seed)
+        self._host = list(tiled_surface.particles())
+        self._copies = attach(self, self._host, self.layer)
+        for grafted in self.layer.grafts:
+            for site in grafted.sites:
+                ports[site].anchor.parent.remove(ports[site])
+        self._index_lengths()
+
+    def _resolve(self, clash_cutoff, conformers, alpha, forcefield, seed):
+        if clash_cutoff is None:
+            return
+        library = _library(conformers)
+        self.clashing = {}
+        for g, n in self._brush_grafts():
+            pool = None if library is None else library.conformers(n, forcefield, alpha)
+            self.clashing[n] = resolve_clashes(self.layer, graft=g, cutoff=clash_cutoff,
+                                               conformers=pool, seed=seed)
+
+    def _backfill(self):
+        return next(g for g, grafted in enumerate(self.layer.grafts) if grafted.name == 'H')
+
+    def _replace(self, g, keep=None, new=None):
+        """Drop copies of graft `g` not in `keep`, then append the copies of `new`."""
+        grafted = self.layer.grafts[g]
+        if keep is not None:
+            for i in np.setdiff1d(np.arange(len(grafted.sites)), keep):
+                self.remove(self._copies[g][i])
+            self._copies[g] = [self._copies[g][i] for i in keep]
+            grafted = grafted._replace(xyz=grafted.xyz[keep], sites=grafted.sites[keep])
+            n = _graft_length(grafted, self.alpha)
+            if self.clashing is not None and n in self.clashing:
+                self.clashing[n] = np.searchsorted(keep, np.intersect1d(self.clashing[n], keep))
+        if new is not None:
+            self._copies[g] += attach_graft(self, self._host, self.layer, new)
+            grafted = grafted._replace(xyz=np.concatenate((grafted.xyz, new.xyz)),
+                                       sites=np.concatenate((grafted.sites, new.sites)))
+        self.layer.grafts[g] = grafted
+
+    def _brush_grafts(self):
+        """Yield the index and chain length of every brush graft."""
+        for g, grafted in enumerate(self.layer.grafts):
+            n = _graft_length(grafted, self.alpha)
+            if n is not None:
+                yield g, n
+
+    def _index_lengths(self):
+        self.site_lengths = np.zeros(len(self.layer.sites), dtype=int)
+        for g, n in self._brush_grafts():
+            self.site_lengths[self.layer.grafts[g].sites] = n
+
+    def _set_lengths(self, sites, lengths):
+        self.site_lengths[sites] = lengths
+        self.chain_lengths = self.site_lengths[self.site_lengths > 0]
+
+    def add_brushes(self, n=None, sites=None, chain_length=4, seed=None):
+        """Graft brushes onto sites held by the hydrogen backfill.
+
+        Parameters
+        ----------
+        n : int, optional, default=None
+            Number of brushes to add at random backfilled sites.
+        sites : array-like of int, optional, default=None
+            Ports to graft onto instead, see ``layer.sites``.
+        chain_length : int, sequence of int or distribution, optional, default=4
+            Lengths of the new brushes, see `chain_lengths`.
+        seed : int, optional, default=None
+            Seed of the site choice, lengths and conformer draws.
+
+        Returns
+        -------
+        sites : np.ndarray
+            Ports of the new brushes.
+
+        Notes
+        -----
+        When the layer was built with `clash_cutoff`, only the new brushes
+        are moved with `resolve_clashes`, and those still overlapping are
+        added to `clashing`.
+        """
+        b = self._backfill()
+        free = self.layer.grafts[b].sites
+        if sites is None:
+            if n is None or n > len(free):
+                raise ValueError('Cannot add {} brushes to {} free sites.'.format(n, len(free)))
+            sites = np.random.default_rng(seed).choice(free, size=n, replace=False)
+        sites = np.asarray(sites, dtype=int)
+        if not np.isin(sites, free).all():
+            raise ValueError('Sites {} are not free.'.format(np.setdiff1d(sites, free).tolist()))
+        lengths = chain_lengths(chain_length, len(sites), seed)
+
+        self._replace(b, keep=np.flatnonzero(~np.isin(free, sites)))
+        conformers, forcefield, clash_cutoff = self._options
+        library = _library(conformers)
+        for length in np.unique(lengths).tolist():
+            chosen = sites[lengths == length]
+            xyz = _conformers(library, np.full(len(chosen), length), self.alpha, forcefield, seed)
+            new = graft(_brush(length, self.alpha), 'down', chosen, self.layer.up, self.layer.anchors,
+                        parts=['silane', 'initiator', 'pmpc'], xyz=None if xyz is None else xyz[0])
+            if clash_cutoff is not None:
+                # The new copies are resolved as a graft of their own, so no
+                # brush that already has a Compound is moved.
+                pool = None if library is None else library.conformers(length, forcefield, self.alpha)
+                clashing = resolve_clashes(self.layer._replace(grafts=[new] + self.layer.grafts),
+                                           cutoff=clash_cutoff, conformers=pool, seed=seed)
+            g = next((g for g, n in self._brush_grafts() if n == length), None)
+            if g is None:
+                g = b
+                b += 1
+                self.layer.grafts.insert(g, new._replace(xyz=new.xyz[:0], sites=new.sites[:0]))
+                self._copies.insert(g, [])
+            if clash_cutoff is not None:
+                offset = len(self.layer.grafts[g].sites)
+                self.clashing[length] = np.union1d(self.clashing.get(length, []), clashing + offset).astype(int)
+            self._replace(g, new=new)
+        self._set_lengths(sites, lengths)
+        return sites
+
+    def remove_brushes(self, n=None, sites=None, seed=None):
+        """Replace brushes with hydrogen backfill.
+
+        Parameters
+        ----------
+        n : int, optional, default=None
+            Number of brushes to remove at random.
+        sites : array-like of int, optional, default=None
+            Ports of the brushes to remove instead.
+        seed : int, optional, default=None
+            Seed of the choice of brushes.
+
+        Returns
+        -------
+        sites : np.ndarray
+            Ports that were freed.
+        """
+        b = self._backfill()
+        grafted = np.concatenate([self.layer.grafts[g].sites for g, _ in self._brush_grafts()])
+        if sites is None:
+            if n is None or n > len(grafted):
+                raise ValueError('Cannot remove {} of {} brushes.'.format(n, len(grafted)))
+            sites = np.random.default_rng(seed).choice(grafted, size=n, replace=False)
+        sites = np.asarray(sites, dtype=int)
+        if not np.isin(sites, grafted).all():
+            raise ValueError('Sites {} hold no brush.'.format(np.setdiff1d(sites, grafted).tolist()))
+
+        for g, _ in self._brush_grafts():
+            self._replace(g, keep=np.flatnonzero(~np.isin(self.layer.grafts[g].sites, sites)))
+        self._replace(b, new=graft(H(), 'up', sites, self.layer.up, self.layer.anchors))
+        self._set_lengths(sites, 0)
+        return sites
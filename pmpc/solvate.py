@@ -0,0 +1,225 @@
+"""Fill the space above or between brush layers with water and ions.
+
+Water molecules are placed on a cubic lattice at the target density, each
+with a random jitter and orientation. Molecules that overlap the solute are
+rejected with a `CellList` search, so the water left over fills the free
+volume at the target density. Waters that end up too close to each other
+are jittered and turned again, and ions then replace water molecules at
+random. Every step works on whole arrays, so no external packing program is
+needed.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from pmpc.spatial import CellList, find_clashes
+from pmpc.template import Template, stamp
+
+
+AVOGADRO = 6.02214076e23
+WATER_MASS = 18.015
+
+ION_ELEMENTS = {'NA': 'Na', 'CL': 'Cl', 'K': 'K', 'CA': 'Ca', 'MG': 'Mg'}
+
+
+def _water(bond=0.1, angle=np.deg2rad(109.47)):
+    """Three-site water with the geometry of SPC/E, centered on its oxygen."""
+    xyz = np.array([[0, 0, 0],
+                    [bond, 0, 0],
+                    [bond * np.cos(angle), bond * np.sin(angle), 0]])
+    return Template(np.array(['OW', 'HW1', 'HW2']), np.array(['O', 'H', 'H']), xyz,
+                    np.array([[0, 1], [0, 2]]))
+
+
+WATER = _water()
+
+
+Solvent = namedtuple('Solvent', ['name', 'template', 'xyz'])
+Solvent.__doc__ = """Copies of one solvent molecule.
+
+Parameters
+----------
+name : str
+    Name given to each copy when it is turned into a Compound.
+template : Template
+xyz : np.ndarray, shape=(k, n, 3)
+    Positions of every copy.
+"""
+
+
+def random_rotations(n, rng):
+    """Return `n` rotation matrices drawn uniformly from unit quaternions."""
+    q = rng.normal(size=(n, 4))
+    q /= np.linalg.norm(q, axis=1, keepdims=True)
+    w, x, y, z = q.T
+    return np.stack([np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)], axis=-1),
+                     np.stack([2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)], axis=-1),
+                     np.stack([2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)], axis=-1)],
+                    axis=1)
+
+
+def surface_top(layer):
+    """Height of the highest surface particle of a layer."""
+    return layer.surface.xyz[:, 2].max()
+
+
+def surface_bottom(layer):
+    """Height of the lowest surface particle of a layer."""
+    return layer.surface.xyz[:, 2].min()
+
+
+def layer_positions(layer):
+    """Return the positions of the surface and every grafted particle of a layer."""
+    return np.concatenate([layer.surface.xyz] + [graft.xyz.reshape(-1, 3) for graft in layer.grafts])
+
+
+def _orient(centers, rng):
+    """Place a randomly turned water on each center."""
+    return centers[:, None, :] + WATER.xyz @ np.swapaxes(random_rotations(len(centers), rng), 1, 2)
+
+
+def _touching(cells, xyz):
+    """Return the waters with an atom in range of the solute indexed by `cells`."""
+    pairs = cells.query(xyz.reshape(-1, 3))
+    return np.unique(pairs[:, 0] // len(WATER.names))
+
+
+def _separate(xyz, sites, jitter, bottom, top, box, cells, cutoff, clearance, max_tries, rng):
+    """Move waters that overlap other waters until they fit, and drop those that never do.
+
+    A water that overlaps gets a new jitter and orientation around its
+    lattice site. Only moved waters can make new overlaps, so after the
+    first round only their atoms are searched.
+    """
+    n_atoms = len(WATER.names)
+    periodic = [box[0], box[1], 0]
+    flat = xyz.reshape(-1, 3)
+    molecules = np.repeat(np.arange(len(xyz)), n_atoms)
+    pairs = find_clashes(flat, molecules, clearance, box=periodic)
+    # Of each overlapping pair the later water moves.
+    moving = np.unique(molecules[pairs[:, 1]])
+    for _ in range(max_tries):
+        if not len(moving):
+            break
+        centers = sites[moving] + rng.uniform(-jitter, jitter, size=(len(moving), 3))
+        xyz[moving] = _orient(centers, rng)
+        z = xyz[moving, :, 2]
+        misplaced = ((z <= bottom + cutoff / 2) | (z >= top - cutoff / 2)).any(axis=1)
+        if cells is not None:
+            misplaced[_touching(cells, xyz[moving])] = True
+        atoms = (moving[:, None] * n_atoms + np.arange(n_atoms)).ravel()
+        pairs = CellList(flat, clearance, box=periodic).query(flat[atoms])
+        pairs = pairs[molecules[atoms[pairs[:, 0]]] != molecules[pairs[:, 1]]]
+        overlapping = np.unique(molecules[atoms[pairs[:, 0]]])
+        moving = np.union1d(overlapping, moving[misplaced])
+    return np.delete(xyz, moving, axis=0)
+
+
+def solvate(box, z_range, solute=None, density=1.0, ions=None, cutoff=0.22, jitter=0.03, seed=None,
+            clearance=0.17, max_tries=50):
+    """Fill a slab of the box with water and ions.
+
+    Parameters
+    ----------
+    box : array-like, shape=(3,)
+        Box lengths in nm. The slab spans the box in x and y, which are
+        periodic.
+    z_range : tuple of float
+        Lower and upper height of the slab, e.g. from `surface_top` of one
+        layer to `surface_bottom` of the layer facing it.
+    solute : np.ndarray, shape=(m, 3), optional, default=None
+        Positions that water must stay `cutoff` away from, e.g. from
+        `layer_positions`.
+    density : float, optional, default=1.0
+        Water density in g/cm^3 in the volume left free by the solute.
+    ions : dict, optional, default=None
+        Number of ions by name, e.g. ``{'NA': 10, 'CL': 10}``. Names are
+        looked up in `ION_ELEMENTS`.
+    cutoff : float, optional, default=0.22
+        Smallest distance in nm between a water or ion atom and the solute.
+    jitter : float, optional, default=0.03
+        Largest random shift in nm of a molecule from its lattice site.
+    seed : int, optional, default=None
+        Seed of the jitter, orientations and ion placement.
+    clearance : float, optional, default=0.17
+        Smallest distance in nm between atoms of different waters.
+        Waters closer than this to another water are given a new random
+        jitter and orientation, up to `max_tries` times, and left out if
+        they still clash.
+    max_tries : int, optional, default=50
+
+    Returns
+    -------
+    solvents : list of Solvent
+        The water, then one entry per ion name.
+    """
+    rng = np.random.default_rng(seed)
+    box = np.asarray(box, dtype=float)
+    lower = np.array([0, 0, z_range[0]], dtype=float)
+    upper = np.array([box[0], box[1], z_range[1]], dtype=float)
+    lengths = upper - lower
+    if lengths[2] <= 0:
+        raise ValueError('The slab {} is empty.'.format(tuple(z_range)))
+
+    # A lattice a little finer than the target, trimmed once the free volume
+    # is known. Sites are kept clear of the slab faces along z.
+    spacing = (WATER_MASS / (density * AVOGADRO * 1e-21)) ** (1 / 3)
+    shape = np.maximum(np.ceil(lengths / spacing).astype(int), 1)
+    grid = np.stack(np.meshgrid(*[(np.arange(n) + 0.5) / n for n in shape], indexing='ij'), axis=-1)
+    sites = lower + grid.reshape(-1, 3) * lengths
+    xyz = _orient(sites + rng.uniform(-jitter, jitter, size=sites.shape), rng)
+    inside = (xyz[:, :, 2] > lower[2] + cutoff / 2) & (xyz[:, :, 2] < upper[2] - cutoff / 2)
+    keep = inside.all(axis=1)
+    n_inside = np.count_nonzero(keep)
+
+    cells = None
+    if solute is not None and len(solute):
+        cells = CellList(solute, cutoff, box=[box[0], box[1], 0])
+        query = np.flatnonzero(keep)
+        keep[query[_touching(cells, xyz[query])]] = False
+
+    # The free volume is the slab less its faces, times the fraction of
+    # lattice sites the solute left free.
+    volume = lengths[0] * lengths[1] * (lengths[2] - cutoff) * np.count_nonzero(keep) / max(n_inside, 1)
+    target = int(round(density * AVOGADRO * 1e-21 / WATER_MASS * volume))
+    kept = np.flatnonzero(keep)
+    kept = np.sort(rng.choice(kept, size=min(target, len(kept)), replace=False))
+    xyz = _separate(xyz[kept], sites[kept], jitter, lower[2], upper[2], box, cells, cutoff, clearance, max_tries,
+                    rng)
+
+    solvents = []
+    ions = ions or {}
+    if sum(ions.values()) > len(xyz):
+        raise ValueError('{} ions do not fit in {} waters.'.format(sum(ions.values()), len(xyz)))
+    replaced = rng.permutation(len(xyz))[:sum(ions.values())]
+    start = 0
+    for name, count in ions.items():
+        chosen = replaced[start:start + count]
+        start += count
+        template = Template(np.array([name]), np.array([ION_ELEMENTS.get(name, name)]),
+                            np.zeros((1, 3)), np.empty((0, 2), dtype=int))
+        solvents.append(Solvent(name, template, xyz[np.sort(chosen), :1]))
+    water = np.delete(xyz, replaced, axis=0)
+    return [Solvent('SOL', WATER, water)] + solvents
+
+
+def add_solvent(compound, solvents):
+    """Add solvent molecules to a compound, one child per molecule.
+
+    Returns
+    -------
+    copies : list of list of mb.Compound
+        The new children, one list per solvent.
+    """
+    import mbuild as mb
+
+    copies = []
+    for solvent in solvents:
+        added = []
+        for xyz in solvent.xyz:
+            copy = mb.Compound(name=solvent.name)
+            stamp(copy, solvent.template, xyz=xyz)
+            compound.add(copy)
+            added.append(copy)
+        copies.append(added)
+    return copies
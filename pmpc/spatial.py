@@ -0,0 +1,143 @@
+"""Cell lists for fixed-radius neighbour searches.
+
+Particles are binned into cubic cells at least `cutoff` wide, so every
+neighbour of a particle lies in its own cell or one of the 26 around it.
+Candidate pairs are generated with array operations only and queries are
+processed in chunks, which keeps both time and memory linear in the number
+of particles.
+"""
+from itertools import product
+
+import numpy as np
+
+
+class CellList(object):
+    """A cell list over a set of positions.
+
+    Parameters
+    ----------
+    xyz : np.ndarray, shape=(n, 3)
+        Positions to index.
+    cutoff : float
+        Largest distance searched for.
+    box : array-like, shape=(3,), optional, default=None
+        Box lengths. Dimensions with a positive length are periodic, the
+        others are not.
+    """
+    def __init__(self, xyz, cutoff, box=None):
+        self.xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+        self.cutoff = float(cutoff)
+        self.box = np.zeros(3) if box is None else np.asarray(box, dtype=float)
+        self.periodic = self.box > 0
+
+        if len(self.xyz):
+            lower = np.where(self.periodic, 0, self.xyz.min(axis=0))
+            upper = np.where(self.periodic, self.box, self.xyz.max(axis=0))
+        else:
+            lower = upper = np.zeros(3)
+        self.lower = lower
+        self.shape = np.maximum(((upper - lower) // self.cutoff).astype(int), 1)
+        self.width = np.where(upper > lower, (upper - lower) / self.shape, 1.0)
+
+        cells = self._flat(self._cells(self.xyz))
+        self.order = np.argsort(cells, kind='stable')
+        counts = np.bincount(cells, minlength=np.prod(self.shape))
+        self.counts = counts
+        self.starts = np.cumsum(counts) - counts
+
+        # Offsets to the cells around a cell, without repeating a cell when a
+        # periodic dimension has fewer than three cells.
+        steps = []
+        for n, periodic in zip(self.shape, self.periodic):
+            steps.append(sorted({s % n for s in (-1, 0, 1)}) if periodic else [-1, 0, 1])
+        self.offsets = np.array(list(product(*steps)))
+
+    def _wrap(self, xyz):
+        return np.where(self.periodic, np.mod(xyz, np.where(self.periodic, self.box, 1)), xyz)
+
+    def _cells(self, xyz):
+        cells = np.floor((self._wrap(xyz) - self.lower) / self.width).astype(int)
+        return np.where(self.periodic, cells % self.shape, cells)
+
+    def _flat(self, cells):
+        return np.ravel_multi_index(np.clip(cells, 0, self.shape - 1).T, self.shape)
+
+    def query(self, points=None, cutoff=None, chunk=65536):
+        """Find all pairs of a query point and an indexed point within `cutoff`.
+
+        Parameters
+        ----------
+        points : np.ndarray, shape=(m, 3), optional, default=None
+            Query points. By default the indexed points are queried against
+            each other and every pair is reported once.
+        cutoff : float, optional, default=None
+            Search radius, no larger than the cutoff of the cell list.
+        chunk : int, optional, default=65536
+            Number of query points processed at a time.
+
+        Returns
+        -------
+        pairs : np.ndarray, shape=(k, 2)
+            Index of the query point and of the indexed point of each pair.
+        """
+        self_query = points is None
+        points = self.xyz if self_query else np.asarray(points, dtype=float).reshape(-1, 3)
+        cutoff = self.cutoff if cutoff is None else cutoff
+        if cutoff > self.cutoff:
+            raise ValueError('cutoff {} exceeds the cell list cutoff {}.'.format(cutoff, self.cutoff))
+
+        found = []
+        for start in range(0, len(points), chunk):
+            queries = np.arange(start, min(start + chunk, len(points)))
+            cells = self._cells(points[queries])
+            # Query points outside of the non-periodic extent still see the
+            # edge cells, since those extend past the indexed points.
+            inside = (cells >= -1) & (cells <= self.shape)
+            cells = np.clip(cells, 0, self.shape - 1)
+            for offset in self.offsets:
+                neighbours = cells + offset
+                valid = np.all(inside, axis=1)
+                valid &= np.all(self.periodic | ((neighbours >= 0) & (neighbours < self.shape)), axis=1)
+                neighbours = self._flat(np.where(self.periodic, neighbours % self.shape, neighbours)[valid])
+                i, j = self._expand(queries[valid], neighbours)
+                if self_query:
+                    keep = i < j
+                    i, j = i[keep], j[keep]
+                delta = self.xyz[j] - points[i]
+                delta -= np.where(self.periodic, self.box * np.round(delta / np.where(self.periodic, self.box, 1)), 0)
+                close = np.einsum('ij,ij->i', delta, delta) < cutoff ** 2
+                found.append(np.column_stack((i[close], j[close])))
+        if not found:
+            return np.empty((0, 2), dtype=int)
+        return np.concatenate(found)
+
+    def _expand(self, queries, cells):
+        """Pair each query with every indexed point of its cell."""
+        counts = self.counts[cells]
+        total = counts.sum()
+        i = np.repeat(queries, counts)
+        first = np.repeat(self.starts[cells], counts)
+        within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        return i, self.order[first + within]
+
+
+def find_clashes(xyz, molecules, cutoff, box=None):
+    """Find particles of different molecules closer than `cutoff`.
+
+    Parameters
+    ----------
+    xyz : np.ndarray, shape=(n, 3)
+    molecules : np.ndarray, shape=(n,), dtype=int
+        Molecule of each particle. Pairs within a molecule are ignored.
+    cutoff : float
+    box : array-like, shape=(3,), optional, default=None
+        Box lengths, see `CellList`.
+
+    Returns
+    -------
+    pairs : np.ndarray, shape=(k, 2)
+        Indices of the overlapping particles, lower index first.
+    """
+    pairs = CellList(xyz, cutoff, box=box).query()
+    pairs = np.sort(pairs, axis=1)
+    return pairs[molecules[pairs[:, 0]] != molecules[pairs[:, 1]]]
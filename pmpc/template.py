@@ -0,0 +1,194 @@
+"""Array-backed templates for rigid building blocks.
+
+A template stores the particle names, elements, coordinates and bonds of a
+compound as NumPy arrays so that new copies can be stamped out without
+re-parsing the file the compound was loaded from. Only the functions that
+build or read compounds import mbuild, so the array code runs without it.
+"""
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+
+Template = namedtuple('Template', ['names', 'elements', 'xyz', 'bonds', 'parts'])
+Template.__new__.__defaults__ = (None,)
+Template.__doc__ = """Particle data of a compound stored as NumPy arrays.
+
+Parameters
+----------
+names : np.ndarray, shape=(n,), dtype=str
+    Particle names.
+elements : np.ndarray, shape=(n,), dtype=str
+    Element symbols, empty strings for particles without an element.
+xyz : np.ndarray, shape=(n, 3), dtype=float
+    Particle positions in nm.
+bonds : np.ndarray, shape=(m, 2), dtype=int
+    Indices of bonded particle pairs.
+parts : np.ndarray, shape=(n,), dtype=str, optional, default=None
+    Label of the child compound each particle belongs to.
+"""
+
+
+def _freeze(*arrays):
+    for array in arrays:
+        if array is not None:
+            array.setflags(write=False)
+
+
+def template_from_compound(compound, parts=None):
+    """Extract a Template from an mbuild Compound.
+
+    Parameters
+    ----------
+    compound : mb.Compound
+        The compound to convert.
+    parts : list of str, optional, default=None
+        Labels of children of `compound`. When given, every particle records
+        the label of the child it belongs to, so that `stamp` can rebuild
+        the same hierarchy.
+
+    Returns
+    -------
+    template : Template
+    """
+    particles = list(compound.particles())
+    index = {particle: i for i, particle in enumerate(particles)}
+    names = np.array([particle.name for particle in particles])
+    elements = np.array([particle.element.symbol if particle.element is not None else ''
+                         for particle in particles])
+    xyz = np.array([particle.pos for particle in particles], dtype=float).reshape(-1, 3)
+    bonds = np.array([(index[a], index[b]) for a, b in compound.bonds()], dtype=int).reshape(-1, 2)
+
+    labels = None
+    if parts is not None:
+        labels = np.full(len(particles), '', dtype=object)
+        for label in parts:
+            for particle in compound[label].particles():
+                labels[index[particle]] = label
+        labels = labels.astype(str)
+
+    _freeze(names, elements, xyz, bonds, labels)
+    return Template(names, elements, xyz, bonds, labels)
+
+
+@lru_cache(maxsize=None)
+def load_template(filename, relative_to_module, new_origin, point_on_y_axis):
+    """Load a file once per process and return it as a Template.
+
+    The coordinate system is transformed with `mb.y_axis_transform` so that
+    particle `new_origin` sits at the origin and particle `point_on_y_axis`
+    lies on the y axis.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the file to load.
+    relative_to_module : str
+        Module name used to locate `filename`, see `mb.load`.
+    new_origin : int
+        Index of the particle placed at the origin.
+    point_on_y_axis : int
+        Index of the particle placed on the y axis.
+
+    Returns
+    -------
+    template : Template
+        A read-only template shared by every caller.
+    """
+    import mbuild as mb
+
+    compound = mb.load(filename, relative_to_module=relative_to_module)
+    mb.y_axis_transform(compound, new_origin=compound[new_origin],
+                        point_on_y_axis=compound[point_on_y_axis])
+    return template_from_compound(compound)
+
+
+def stamp(compound, template, xyz=None):
+    """Add the particles and bonds of a template to a compound.
+
+    Parameters
+    ----------
+    compound : mb.Compound
+        The compound that receives the new particles.
+    template : Template
+        The template to copy.
+    xyz : np.ndarray, shape=(n, 3), optional, default=None
+        Positions to use instead of `template.xyz`.
+
+    Returns
+    -------
+    particles : list of mb.Particle
+        The new particles, in template order.
+    """
+    import mbuild as mb
+
+    if xyz is None:
+        xyz = template.xyz
+    particles = [mb.Particle(name=name, pos=pos, element=element or None)
+                 for name, pos, element in zip(template.names, xyz, template.elements)]
+
+    if template.parts is None:
+        compound.add(particles)
+    else:
+        labels = list(dict.fromkeys(template.parts))
+        for label in labels:
+            child = mb.Compound(name=label)
+            child.add([particles[i] for i in np.flatnonzero(template.parts == label)])
+            compound.add(child, label=label)
+
+    for i, j in template.bonds:
+        compound.add_bond((particles[i], particles[j]))
+    return particles
+
+
+def rotation_matrix(theta, around):
+    """Return the matrix of a rotation by `theta` around the vector `around`.
+
+    This is the same rotation `mb.Compound.rotate` applies, so that
+    ``xyz @ rotation_matrix(theta, around).T`` matches
+    ``compound.rotate(theta, around)``. Arrays of angles and of vectors are
+    broadcast against each other and give a stack of matrices.
+    """
+    around = np.asarray(around, dtype=float)
+    around = around / np.linalg.norm(around, axis=-1, keepdims=True)
+    theta, x, y, z = np.broadcast_arrays(theta, around[..., 0], around[..., 1], around[..., 2])
+    s = np.sin(theta)
+    c = np.cos(theta)
+    t = 1 - c
+    matrix = np.array([[t * x * x + c, t * x * y - s * z, t * x * z + s * y],
+                       [t * x * y + s * z, t * y * y + c, t * y * z - s * x],
+                       [t * x * z - s * y, t * y * z + s * x, t * z * z + c]])
+    return np.moveaxis(matrix, (0, 1), (-2, -1))
+
+
+def fit_transform(source, target):
+    """Find the rigid transform that best maps `source` onto `target`.
+
+    Parameters
+    ----------
+    source : np.ndarray, shape=(n, 3)
+        Reference positions.
+    target : np.ndarray, shape=(n, 3) or (k, n, 3)
+        Positions to fit, optionally a stack of k copies that are fitted
+        in one batch.
+
+    Returns
+    -------
+    rotation : np.ndarray, shape=(3, 3) or (k, 3, 3)
+    translation : np.ndarray, shape=(3,) or (k, 3)
+        The transform ``target ~= source @ rotation.T + translation``.
+    """
+    source = np.asarray(source, dtype=float)
+    target = np.asarray(target, dtype=float)
+    source_center = source.mean(axis=0)
+    target_center = target.mean(axis=-2)
+
+    covariance = np.swapaxes(source - source_center, -1, -2) @ (target - target_center[..., None, :])
+    u, _, vt = np.linalg.svd(covariance)
+    v = np.swapaxes(vt, -1, -2).copy()
+    # Flip the last axis where needed so that the result is a proper rotation.
+    v[..., :, 2] *= np.sign(np.linalg.det(v @ np.swapaxes(u, -1, -2)))[..., None]
+    rotation = v @ np.swapaxes(u, -1, -2)
+    translation = target_center - rotation @ source_center
+    return rotation, translation
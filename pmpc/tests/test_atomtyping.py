@@ -0,0 +1,114 @@
+"""
+Tests for environment labels and term enumeration of the fragment typer.
+"""
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from pmpc.atomtyping import bonded_terms, environment_labels, molecule_components
+
+
+def _propane_copies(n):
+    """Heavy-atom propane chains C-C-C, `n` copies of them in one system."""
+    elements = np.tile(['C', 'C', 'C'], n)
+    bonds = np.concatenate([np.array([[0, 1], [1, 2]]) + 3 * k for k in range(n)])
+    return elements, bonds
+
+
+def test_copies_share_labels():
+    elements, bonds = _propane_copies(4)
+    labels = environment_labels(elements, bonds)
+    assert len(np.unique(labels)) == 2
+    assert labels[0] == labels[2] == labels[11]
+    assert labels[1] != labels[0]
+    # Labels do not depend on the system they come from.
+    assert np.array_equal(environment_labels(*_propane_copies(1)), labels[:3])
+
+
+def test_depth_limits_environment():
+    elements = np.array(['O', 'C', 'C', 'C', 'C', 'C'])
+    bonds = np.column_stack((np.arange(5), np.arange(1, 6)))
+    near = environment_labels(elements, bonds, depth=1)
+    far = environment_labels(elements, bonds, depth=4)
+    assert near[3] == near[4]
+    assert far[3] != far[4]
+
+
+def test_bonded_terms():
+    # Isobutane heavy atoms plus a tail: C0 is bonded to C1, C2 and C3, C3 to C4.
+    bonds = np.array([[0, 1], [0, 2], [0, 3], [3, 4]])
+    angles, dihedrals, centers = bonded_terms(bonds, 5)
+    assert len(angles) == 4
+    assert {tuple(sorted((a, c))) for a, _, c in angles.tolist()} == {(1, 2), (1, 3), (2, 3), (0, 4)}
+    assert {frozenset((d[0], d[3])) for d in dihedrals.tolist()} == {frozenset((1, 4)), frozenset((2, 4))}
+    assert len(dihedrals) == 2
+    assert centers.tolist() == [[0, 1, 2, 3]]
+
+
+def test_molecule_components_groups_copies():
+    # Two waters, an ion, then a third water listed with its hydrogens first.
+    system = SimpleNamespace(names=np.array(['OW', 'HW1', 'HW2'] * 2 + ['NA', 'HW1', 'HW2', 'OW']),
+                             elements=np.array(['O', 'H', 'H'] * 2 + ['Na', 'H', 'H', 'O']),
+                             bonds=np.array([[0, 1], [2, 0], [3, 4], [3, 5], [9, 7], [9, 8]]))
+    groups = molecule_components(system)
+    assert [g.tolist() for g in groups] == [[[0, 1, 2], [3, 4, 5]], [[6]], [[7, 8, 9]]]
+
+
+def _typer(monkeypatch, apply_kwargs=None):
+    """A FragmentTyper whose force field gives propane bond parameters but no angle parameters."""
+    from pmpc import atomtyping
+    from pmpc.gromacs import AtomType, Interactions, MoleculeType
+
+    def subsystem(self, template, graph, needed):
+        return None, template, np.arange(len(template.names))
+
+    def from_parmed(structure):
+        molecule = MoleculeType('RES', 3, np.array(['CT', 'CT2', 'CT']), np.ones(3, dtype=int),
+                                np.full(3, 'RES'), np.array(['C'] * 3), np.zeros(3), np.full(3, 12.011),
+                                [Interactions(np.array([[0, 1], [1, 2]]), 1, np.array([[0.15, 2e5]] * 2))],
+                                [], [], [])
+        return [AtomType(name, 6, 12.011, 0, 0.35, 0.3) for name in ('CT', 'CT2')], molecule
+
+    monkeypatch.setattr(atomtyping.FragmentTyper, '_subsystem', subsystem)
+    monkeypatch.setattr(atomtyping, 'from_parmed', from_parmed)
+    forcefield = SimpleNamespace(apply=lambda compound, **kwargs: SimpleNamespace(atoms=[None] * 3))
+    return atomtyping.FragmentTyper(forcefield, prune=False, apply_kwargs=apply_kwargs)
+
+
+def test_missing_parameters_raise(monkeypatch):
+    template = SimpleNamespace(names=np.array(['C1', 'C2', 'C3']), elements=np.array(['C'] * 3),
+                               bonds=np.array([[0, 1], [1, 2]]), xyz=np.zeros((3, 3)))
+    typer = _typer(monkeypatch)
+    with pytest.raises(ValueError, match='angles.*CT-CT2-CT.*assert_angle_params'):
+        typer.type(template)
+    assert not typer.terms['bonds']
+
+    typer = _typer(monkeypatch, apply_kwargs={'assert_angle_params': False})
+    _, molecule = typer.type(template)
+    assert len(molecule.bonds[0].indices) == 2
+    assert not molecule.angles
+
+
+def test_typer_keyed_by_contents(tmpdir, monkeypatch):
+    """Workers share a typer between tasks on the same files and get a new one when they change."""
+    from pmpc import atomtyping
+
+    monkeypatch.setattr(atomtyping, '_TYPERS', {})
+    monkeypatch.setattr(atomtyping, 'load_forcefield', lambda files: SimpleNamespace(files=files))
+    first, copy = tmpdir.join('a.xml'), tmpdir.join('b.xml')
+    first.write('<ForceField/>')
+    copy.write('<ForceField/>')
+
+    typer = atomtyping._typer(str(first), {'depth': 3})
+    assert atomtyping._typer(str(first), {'depth': 3}) is typer
+    assert atomtyping._typer([str(copy)], {'depth': 3}) is typer
+    assert atomtyping._typer(str(first), {'depth': 4}) is not typer
+
+    strict = atomtyping._typer(str(first), {'apply_kwargs': {'assert_dihedral_params': True}})
+    loose = atomtyping._typer(str(first), {'apply_kwargs': {'assert_dihedral_params': False}})
+    assert loose is not strict
+    assert atomtyping._typer(str(first), {'apply_kwargs': {'assert_dihedral_params': False}}) is loose
+    assert loose.apply_kwargs == {'assert_dihedral_params': False}
+    first.write('<ForceField name="edited"/>')
+    assert atomtyping._typer(str(first), {'depth': 3}) is not typer
@@ -0,0 +1,21 @@
+"""
+Tests for the vectorized chain builder.
+"""
+import numpy as np
+import pytest
+
+mb = pytest.importorskip("mbuild")
+
+from pmpc.chain import _polymer, chain_template
+from pmpc.template import template_from_compound
+
+
+@pytest.mark.parametrize("n", [1, 2, 5])
+def test_chain_matches_polymer(n):
+    """The vectorized chain reproduces mb.recipes.Polymer particle for particle."""
+    reference = template_from_compound(_polymer(np.pi / 4, n))
+    chain = chain_template(n, np.pi / 4)
+
+    assert np.array_equal(chain.names, reference.names)
+    assert np.allclose(chain.xyz, reference.xyz, atol=1e-6)
+    assert set(map(tuple, np.sort(chain.bonds, axis=1))) == set(map(tuple, np.sort(reference.bonds, axis=1)))
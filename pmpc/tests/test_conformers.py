@@ -0,0 +1,57 @@
+"""
+Tests for the memory-mapped conformer library.
+"""
+import zipfile
+
+import numpy as np
+import pytest
+from numpy import pi
+
+from pmpc.conformers import ConformerLibrary, _memmap_npz
+
+
+def test_round_trip(tmp_path):
+    """Conformations written to a library read back memory-mapped and unchanged."""
+    filename = str(tmp_path / 'library.npz')
+    rng = np.random.default_rng(0)
+    first = rng.normal(size=(3, 7, 3))
+    second = rng.normal(size=(2, 7, 3))
+    wide = rng.normal(size=(4, 7, 3))
+
+    library = ConformerLibrary(filename)
+    library.add(4, first)
+    library.add(4, second)
+    library.add(4, wide, alpha=pi / 3)
+    library.add(4, first, forcefield='oplsaa')
+
+    reopened = ConformerLibrary(filename)
+    assert sorted(reopened.keys()) == sorted([ConformerLibrary.key(4), ConformerLibrary.key(4, alpha=pi / 3),
+                                              ConformerLibrary.key(4, 'oplsaa')])
+    assert ConformerLibrary.key(4, 'oplsaa') in reopened
+
+    xyz = reopened.conformers(4)
+    assert isinstance(xyz, np.memmap)
+    assert xyz.dtype == np.float32
+    np.testing.assert_array_equal(xyz, np.concatenate((first, second)).astype(np.float32))
+    np.testing.assert_array_equal(reopened.conformers(4, alpha=pi / 3), wide.astype(np.float32))
+    np.testing.assert_array_equal(reopened.conformers(4, 'oplsaa'), first.astype(np.float32))
+
+    drawn = reopened.sample(4, 10, seed=1)
+    assert drawn.shape == (10, 7, 3)
+    assert all(np.isin(frame, xyz).all() for frame in drawn)
+    with pytest.raises(KeyError):
+        reopened.conformers(5)
+
+
+def test_alpha_keys_differ():
+    assert ConformerLibrary.key(4) != ConformerLibrary.key(4, alpha=pi / 3)
+    assert ConformerLibrary.key(4, 'oplsaa') != ConformerLibrary.key(4, 'oplsaa', alpha=pi / 3)
+
+
+def test_compressed_is_rejected(tmp_path):
+    filename = str(tmp_path / 'compressed.npz')
+    np.savez_compressed(filename, L4=np.zeros((1, 2, 3)))
+    with zipfile.ZipFile(filename) as archive:
+        assert archive.infolist()[0].compress_type == zipfile.ZIP_DEFLATED
+    with pytest.raises(ValueError, match='compressed'):
+        _memmap_npz(filename)
@@ -0,0 +1,79 @@
+"""
+Tests for the columnar topology tables of demo_utils.
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+gmso = pytest.importorskip("gmso")
+pytest.importorskip("mbuild")
+unyt = pytest.importorskip("unyt")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
+from demo_utils import save_topology_frame, topology_frame  # noqa: E402
+
+
+def _butane():
+    """Four typed atoms with charges of both signs, three bonds and one two-term periodic dihedral."""
+    from gmso.core.atom import Atom
+    from gmso.core.atom_type import AtomType
+    from gmso.core.bond import Bond
+    from gmso.core.bond_type import BondType
+    from gmso.core.dihedral import Dihedral
+    from gmso.core.dihedral_type import DihedralType
+
+    topology = gmso.Topology(name='butane')
+    types = {'CT': AtomType(name='CT'), 'CM': AtomType(name='CM')}
+    atoms = []
+    for k, (name, charge) in enumerate([('CT', 0.4), ('CM', -0.8), ('CM', 0.4), ('CT', 0.0)]):
+        atom = Atom(name='C{}'.format(k), charge=charge * unyt.elementary_charge, mass=12.011 * unyt.amu,
+                    position=[0.15 * k, 0, 0] * unyt.nm, atom_type=types[name])
+        topology.add_site(atom)
+        atoms.append(atom)
+
+    bond_type = BondType(name='CC', expression='k * (r - r_eq)**2',
+                         parameters={'k': 2e5 * unyt.Unit('kJ/(mol*nm**2)'), 'r_eq': 0.15 * unyt.nm},
+                         independent_variables={'r'})
+    for a, b in zip(atoms[:-1], atoms[1:]):
+        topology.add_connection(Bond(connection_members=[a, b], bond_type=bond_type))
+    dihedral_type = DihedralType(name='periodic', expression='k * (1 + cos(n * phi - phi_eq))',
+                                 parameters={'k': [1.0, 2.0] * unyt.Unit('kJ/mol'),
+                                             'n': [1, 3] * unyt.dimensionless,
+                                             'phi_eq': [0.0, 180.0] * unyt.degree},
+                                 independent_variables={'phi'})
+    topology.add_connection(Dihedral(connection_members=atoms, dihedral_type=dihedral_type))
+    topology.update_topology()
+    return topology
+
+
+def test_topology_frame(tmpdir):
+    frames = topology_frame(_butane())
+
+    atoms = frames['atoms']
+    np.testing.assert_allclose(atoms['charge'], [0.4, -0.8, 0.4, 0.0])
+    np.testing.assert_allclose(atoms['mass'], 12.011)
+    assert atoms['name'].dtype == 'category'
+    assert atoms['atom_type'].dtype == 'category'
+    assert list(atoms['atom_type']) == ['CT', 'CM', 'CM', 'CT']
+
+    bonds = frames['bonds']
+    assert bonds[['atom1', 'atom2']].values.tolist() == [[0, 1], [1, 2], [2, 3]]
+    assert any(column.startswith('r_eq (') for column in bonds.columns)
+
+    dihedrals = frames['dihedrals']
+    assert dihedrals[['atom1', 'atom2', 'atom3', 'atom4']].values.tolist() == [[0, 1, 2, 3]]
+    k_0 = next(column for column in dihedrals.columns if column.startswith('k_0 ('))
+    k_1 = next(column for column in dihedrals.columns if column.startswith('k_1 ('))
+    assert dihedrals[k_0].tolist() == [1.0]
+    assert dihedrals[k_1].tolist() == [2.0]
+    assert not any(column.startswith('k (') for column in dihedrals.columns)
+
+    pytest.importorskip("pyarrow")
+    prefix = str(tmpdir.join('butane'))
+    save_topology_frame(frames, prefix)
+    read = pd.read_parquet(prefix + '_atoms.parquet')
+    assert read['atom_type'].dtype == 'category'
+    np.testing.assert_allclose(read['charge'], atoms['charge'])
@@ -0,0 +1,23 @@
+"""
+Tests for the chain length distributions.
+"""
+import numpy as np
+import pytest
+
+from pmpc.dispersity import Poisson, SchulzZimm, chain_lengths, dispersity
+
+
+@pytest.mark.parametrize("distribution", [SchulzZimm(20, 1.3), Poisson(20)])
+def test_moments(distribution):
+    lengths = distribution.sample(100000, seed=0)
+    assert lengths.min() >= 1
+    assert lengths.mean() == pytest.approx(distribution.mn, rel=0.01)
+    assert dispersity(lengths) == pytest.approx(distribution.pdi, rel=0.01)
+
+
+def test_chain_lengths():
+    assert chain_lengths(4, 3).tolist() == [4, 4, 4]
+    assert chain_lengths([1, 2, 3], 3).tolist() == [1, 2, 3]
+    assert np.array_equal(chain_lengths(Poisson(5), 10, seed=1), Poisson(5).sample(10, seed=1))
+    with pytest.raises(ValueError):
+        chain_lengths([1, 2], 3)
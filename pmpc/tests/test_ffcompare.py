@@ -0,0 +1,36 @@
+"""
+Tests for aligning the typing results of force field variants.
+"""
+import numpy as np
+
+from pmpc.ffcompare import align, charge_report, differences
+from pmpc.gromacs import Interactions, MoleculeType
+
+
+def _molecule(types, charges, dihedrals):
+    n = len(types)
+    return MoleculeType('RES', 3, np.array(types), np.ones(n, dtype=int), np.full(n, 'RES'),
+                        np.array(['A'] * n), np.array(charges), np.full(n, 12.0),
+                        [Interactions(np.array([[0, 1], [1, 2], [2, 3]]), 1, np.tile([0.15, 2e5], (3, 1)))],
+                        [Interactions(np.array([[0, 3]]), 1)], [], dihedrals)
+
+
+def test_align_and_differences():
+    periodic = Interactions(np.array([[0, 1, 2, 3], [3, 2, 1, 0]]), 9, np.array([[0, 1.0, 1], [180, 2.0, 2]]))
+    reference = _molecule(['a', 'b', 'b', 'a'], [0.1, -0.1, -0.1, 0.1], [periodic])
+    variant = _molecule(['a', 'c', 'b', 'a'], [0.1, -0.1, -0.1, 0.2],
+                        [Interactions(np.array([[0, 1, 2, 3]]), 9, np.array([[0, 1.0, 1]])),
+                         Interactions(np.array([[1, 0, 2, 3]]), 4, np.array([[180, 4.6, 2]]))])
+    comparison = align(['ref', 'var'], [reference, variant])
+
+    indices, present, params = comparison.terms[('dihedrals', 9)]
+    assert indices.tolist() == [[0, 1, 2, 3, 0], [0, 1, 2, 3, 1]]
+    assert present.tolist() == [[True, True], [True, False]]
+    assert np.isnan(params[1, 1]).all()
+
+    atoms, terms = differences(comparison)
+    assert atoms.tolist() == [[False] * 4, [False, True, False, True]]
+    assert terms[('dihedrals', 9)].tolist() == [[False, False], [False, True]]
+    assert terms[('dihedrals', 4)].tolist() == [[False], [True]]
+    assert not terms[('pairs', 1)].any()
+    assert [integral for _, _, integral in charge_report(comparison)] == [True, False]
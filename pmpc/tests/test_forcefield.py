@@ -0,0 +1,123 @@
+"""
+Tests for the force field cache. Only the round trip through the disk cache needs Foyer.
+"""
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from pmpc import forcefield as ff
+from pmpc.forcefield import (CompiledParser, TypingProfiler, content_hash, load_forcefield, prune_forcefield,
+                             rule_requirements)
+
+
+class _Parser(object):
+    def __init__(self):
+        self.calls = 0
+
+    def parse(self, smarts):
+        self.calls += 1
+        return [smarts]
+
+
+def test_compiled_parser_parses_once():
+    parser = CompiledParser(_Parser())
+    tree = parser.parse('[C;X4]')
+    assert parser.parse('[C;X4]') is tree
+    assert parser.calls == 1
+
+
+def test_content_hash_follows_contents(tmpdir):
+    xml = tmpdir.join('ff.xml')
+    xml.write('<ForceField/>')
+    before = content_hash(str(xml))
+    assert content_hash([str(xml)]) == before
+    xml.write('<ForceField name="edited"/>')
+    assert content_hash(str(xml)) != before
+
+
+def test_cache_round_trip(tmpdir, monkeypatch):
+    """A force field read back from the disk cache keeps its compiled SMARTS."""
+    foyer = pytest.importorskip("foyer")
+    xml = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, 'utils', 'mpc.xml')
+    monkeypatch.setattr(ff, '_LOADED', {})
+    loaded = load_forcefield(xml, cache_dir=str(tmpdir))
+    assert load_forcefield(xml, cache_dir=str(tmpdir)) is loaded
+    assert [path.basename for path in tmpdir.listdir()] == ['forcefield-{}.pkl'.format(content_hash(xml))]
+
+    def rebuild(*args, **kwargs):
+        raise AssertionError('The force field was parsed again instead of read from the cache.')
+
+    monkeypatch.setattr(ff, '_LOADED', {})
+    monkeypatch.setattr(foyer, 'Forcefield', rebuild)
+    cached = load_forcefield(xml, cache_dir=str(tmpdir))
+    assert cached is not loaded
+    assert cached.atomTypeDefinitions == loaded.atomTypeDefinitions
+    assert isinstance(cached.parser, CompiledParser)
+    smarts = [definition for definition in loaded.atomTypeDefinitions.values() if definition]
+    assert set(cached.parser.trees) == set(smarts)
+    # Stored trees are handed out without reaching the wrapped parser.
+    cached.parser.parser = None
+    assert all(cached.parser.parse(definition) is cached.parser.trees[definition] for definition in smarts)
+
+
+def test_rule_requirements():
+    assert rule_requirements('[C;X4](C)(H)(H)H') == ('C', 4, {'C', 'H'})
+    assert rule_requirements('[C;X4]Si') == ('C', 4, {'C', 'Si'})
+    # Alternatives, negations and recursive environments require nothing.
+    assert rule_requirements('[C,N;X3]([!H])[$(OP)]') == (None, None, set())
+
+
+def test_prune_forcefield():
+    forcefield = SimpleNamespace(atomTypeDefinitions={'CT': '[C;X4](H)(H)(H)', 'CM': '[C;X3]',
+                                                      'P': '[P;X4]', 'HC': 'H[C;X4]', 'X': None},
+                                 atomTypeElements={'CT': 'C', 'CM': 'C', 'P': 'P', 'HC': 'H'})
+    methane = prune_forcefield(forcefield, ['C', 'H', 'H', 'H', 'H'], [[0, 1], [0, 2], [0, 3], [0, 4]])
+    assert methane.n_rules == 4
+    assert methane.by_element == ['P']
+    assert methane.by_neighbours == ['CM']
+    assert set(methane.forcefield.atomTypeDefinitions) == {'CT', 'HC'}
+    assert len(forcefield.atomTypeDefinitions) == 5
+
+
+class _Graph(object):
+    def __init__(self, elements):
+        self.elements = elements
+
+    def __len__(self):
+        return len(self.elements)
+
+    def nodes(self, data=False):
+        return [(i, {'atom_data': SimpleNamespace(element=e)}) for i, e in enumerate(self.elements)]
+
+
+class _Rule(object):
+    def __init__(self, name, smarts):
+        self.name = name
+        self.smarts_string = smarts
+
+    def find_matches(self, graph):
+        # Like Foyer, match lazily, so that the profiler has to time the iteration.
+        for i, element in enumerate(graph.elements):
+            time.sleep(0.01)
+            if element == self.name:
+                yield i
+
+
+def test_typing_profiler(tmpdir):
+    rules = [_Rule('C', '[C]'), _Rule('H', '[H]'), _Rule('X', '*')]
+    graph = _Graph(['C', 'H', 'H'])
+    with TypingProfiler(smarts_graph=_Rule) as profiler:
+        for rule in rules:
+            rule.find_matches(graph)
+    assert rules[0].find_matches.__name__ == 'find_matches'
+    report = {entry['name']: entry for entry in profiler.report(sort='name')}
+    assert report['H']['candidates'] == 2
+    assert report['C']['candidates'] == 1
+    assert report['X']['candidates'] == 3
+    assert report['H']['matches'] == 2
+    assert report['C']['calls'] == 1
+    assert report['C']['time'] >= 0.02
+    profiler.to_csv(str(tmpdir.join('typing.csv')))
+    assert tmpdir.join('typing.csv').readlines()[0].strip() == ','.join(TypingProfiler.fields)
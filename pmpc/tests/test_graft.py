@@ -0,0 +1,141 @@
+"""
+Tests for bulk grafting.
+"""
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from pmpc.graft import Graft, Layer, overlap_transforms, stitch
+from pmpc.template import Template, rotation_matrix
+
+
+class _Port(object):
+    """The parts of an `mb.Port` that `overlap_transforms` reads."""
+    def __init__(self, up, down, anchor):
+        self.subports = {'up': SimpleNamespace(xyz_with_ports=up), 'down': SimpleNamespace(xyz_with_ports=down)}
+        self.anchor = SimpleNamespace(pos=anchor)
+
+    def __getitem__(self, label):
+        return self.subports[label]
+
+
+def _port():
+    up = np.array([[0.005, 0.0025, -0.0025], [0.005, 0.0225, -0.0025],
+                   [-0.015, -0.0075, -0.0025], [0.005, -0.0175, 0.0075]]) + [0, 0, 0.07]
+    down = up @ rotation_matrix(np.pi, [0, 1, 0]).T + [0, 0, 0.14]
+    return _Port(up, down, np.zeros(3))
+
+
+def test_overlap_transforms():
+    """Each host port gets the exact fit of one sub-port, the one that keeps the anchors apart."""
+    rng = np.random.default_rng(0)
+    port = _port()
+    rotations = rotation_matrix(rng.uniform(0, 2 * np.pi, 5), rng.normal(size=(5, 3)))
+    translations = rng.uniform(0, 3, size=(5, 3))
+    # The first three hosts face the guest's 'up' sub-port, the others its
+    # 'down' one. Host anchors sit behind their ports, so the other sub-port
+    # is fitted to keep the guest on the far side.
+    guest = np.array([port['up'].xyz_with_ports] * 3 + [port['down'].xyz_with_ports] * 2)
+    up = guest @ np.swapaxes(rotations, 1, 2) + translations[:, None, :]
+    normals = (up.mean(axis=1) - translations) / np.linalg.norm(up.mean(axis=1) - translations, axis=1)[:, None]
+    anchors = up.mean(axis=1) - 0.1 * normals
+
+    fitted, shifts = overlap_transforms(port, up, anchors)
+    for subport, rows in (('down', slice(0, 3)), ('up', slice(3, 5))):
+        placed = port[subport].xyz_with_ports @ np.swapaxes(fitted[rows], 1, 2) + shifts[rows, None, :]
+        np.testing.assert_allclose(placed, up[rows], atol=1e-10)
+    np.testing.assert_allclose(fitted @ np.swapaxes(fitted, 1, 2), np.broadcast_to(np.eye(3), (5, 3, 3)),
+                               atol=1e-10)
+    np.testing.assert_allclose(np.linalg.det(fitted), 1)
+
+
+def test_graft_matches_force_overlap():
+    """One batched copy lands where `force_overlap` puts it."""
+    mb = pytest.importorskip("mbuild")
+    from mbuild.lib.moieties import CH3
+    from mbuild.lib.surfaces import Betacristobalite
+
+    from pmpc.graft import graft, port_frames
+
+    host = Betacristobalite()
+    ports = host.available_ports()
+    up, anchors = port_frames(ports)
+    guest = CH3()
+    grafted = graft(guest, 'up', np.array([3]), up, anchors)
+
+    copy = mb.clone(guest)
+    mb.force_overlap(copy, copy['up'], ports[3])
+    np.testing.assert_allclose(grafted.xyz[0], copy.xyz, atol=1e-6)
+
+
+def test_graft_layer_matches_monolayer():
+    """A grafted layer has the positions of the `Monolayer` built from the same pattern."""
+    mb = pytest.importorskip("mbuild")
+    from mbuild.lib.atoms import H
+    from mbuild.lib.moieties import CH3
+    from mbuild.lib.surfaces import Betacristobalite
+
+    from pmpc.graft import graft_layer
+
+    monolayer = mb.lib.recipes.Monolayer(Betacristobalite(), CH3(), backfill=H(),
+                                         pattern=mb.Random2DPattern(5, seed=1))
+    host = mb.lib.recipes.TiledCompound(Betacristobalite(), n_tiles=(1, 1, 1))
+    layer = graft_layer(host, mb.Random2DPattern(5, seed=1), CH3(), backfill=H(), guest_port_name='up')
+
+    assert [len(graft.sites) for graft in layer.grafts] == [5, len(layer.sites) - 5]
+    grafted = np.concatenate([graft.xyz.reshape(-1, 3) for graft in layer.grafts])
+    expected = np.array([particle.pos for particle in monolayer.particles()
+                         if particle not in set(monolayer['tiled_surface'].particles())])
+    order = np.lexsort(np.round(grafted, 4).T)
+    np.testing.assert_allclose(grafted[order], expected[np.lexsort(np.round(expected, 4).T)], atol=1e-6)
+
+
+def _tile():
+    """A one-tile layer whose surface bond crosses the tile boundary along x."""
+    surface = Template(np.array(['A', 'B']), np.array(['O', 'Si']), np.array([[0.1, 0.5, 0], [0.9, 0.5, 0]]),
+                       np.array([[0, 1]]))
+    hydrogen = Template(np.array(['H']), np.array(['H']), np.zeros((1, 3)), np.empty((0, 2), dtype=int))
+    xyz = np.array([[[0.1, 0.5, 0.1]], [[0.9, 0.5, 0.1]]])
+    return Layer(surface, np.array([0, 1]), [Graft('H', hydrogen, xyz, np.array([0, 1]), 0)],
+                 np.array([1.0, 1.0, 2.0]), np.zeros((2, 4, 3)), np.zeros((2, 3)))
+
+
+def test_stitch():
+    """Tiles are offset, wrapped bonds join neighbouring tiles, and grafts merge."""
+    tiles = [_tile(), _tile(), _tile()]
+    layer = stitch(tiles, 3, 1)
+
+    np.testing.assert_array_equal(layer.box, [3, 1, 2])
+    np.testing.assert_allclose(layer.surface.xyz[:, 0], [0.1, 0.9, 1.1, 1.9, 2.1, 2.9])
+    assert set(map(tuple, layer.surface.bonds)) == {(0, 5), (2, 1), (4, 3)}
+    np.testing.assert_array_equal(layer.sites, [0, 1, 2, 3, 4, 5])
+
+    hydrogen, = layer.grafts
+    np.testing.assert_array_equal(hydrogen.sites, [0, 1, 2, 3, 4, 5])
+    np.testing.assert_allclose(hydrogen.xyz[:, 0, 0], [0.1, 0.9, 1.1, 1.9, 2.1, 2.9])
+    np.testing.assert_allclose(layer.up[2:4, :, 0], 1)
+    np.testing.assert_allclose(layer.anchors[4:, 0], 2)
+
+
+def test_stitch_grid():
+    """Every stitched bond has the length of the bond it copies, across the periodic box."""
+    layer = stitch([_tile()] * 6, 2, 3)
+    np.testing.assert_array_equal(layer.box, [2, 3, 2])
+    delta = np.diff(layer.surface.xyz[layer.surface.bonds], axis=1)[:, 0]
+    delta -= layer.box * np.round(delta / layer.box)
+    np.testing.assert_allclose(np.linalg.norm(delta, axis=1), 0.2)
+    with pytest.raises(ValueError):
+        stitch([_tile()] * 5, 2, 3)
+
+
+def test_tile_seeds():
+    pytest.importorskip("mbuild")
+    from pmpc.pmpc_brush_layer import tile_seeds
+
+    seeds = tile_seeds(12, 8)
+    assert seeds == tile_seeds(12, 8)
+    assert tile_seeds(12, 4) == seeds[:4]
+    assert len(set(seeds)) == 8
+    assert all(isinstance(seed, int) and 0 < seed < 2 ** 63 for seed in seeds)
+    assert tile_seeds(13, 8) != seeds
@@ -0,0 +1,139 @@
+"""
+Tests for the streaming GROMACS writers.
+"""
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from pmpc.gromacs import (AtomType, GroWriter, Interactions, MoleculeType, from_parmed, split_molecules,
+                          write_gro, write_top)
+
+
+def _sections(filename):
+    sections, current = {}, None
+    with open(filename) as top:
+        for line in top:
+            line = line.strip()
+            if line.startswith('['):
+                current = line.strip('[] ')
+                sections.setdefault(current, [])
+            elif line and not line.startswith(';'):
+                sections[current].append(line.split())
+    return sections
+
+
+def test_top_sections_are_chunked_consistently(tmpdir):
+    n = 25
+    chain = np.column_stack((np.arange(n - 1), np.arange(1, n)))
+    molecule = MoleculeType('RES', 3, np.full(n, 'opls_135'), np.ones(n, dtype=int), np.full(n, 'RES'),
+                            np.full(n, 'C'), np.full(n, 0.1), np.full(n, 12.011),
+                            [Interactions(chain, 1, np.tile([0.1529, 224262.4], (n - 1, 1)))],
+                            [Interactions(chain[:-2] + [0, 3], 1)],
+                            [Interactions(np.column_stack((chain[:-1], np.arange(2, n))), 1,
+                                          np.tile([112.7, 488.273], (n - 2, 1)))],
+                            [])
+    filename = str(tmpdir.join('chain.top'))
+    write_top(filename, [AtomType('opls_135', 6, 12.011, 0.0, 0.35, 0.276144)], [molecule], [('RES', 2)],
+              chunk=4)
+
+    sections = _sections(filename)
+    assert len(sections['atoms']) == n
+    assert [int(row[0]) for row in sections['atoms']] == list(range(1, n + 1))
+    assert float(sections['atoms'][-1][-1]) == pytest.approx(0.1 * n)
+    assert [[int(row[0]), int(row[1])] for row in sections['bonds']] == (chain + 1).tolist()
+    assert len(sections['pairs']) == n - 3
+    assert len(sections['angles']) == n - 2
+    assert sections['molecules'] == [['RES', '2']]
+
+
+def test_gro_writer_numbers_across_writes(tmpdir):
+    filename = str(tmpdir.join('out.gro'))
+    xyz = np.random.default_rng(0).uniform(size=(6, 3))
+    with GroWriter(filename, 12, [1, 2, 3]) as gro:
+        for _ in range(2):
+            gro.write(xyz, np.full(6, 'OW'), np.full(6, 'SOL'), np.repeat([1, 2], 3), chunk=4)
+
+    with open(filename) as handle:
+        lines = handle.read().splitlines()
+    assert lines[1] == '12'
+    assert [int(line[15:20]) for line in lines[2:-1]] == list(range(1, 13))
+    assert [int(line[:5]) for line in lines[2:-1]] == [1, 1, 1, 2, 2, 2, 3, 3, 3, 4, 4, 4]
+    assert lines[-1].split() == ['1.00000', '2.00000', '3.00000']
+
+    with pytest.raises(ValueError):
+        with GroWriter(filename, 7, [1, 1, 1]) as gro:
+            gro.write(xyz, np.full(6, 'OW'), np.full(6, 'SOL'), np.ones(6, dtype=int))
+
+
+def test_write_gro(tmpdir):
+    filename = str(tmpdir.join('out.gro'))
+    write_gro(filename, np.zeros((3, 3)), np.array(['OW', 'HW1', 'HW2']), np.full(3, 'SOL'),
+              np.ones(3, dtype=int), [1, 1, 1])
+    with open(filename) as handle:
+        assert handle.read().splitlines()[2] == '    1SOL     OW    1   0.000   0.000   0.000'
+
+
+def test_split_molecules_merges_identical_fragments():
+    # water, three-atom chain, water, ion
+    types = np.array(['OW', 'HW', 'HW', 'C', 'C', 'C', 'OW', 'HW', 'HW', 'NA'])
+    residues = np.array(['SOL'] * 3 + ['RES'] * 3 + ['SOL'] * 3 + ['NA'])
+    water = np.array([[0, 1], [0, 2]])
+    bonds = np.concatenate((water, [[3, 4], [4, 5]], water + 6))
+    molecule = MoleculeType('RES', 3, types, np.repeat([1, 2, 3, 4], [3, 3, 3, 1]), residues, types,
+                            np.zeros(10), np.ones(10),
+                            [Interactions(bonds, 1, np.tile([0.1, 1000.0], (len(bonds), 1)))],
+                            [], [Interactions(np.array([[1, 0, 2], [3, 4, 5], [7, 6, 8]]), 1)], [])
+
+    moleculetypes, molecules, order = split_molecules(molecule)
+
+    assert molecules == [('SOL', 2), ('RES', 1), ('NA', 1)]
+    assert order.tolist() == [0, 1, 2, 6, 7, 8, 3, 4, 5, 9]
+    sol = moleculetypes[0]
+    assert sol.bonds[0].indices.tolist() == [[0, 1], [0, 2]]
+    assert sol.angles[0].indices.tolist() == [[1, 0, 2]]
+    assert sol.resids.tolist() == [1, 1, 1]
+    assert moleculetypes[1].bonds[0].indices.tolist() == [[0, 1], [1, 2]]
+
+
+def _structure(urey_bradleys=((1, 2),)):
+    """A ParmEd-like carbon bonded to three hydrogens, with one harmonic improper."""
+    residue = SimpleNamespace(idx=0, name='RES')
+    atoms = [SimpleNamespace(idx=k, type=kind, name=kind + str(k), atomic_number=number, mass=mass, charge=0.0,
+                             residue=residue, atom_type=SimpleNamespace(sigma=3.0, epsilon=0.1))
+             for k, (kind, number, mass) in enumerate([('C', 6, 12.011)] + [('H', 1, 1.008)] * 3)]
+
+    def term(*indices, **parameters):
+        members = {'atom{}'.format(k + 1): atoms[i] for k, i in enumerate(indices)}
+        return SimpleNamespace(type=SimpleNamespace(**parameters), **members)
+
+    return SimpleNamespace(
+        atoms=atoms, adjusts=[], dihedrals=[], rb_torsions=[],
+        bonds=[term(0, k, req=1.09, k=340.0) for k in (1, 2, 3)],
+        angles=[term(1, 0, 2, theteq=109.5, k=35.0), term(1, 0, 3, theteq=109.5, k=35.0)],
+        urey_bradleys=[term(i, j, req=1.8, k=5.0) for i, j in urey_bradleys],
+        impropers=[term(0, 1, 2, 3, psi_eq=0.0, psi_k=10.0)])
+
+
+def test_from_parmed_impropers_and_urey_bradleys(tmpdir):
+    _, molecule = from_parmed(_structure())
+
+    plain, spanned = molecule.angles
+    assert (plain.funct, spanned.funct) == (1, 5)
+    assert plain.indices.tolist() == [[1, 0, 3]]
+    assert spanned.indices.tolist() == [[1, 0, 2]]
+    np.testing.assert_allclose(spanned.params, [[109.5, 2 * 35.0 * 4.184, 0.18, 2 * 5.0 * 4.184 * 100]])
+
+    improper, = molecule.dihedrals
+    assert improper.funct == 2
+    assert improper.indices.tolist() == [[0, 1, 2, 3]]
+    np.testing.assert_allclose(improper.params, [[0.0, 2 * 10.0 * 4.184]])
+
+    filename = str(tmpdir.join('ch3.top'))
+    write_top(filename, [], [molecule], [('RES', 1)])
+    sections = _sections(filename)
+    assert [row[3] for row in sections['angles']] == ['1', '5']
+    assert sections['dihedrals'][0][4] == '2'
+
+    with pytest.raises(ValueError, match='Urey-Bradley'):
+        from_parmed(_structure(urey_bradleys=((1, 2), (2, 3), (0, 1))))
@@ -0,0 +1,220 @@
+"""
+Tests for the index group tools in utils, which need no mbuild.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, 'utils'))
+from index_groups import (Selector, ancestry, chain_groups, chain_index, detect_layers, layer_faces,  # noqa: E402
+                          membership_masks, molecule_ids, write_lammps_groups, write_ndx)
+
+
+class _Compound(object):
+    """The parts of an mbuild Compound that the tree walks read."""
+    def __init__(self, name, children=(), port_particle=False, labels=None):
+        self.name = name
+        self.children = list(children)
+        self.port_particle = port_particle
+        self.labels = labels or {}
+
+
+def _port():
+    ghosts = [_Compound('subport', [_Compound('_', port_particle=True) for _ in range(4)]) for _ in range(2)]
+    return _Compound('Port', ghosts)
+
+
+def _system():
+    surface = _Compound('Surface', [_Compound('Si'), _Compound('O'), _port()])
+    chain = _Compound('Alkylsilane', [_Compound('C'), _Compound('CH2', [_Compound('C'), _Compound('H')]), _port()])
+    return _Compound('System', [surface, chain, _Compound('O')])
+
+
+def _brush():
+    """A brush whose children are labeled differently from their names, as in `Brush`."""
+    silane = _Compound('Silane', [_Compound('Si'), _Compound('O')])
+    initiator = _Compound('Initiator', [_Compound('C'), _Compound('Br')])
+    chain = _Compound('PMPCChain', [_Compound('MPC', [_Compound('P'), _Compound('O')])])
+    # mbuild also files children by name in lists, which are not labels of one child.
+    return _Compound('Brush', [silane, initiator, chain],
+                     labels={'silane': silane, 'initiator': initiator, 'pmpc': chain, 'MPC': [chain]})
+
+
+def test_label_matches_labels_and_names():
+    lineage = ancestry(_brush())
+    selector = Selector(np.zeros((6, 3)), lineage=lineage)
+    assert selector.select('label pmpc').tolist() == [False] * 4 + [True] * 2
+    assert selector.select('label PMPCChain').tolist() == [False] * 4 + [True] * 2
+    assert selector.select('label silane or label Initiator').tolist() == [True] * 4 + [False] * 2
+    assert not selector.select('label MPC and label silane').any()
+    initiator = membership_masks(_brush(), ['initiator'], lineage=lineage)['initiator']
+    assert initiator.tolist() == [False, False, True, True, False, False]
+
+
+def test_ancestry_skips_port_particles():
+    codes, lineages, parents = ancestry(_system())
+    assert len(codes) == 6
+    assert parents.tolist() == ['Surface', 'Surface', 'Alkylsilane', 'CH2', 'CH2', 'System']
+    assert [sorted(lineages[code]) for code in codes][3] == ['Alkylsilane', 'CH2', 'System']
+
+
+def test_membership_masks():
+    masks = membership_masks(_system(), ['Alkylsilane', 'Surface'])
+    assert masks['Alkylsilane'].tolist() == [False, False, True, True, True, False]
+    assert masks['Surface'].tolist() == [True, True, False, False, False, False]
+
+
+def _selector():
+    system = _system()
+    lineage = ancestry(system)
+    xyz = np.column_stack((np.zeros(6), np.zeros(6), np.arange(6.0)))
+    elements = np.array(['Si', 'O', 'C', 'C', 'H', 'O'])
+    return Selector(xyz, names=elements, elements=elements, residues=lineage[2], lineage=lineage)
+
+
+def test_selector_keywords():
+    selector = _selector()
+    assert selector.indices('label Alkylsilane').tolist() == [3, 4, 5]
+    assert selector.indices('element O Si').tolist() == [1, 2, 6]
+    assert selector.indices('resname CH2').tolist() == [4, 5]
+    assert selector.indices('z 1:3').tolist() == [2, 3]
+    assert selector.indices('z 4:').tolist() == [5, 6]
+    assert selector.indices('all').tolist() == [1, 2, 3, 4, 5, 6]
+    assert selector.indices('none').tolist() == []
+
+
+def test_selector_precedence():
+    selector = _selector()
+    # not binds tightest, then and, then or.
+    assert selector.indices('element O or element C and z 3:').tolist() == [2, 4, 6]
+    assert selector.indices('(element O or element C) and z 3:').tolist() == [4, 6]
+    assert selector.indices('not element O and not label Surface').tolist() == [3, 4, 5]
+    assert selector.indices('not (element O or label Surface)').tolist() == [3, 4, 5]
+    assert selector.indices('not not element H').tolist() == [5]
+
+
+def test_selector_invert_clears_padding():
+    # Six particles leave two padding bits in the last byte.
+    selector = _selector()
+    bits = selector.compile('not none')
+    assert bits.tolist() == [0b11111100]
+    assert np.unpackbits(selector.compile('not all')).sum() == 0
+
+
+def test_selector_caches_and_reuses_bitsets():
+    selector = _selector()
+    first = selector.compile('label Alkylsilane and element C')
+    assert selector.compile('label Alkylsilane and element C') is first
+    assert ('label', ('Alkylsilane',)) in selector._cache
+    assert selector.compile('label Alkylsilane') is selector._cache[('label', ('Alkylsilane',))]
+
+
+@pytest.mark.parametrize('expression', ['label', 'foo bar', '(all', 'all )', 'z 3', 'type opls_135', 'all and'])
+def test_selector_errors(expression):
+    with pytest.raises(ValueError):
+        _selector().compile(expression)
+
+
+def test_write_ndx(tmpdir):
+    filename = str(tmpdir.join('index.ndx'))
+    # A chunk of 16 is rounded down to one line, so the first group spans three chunks.
+    write_ndx(filename, {'A': np.arange(1, 38), 'B': np.array([], dtype=int), 'C': np.array([7, 3])}, chunk=16)
+    with open(filename) as ndx:
+        lines = ndx.read().split('\n')
+    assert lines[0] == '[ A ]'
+    assert [len(line.split()) for line in lines[1:4]] == [15, 15, 7]
+    assert [int(i) for line in lines[1:4] for i in line.split()] == list(range(1, 38))
+    assert lines[4:9] == ['', '[ B ]', '', '[ C ]', '     7      3']
+
+
+def test_write_lammps_groups(tmpdir):
+    filename = str(tmpdir.join('groups.lmp'))
+    groups = {'A': np.array([9, 1, 3, 2, 2, 5, 4, 10, 20]), 'B': np.array([], dtype=int)}
+    write_lammps_groups(filename, groups, chunk=2)
+    with open(filename) as script:
+        lines = script.read().splitlines()
+    assert lines == ['group A id 1:5 9:10', 'group A id 20', 'group B empty']
+
+
+def _slabs(bounds, per_slab=50):
+    z = np.concatenate([np.linspace(lo, hi, per_slab) for lo, hi in bounds])
+    return np.column_stack((np.zeros_like(z), np.zeros_like(z), z))
+
+
+def test_detect_layers_stack():
+    xyz = _slabs([(5, 6), (1, 2), (3, 3.5), (3.6, 4)])
+    layers, extents = detect_layers(xyz, min_gap=0.3)
+    # The 0.1 nm gap inside the third slab is too narrow to split it.
+    assert np.bincount(layers).tolist() == [50, 100, 50]
+    assert layers[:50].tolist() == [2] * 50
+    assert layers[50:100].tolist() == [0] * 50
+    assert np.allclose(extents[:, 0], [1, 3, 5], atol=0.06)
+
+
+def test_detect_layers_across_box_edge():
+    box = [1, 1, 8]
+    xyz = _slabs([(7.5, 7.99), (0, 0.5), (3, 4)])
+    layers, extents = detect_layers(xyz, box=box)
+    assert layers.tolist() == [0] * 100 + [1] * 50
+    assert extents[0, 0] < 0 < extents[0, 1]
+    assert np.allclose(extents[0], [-0.5, 0.55], atol=0.06)
+    bottom, top = layer_faces(xyz, layers, extents, thickness=0.205, box=box)
+    assert bottom[:50].tolist() == (xyz[:50, 2] - 8 < extents[0, 0] + 0.205).tolist()
+    assert top[50:100].tolist() == (xyz[50:100, 2] > extents[0, 1] - 0.205).tolist()
+    assert bottom[:50].any() and top[50:100].any() and not bottom[50:100].any() and not top[:50].any()
+
+
+def test_detect_layers_votes_per_molecule():
+    xyz = _slabs([(0, 1), (3, 4)], per_slab=10)
+    # Particle 0 is bonded into a molecule that lies mostly in the upper layer.
+    bonds = np.array([[0, 10], [10, 11]])
+    layers, _ = detect_layers(xyz, bonds=bonds)
+    assert layers[[0, 10, 11]].tolist() == [1, 1, 1]
+    assert layers[1:10].tolist() == [0] * 9
+
+
+def test_detect_layers_mask():
+    xyz = _slabs([(0, 1), (3, 4)], per_slab=10)
+    layers, extents = detect_layers(xyz, mask=np.arange(20) < 10)
+    assert layers.tolist() == [0] * 10 + [-1] * 10
+    layers, extents = detect_layers(xyz, mask=np.zeros(20, dtype=bool))
+    assert (layers == -1).all() and extents.shape == (0, 2)
+
+
+def test_detect_layers_mask_outside_range():
+    """Unselected particles below or above the selected layers are left out, not binned."""
+    xyz = np.concatenate((_slabs([(5, 6), (8, 9)], per_slab=10), [[0, 0, -10], [0, 0, 4.99], [0, 0, 20]]))
+    mask = np.arange(23) < 20
+    layers, extents = detect_layers(xyz, mask=mask)
+    assert layers.tolist() == [0] * 10 + [1] * 10 + [-1] * 3
+    assert np.allclose(extents[:, 0], [5, 8], atol=0.06)
+
+
+def _grafted():
+    # Surface 0-3 in a line, chain 7-8 grafted to 2 and chain 4-5-6 grafted to 0, listed in that order.
+    bonds = np.array([[0, 1], [1, 2], [2, 3], [2, 7], [7, 8], [0, 4], [4, 5], [5, 6], [9, 10]])
+    chains = np.zeros(11, dtype=bool)
+    chains[4:9] = True
+    return bonds, chains
+
+
+def test_molecule_ids():
+    bonds, chains = _grafted()
+    assert molecule_ids(11, bonds).tolist() == [0] * 9 + [1, 1]
+    # Cutting the bonds to the surface separates the chains, numbered by their first particle.
+    assert molecule_ids(11, bonds, mask=chains).tolist() == [-1] * 4 + [0, 0, 0, 1, 1] + [-1, -1]
+
+
+def test_chain_index_and_groups():
+    bonds, chains = _grafted()
+    ids = molecule_ids(11, bonds, mask=chains)
+    indptr, atoms = chain_index(ids)
+    assert indptr.tolist() == [0, 3, 5]
+    assert atoms.tolist() == [4, 5, 6, 7, 8]
+    groups = chain_groups(ids)
+    assert list(groups) == ['chain0', 'chain1']
+    assert groups['chain1'].tolist() == [8, 9]
+    indptr, atoms = chain_index(np.full(3, -1))
+    assert indptr.tolist() == [0] and atoms.tolist() == []
@@ -0,0 +1,29 @@
+"""
+Tests for the lazy layer description.
+"""
+import pytest
+
+mb = pytest.importorskip("mbuild")
+
+from pmpc.dispersity import Poisson
+from pmpc.layer_spec import PMPCLayerSpec
+
+
+def test_counts_match_built_layer():
+    spec = PMPCLayerSpec(6, tile_x=2, chain_length=Poisson(3), seed=12)
+    layer = spec.build()
+
+    assert spec.n_particles == layer.n_particles
+    assert spec.n_bonds == layer.n_bonds
+    assert sum(spec.composition.values()) == layer.n_particles
+
+
+def test_save_gro_streams_every_particle(tmpdir):
+    spec = PMPCLayerSpec(4, tile_x=2, chain_length=2, seed=3)
+    filename = str(tmpdir.join('layer.gro'))
+    spec.save(filename)
+
+    with open(filename) as gro:
+        lines = gro.readlines()
+    assert int(lines[1]) == spec.n_particles
+    assert len(lines) == spec.n_particles + 3
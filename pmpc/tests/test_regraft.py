@@ -0,0 +1,41 @@
+"""
+Tests for adding and removing brushes on a built layer.
+"""
+import pytest
+
+mb = pytest.importorskip("mbuild")
+
+from pmpc.pmpc_brush_layer import PMPCLayer
+
+
+def test_add_and_remove_brushes():
+    layer = PMPCLayer(mb.Random2DPattern(3, seed=1), chain_length=2, seed=1)
+    built = PMPCLayer(mb.Random2DPattern(5, seed=1), chain_length=2, seed=1)
+
+    added = layer.add_brushes(2, chain_length=2, seed=2)
+    assert len(layer.chain_lengths) == 5
+    assert (layer.site_lengths[added] == 2).all()
+    assert layer.chain_lengths.tolist() == layer.site_lengths[layer.site_lengths > 0].tolist()
+    assert layer.n_particles == built.n_particles
+    assert layer.n_bonds == built.n_bonds
+
+    layer.remove_brushes(sites=added)
+    assert len(layer.chain_lengths) == 3
+    assert (layer.site_lengths[added] == 0).all()
+    assert layer.n_particles == PMPCLayer(mb.Random2DPattern(3, seed=1), chain_length=2).n_particles
+
+
+def test_added_brushes_are_resolved():
+    """Brushes added to a layer built with a clash cutoff are moved apart like the first ones."""
+    from pmpc.graft import _offenders, layer_clashes
+
+    layer = PMPCLayer(mb.Random2DPattern(10, seed=1), chain_length=3, seed=1, clash_cutoff=0.1)
+    layer.add_brushes(20, chain_length=3, seed=2)
+    g = next(g for g, grafted in enumerate(layer.layer.grafts) if grafted.name != 'H')
+    offenders = _offenders(layer_clashes(layer.layer, 0.1), g)
+    assert set(offenders.tolist()) <= set(layer.clashing[3].tolist())
+
+
+def test_processes_need_random_pattern():
+    with pytest.raises(ValueError, match='Grid2DPattern'):
+        PMPCLayer(mb.Grid2DPattern(2, 2), processes=1)
@@ -0,0 +1,26 @@
+"""
+Tests for lattice solvation.
+"""
+import numpy as np
+import pytest
+
+from pmpc.solvate import WATER_MASS, solvate
+from pmpc.spatial import CellList, find_clashes
+
+
+def test_density_and_exclusion():
+    rng = np.random.default_rng(0)
+    solute = rng.uniform(0, [4, 4, 2], size=(1000, 3))
+    water, sodium, chloride = solvate([4, 4, 8], (0, 8), solute=solute, ions={'NA': 3, 'CL': 3}, seed=1)
+
+    assert len(sodium.xyz) == len(chloride.xyz) == 3
+    placed = np.concatenate([water.xyz.reshape(-1, 3), sodium.xyz[:, 0], chloride.xyz[:, 0]])
+    assert len(CellList(solute, 0.22, box=[4, 4, 0]).query(placed)) == 0
+
+    # Waters keep clear of each other too.
+    molecules = np.repeat(np.arange(len(water.xyz)), 3)
+    assert len(find_clashes(water.xyz.reshape(-1, 3), molecules, 0.17, box=[4, 4, 0])) == 0
+
+    empty, = solvate([4, 4, 8], (0, 8), seed=1)
+    density = len(empty.xyz) * WATER_MASS / 6.02214076e2 / (4 * 4 * (8 - 0.22))
+    assert density == pytest.approx(1.0, rel=1e-3)
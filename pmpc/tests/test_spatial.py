@@ -0,0 +1,44 @@
+"""
+Tests for the cell list neighbour search.
+"""
+import numpy as np
+import pytest
+
+from pmpc.spatial import CellList, find_clashes
+
+
+def _brute_force(xyz, cutoff, box):
+    delta = xyz[None, :, :] - xyz[:, None, :]
+    periodic = box > 0
+    delta -= np.where(periodic, box * np.round(delta / np.where(periodic, box, 1)), 0)
+    close = (delta ** 2).sum(axis=-1) < cutoff ** 2
+    return set(zip(*np.nonzero(np.triu(close, k=1))))
+
+
+@pytest.mark.parametrize("box", [None, [2.0, 2.0, 0.0], [0.5, 3.0, 1.0]])
+def test_pairs_match_brute_force(box):
+    """Every pair within the cutoff is found once, across periodic boundaries."""
+    rng = np.random.default_rng(0)
+    xyz = rng.uniform(0, [2.0, 3.0, 1.0], size=(500, 3))
+    box = np.zeros(3) if box is None else np.asarray(box)
+    pairs = CellList(xyz, 0.2, box=box).query()
+
+    assert len(pairs) == len(set(map(tuple, np.sort(pairs, axis=1))))
+    assert set(map(tuple, np.sort(pairs, axis=1))) == _brute_force(xyz, 0.2, box)
+
+
+def test_query_points():
+    """Outside points are matched against the indexed points."""
+    rng = np.random.default_rng(1)
+    xyz = rng.uniform(0, 1, size=(200, 3))
+    points = rng.uniform(-0.5, 1.5, size=(100, 3))
+    pairs = CellList(xyz, 0.3).query(points, cutoff=0.25, chunk=7)
+
+    d2 = ((points[:, None] - xyz[None]) ** 2).sum(axis=-1)
+    assert set(map(tuple, pairs)) == set(zip(*np.nonzero(d2 < 0.25 ** 2)))
+
+
+def test_find_clashes_ignores_own_molecule():
+    xyz = np.array([[0, 0, 0], [0.1, 0, 0], [0.15, 0, 0], [1, 1, 1]])
+    molecules = np.array([0, 0, 1, 2])
+    assert find_clashes(xyz, molecules, 0.2).tolist() == [[0, 2], [1, 2]]
@@ -1,53 +1,88 @@
 from __future__ import division
 
+import re
+
 import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+
+
+def ancestry(system):
+    """Walk the compound tree once and record what every particle belongs to.
+
+    Returns
+    -------
+    codes : np.ndarray, shape=(n,), dtype=int
+        Index into `lineages` of each particle, in the order of
+        `system.particles()`.
+    lineages : list of frozenset
+        Names of the ancestors of the particles with each code, and the
+        labels they were added to their parents under, e.g. 'pmpc' for a
+        `PMPCChain` added to a `Brush` with ``label='pmpc'``.
+    parents : np.ndarray, shape=(n,), dtype=str
+        Name of the parent compound of each particle.
+    """
+    codes, parents, lineages = [], [], {}
+    stack = [(system, frozenset(), system.name, frozenset())]
+    while stack:
+        compound, inherited, parent, labels = stack.pop()
+        children = list(compound.children)
+        if children:
+            inherited = inherited | {compound.name} | labels
+            tags = {}
+            for label, child in getattr(compound, 'labels', {}).items():
+                if not isinstance(child, list):
+                    tags.setdefault(id(child), set()).add(label)
+            stack.extend((child, inherited, compound.name, frozenset(tags.get(id(child), ())))
+                         for child in reversed(children))
+        elif not getattr(compound, 'port_particle', False):
+            # Ports hold ghost particles that `system.particles()` leaves out.
+            codes.append(lineages.setdefault(inherited, len(lineages)))
+            parents.append(parent)
+    return np.array(codes, dtype=int), list(lineages), np.array(parents)
+
 
+def membership_masks(system, labels, lineage=None):
+    """Mark the particles that belong to a compound with each label.
 
-def generate_index_groups(system, freeze_thickness=0.5):
-    bounding_box = system.boundingbox
-    bot_of_box = bounding_box.mins[2]
-    top_of_box = bounding_box.maxs[2]
+    The compound tree is walked once, in the order of `system.particles()`,
+    and every particle inherits the labels of its ancestors.
+
+    Returns
+    -------
+    masks : dict of np.ndarray, shape=(n,), dtype=bool
+        Keyed by label.
+    """
+    codes, lineages, _ = ancestry(system) if lineage is None else lineage
+    return {label: np.array([label in names for names in lineages], dtype=bool)[codes] for label in labels}
+
+
+def generate_index_groups(system, freeze_thickness=0.5, chain_label='Alkylsilane'):
+    xyz = system.xyz
+    chain = membership_masks(system, [chain_label])[chain_label]
+    bot_of_box = xyz[:, 2].min()
+    top_of_box = xyz[:, 2].max()
     middle = (bot_of_box + top_of_box) / 2
 
-    bottom_frozen = []
-    top_frozen = []
-    bottom_surface = []
-    top_surface = []
-    bottom_chains = []
-    top_chains = []
-    for i, particle in enumerate(system.particles()):
-        z = particle.pos[2]
-        ancestors = [ancestor.name for ancestor in particle.ancestors()]
-        if z > middle:
-            if 'Alkylsilane' in ancestors:
-                top_chains.append(i + 1)
-            else:
-                top_surface.append(i + 1)
-                if z > top_of_box - freeze_thickness:
-                    top_frozen.append(i + 1)
-        else:
-            if 'Alkylsilane' in ancestors:
-                bottom_chains.append(i + 1)
-            else:
-                bottom_surface.append(i + 1)
-                if z < bot_of_box + freeze_thickness:
-                    bottom_frozen.append(i + 1)
-
-    bottom_frozen = np.asarray(bottom_frozen)
+    z = xyz[:, 2]
+    upper = z > middle
+    indices = np.arange(1, len(xyz) + 1)
+
+    bottom_frozen = indices[~upper & ~chain & (z < bot_of_box + freeze_thickness)]
     print('bottom_frozen: {}'.format(len(bottom_frozen)))
-    top_frozen = np.asarray(top_frozen)
+    top_frozen = indices[upper & ~chain & (z > top_of_box - freeze_thickness)]
     print('top_frozen: {}'.format(len(top_frozen)))
 
-    bottom_surface = np.asarray(bottom_surface)
+    bottom_surface = indices[~upper & ~chain]
     print('bottom_surface: {}'.format(len(bottom_surface)))
-    top_surface = np.asarray(top_surface)
+    top_surface = indices[upper & ~chain]
     print('top_surface: {}'.format(len(top_surface)))
     surfaces = np.hstack((bottom_surface, top_surface))
     print('surfaces: {}'.format(len(surfaces)))
 
-    bottom_chains = np.asarray(bottom_chains)
+    bottom_chains = indices[~upper & chain]
     print('bottom_chains: {}'.format(len(bottom_chains)))
-    top_chains = np.asarray(top_chains)
+    top_chains = indices[upper & chain]
     print('top_chains: {}'.format(len(top_chains)))
     chains = np.hstack((bottom_chains, top_chains))
     print('chains: {}'.format(len(chains)))
@@ -72,3 +107,418 @@ def generate_index_groups(system, freeze_thickness=0.5):
                     'top_chains': top_chains}
 
     return index_groups
+
+
+_TOKENS = re.compile(r'\(|\)|[^\s()]+')
+
+
+class Selector(object):
+    """Select particles with expressions compiled to cached bitsets.
+
+    An expression combines keywords with ``and``, ``or``, ``not`` and
+    parentheses, e.g. ``'label pmpc and element O P'`` or
+    ``'not label initiator and z 0:1.5'``. The keywords are
+
+    - ``label``: particles inside a compound with one of the given names,
+      or added to its parent under one of the given labels,
+    - ``element``, ``type``, ``name``: particles with one of the given
+      elements, atom types or names,
+    - ``resname``: particles whose parent compound has one of the names,
+    - ``z lo:hi``: particles with ``lo <= z < hi`` in nm, where either end
+      may be left out,
+    - ``all`` and ``none``.
+
+    Every keyword and every expression is evaluated once into a bitset of
+    one bit per particle, so building many groups that share terms only
+    combines bitsets.
+
+    Parameters
+    ----------
+    xyz : np.ndarray, shape=(n, 3)
+    names, elements, types, residues : np.ndarray, shape=(n,), optional
+    lineage : tuple, optional, default=None
+        The result of `ancestry`, needed for ``label``.
+    """
+    keywords = ('label', 'element', 'type', 'name', 'resname', 'z')
+
+    def __init__(self, xyz, names=None, elements=None, types=None, residues=None, lineage=None):
+        self.xyz = np.asarray(xyz)
+        self.n = len(self.xyz)
+        self.fields = {'name': names, 'element': elements, 'type': types, 'resname': residues}
+        self.lineage = lineage
+        self._cache = {}
+
+    @classmethod
+    def from_compound(cls, system, types=None):
+        """Collect the arrays of a selector in one pass over an mbuild Compound."""
+        lineage = ancestry(system)
+        particles = list(system.particles())
+        names = np.array([particle.name for particle in particles])
+        elements = np.array([particle.element.symbol if particle.element is not None else ''
+                             for particle in particles])
+        return cls(system.xyz, names=names, elements=elements, types=types, residues=lineage[2],
+                   lineage=lineage)
+
+    def _pack(self, mask):
+        return np.packbits(mask)
+
+    def _invert(self, bits):
+        inverted = ~bits
+        pad = len(bits) * 8 - self.n
+        if pad:
+            inverted[-1] &= (0xFF << pad) & 0xFF
+        return inverted
+
+    def _primitive(self, keyword, values):
+        key = (keyword, values)
+        if key in self._cache:
+            return self._cache[key]
+        if keyword == 'all':
+            mask = np.ones(self.n, dtype=bool)
+        elif keyword == 'none':
+            mask = np.zeros(self.n, dtype=bool)
+        elif keyword == 'z':
+            if len(values) != 1 or ':' not in values[0]:
+                raise ValueError('Expected a range lo:hi after z, got {}.'.format(' '.join(values)))
+            lo, hi = values[0].split(':')
+            z = self.xyz[:, 2]
+            mask = (z >= (float(lo) if lo else -np.inf)) & (z < (float(hi) if hi else np.inf))
+        elif keyword == 'label':
+            if self.lineage is None:
+                raise ValueError('Selecting by label needs the lineage of the particles.')
+            codes, lineages, _ = self.lineage
+            mask = np.array([not names.isdisjoint(values) for names in lineages], dtype=bool)[codes]
+        else:
+            field = self.fields[keyword]
+            if field is None:
+                raise ValueError('No {} is known for the particles.'.format(keyword))
+            mask = np.isin(np.asarray(field), values)
+        self._cache[key] = bits = self._pack(mask)
+        return bits
+
+    def _parse(self, tokens, position=0):
+        bits, position = self._term(tokens, position)
+        while position < len(tokens) and tokens[position] == 'or':
+            other, position = self._term(tokens, position + 1)
+            bits = bits | other
+        return bits, position
+
+    def _term(self, tokens, position):
+        bits, position = self._factor(tokens, position)
+        while position < len(tokens) and tokens[position] == 'and':
+            other, position = self._factor(tokens, position + 1)
+            bits = bits & other
+        return bits, position
+
+    def _factor(self, tokens, position):
+        if position >= len(tokens):
+            raise ValueError('Unexpected end of selection.')
+        token = tokens[position]
+        if token == 'not':
+            bits, position = self._factor(tokens, position + 1)
+            return self._invert(bits), position
+        if token == '(':
+            bits, position = self._parse(tokens, position + 1)
+            if position >= len(tokens) or tokens[position] != ')':
+                raise ValueError('Unbalanced parentheses in selection.')
+            return bits, position + 1
+        if token in ('all', 'none'):
+            return self._primitive(token, ()), position + 1
+        if token not in self.keywords:
+            raise ValueError('Unknown selection keyword {!r}.'.format(token))
+        end = position + 1
+        while end < len(tokens) and tokens[end] not in ('and', 'or', 'not', '(', ')'):
+            end += 1
+        if end == position + 1:
+            raise ValueError('Expected values after {!r}.'.format(token))
+        return self._primitive(token, tuple(tokens[position + 1:end])), end
+
+    def compile(self, expression):
+        """Return the bitset of an expression, packed with `np.packbits`."""
+        if expression not in self._cache:
+            tokens = _TOKENS.findall(expression)
+            bits, position = self._parse(tokens)
+            if position != len(tokens):
+                raise ValueError('Unexpected {!r} in selection.'.format(tokens[position]))
+            self._cache[expression] = bits
+        return self._cache[expression]
+
+    def select(self, expression):
+        """Return a boolean mask of the particles an expression selects."""
+        return np.unpackbits(self.compile(expression), count=self.n).astype(bool)
+
+    def indices(self, expression):
+        """Return the 1-based indices of the particles an expression selects."""
+        return np.flatnonzero(self.select(expression)) + 1
+
+    def groups(self, selections):
+        """Return the 1-based indices of each group of a dict of expressions."""
+        return {name: self.indices(expression) for name, expression in selections.items()}
+
+
+def _runs(indices):
+    """Return the first and last index of every run of consecutive indices."""
+    indices = np.unique(indices)
+    if not len(indices):
+        return indices, indices
+    breaks = np.flatnonzero(np.diff(indices) != 1)
+    return indices[np.r_[0, breaks + 1]], indices[np.r_[breaks, len(indices) - 1]]
+
+
+def write_ndx(filename, groups, chunk=150000):
+    """Write index groups to a GROMACS .ndx file, `chunk` indices at a time.
+
+    Parameters
+    ----------
+    filename : str
+    groups : dict
+        1-based indices of each group, e.g. from `generate_index_groups`.
+    chunk : int, optional, default=150000
+        Rounded down to whole lines of 15 indices.
+    """
+    chunk = max(chunk // 15, 1) * 15
+    line = ' '.join(['%6d'] * 15) + '\n'
+    with open(filename, 'w') as ndx:
+        for name, indices in groups.items():
+            ndx.write('[ {} ]\n'.format(name))
+            for start in range(0, len(indices), chunk):
+                values = np.asarray(indices[start:start + chunk]).tolist()
+                full = len(values) // 15 * 15
+                ndx.write(line * (full // 15) % tuple(values[:full]))
+                if full < len(values):
+                    ndx.write(' '.join(['%6d'] * (len(values) - full)) % tuple(values[full:]) + '\n')
+            ndx.write('\n')
+
+
+def write_lammps_groups(filename, groups, chunk=1000):
+    """Write index groups as LAMMPS ``group ... id`` commands.
+
+    Runs of consecutive indices are written as ranges, e.g. ``1:5000``. A
+    group with many runs is split over several commands of `chunk` runs
+    each, which LAMMPS adds up into one group.
+
+    Parameters
+    ----------
+    filename : str
+    groups : dict
+        1-based indices of each group, e.g. from `generate_index_groups`.
+    chunk : int, optional, default=1000
+    """
+    with open(filename, 'w') as script:
+        for name, indices in groups.items():
+            first, last = _runs(indices)
+            if not len(first):
+                script.write('group {} empty\n'.format(name))
+                continue
+            for start in range(0, len(first), chunk):
+                a = first[start:start + chunk].tolist()
+                b = last[start:start + chunk].tolist()
+                script.write('group {} id {}\n'.format(
+                    name, ' '.join(str(i) if i == j else '{}:{}'.format(i, j) for i, j in zip(a, b))))
+
+
+def molecule_ids(n, bonds, mask=None):
+    """Number the molecules, or chains, of a system by the components of its bond graph.
+
+    Parameters
+    ----------
+    n : int
+        Number of particles.
+    bonds : np.ndarray, shape=(m, 2), dtype=int
+        0-based bonds.
+    mask : np.ndarray, shape=(n,), dtype=bool, optional, default=None
+        Particles to number. Bonds to other particles are cut, so that e.g.
+        the chains grafted to one surface get one ID each instead of the
+        whole layer sharing one. Other particles get -1.
+
+    Returns
+    -------
+    ids : np.ndarray, shape=(n,), dtype=int
+        IDs from 0, in order of the first particle of each molecule.
+    """
+    bonds = np.asarray(bonds, dtype=int).reshape(-1, 2)
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        bonds = bonds[mask[bonds[:, 0]] & mask[bonds[:, 1]]]
+    graph = sparse.coo_matrix((np.ones(len(bonds), dtype=np.int8), (bonds[:, 0], bonds[:, 1])), shape=(n, n))
+    labels = csgraph.connected_components(graph, directed=False)[1]
+    if mask is None:
+        return labels
+    _, first, inverse = np.unique(labels[mask], return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype=int)
+    rank[np.argsort(first, kind='stable')] = np.arange(len(first))
+    ids = np.full(n, -1)
+    ids[mask] = rank[inverse.ravel()]
+    return ids
+
+
+def chain_index(ids):
+    """Return a CSR index of the particles of every molecule.
+
+    Returns
+    -------
+    indptr : np.ndarray, shape=(k + 1,), dtype=int
+    atoms : np.ndarray, dtype=int
+        0-based particles of molecule ``i`` are ``atoms[indptr[i]:indptr[i + 1]]``,
+        in increasing order. Particles with ID -1 are left out.
+    """
+    ids = np.asarray(ids)
+    atoms = np.flatnonzero(ids >= 0)
+    atoms = atoms[np.argsort(ids[atoms], kind='stable')]
+    counts = np.bincount(ids[atoms], minlength=ids.max() + 1 if len(atoms) else 0)
+    return np.r_[0, np.cumsum(counts)], atoms
+
+
+def chain_groups(ids, prefix='chain'):
+    """Return 1-based index groups ``<prefix><i>`` of every molecule."""
+    indptr, atoms = chain_index(ids)
+    return {'{}{}'.format(prefix, i): members + 1
+            for i, members in enumerate(np.split(atoms, indptr[1:-1]))}
+
+
+def detect_layers(xyz, box=None, bonds=None, molecules=None, mask=None, bin_width=0.05, min_gap=0.2):
+    """Find stacked layers from gaps in the density along z.
+
+    Heights are histogrammed, and runs of empty bins at least `min_gap` wide
+    separate layers. With a periodic box the histogram wraps around, so a
+    layer cut by the box edge stays one layer. Every molecule is then put
+    in the layer most of its particles fall in.
+
+    Parameters
+    ----------
+    xyz : np.ndarray, shape=(n, 3)
+    box : array-like, shape=(3,), optional, default=None
+        Box lengths; z is periodic when given.
+    bonds : np.ndarray, shape=(m, 2), optional, default=None
+        0-based bonds that define the molecules, when `molecules` is None.
+    molecules : np.ndarray, shape=(n,), dtype=int, optional, default=None
+        Molecule of each particle. Every particle is its own molecule when
+        neither this nor `bonds` is given.
+    mask : np.ndarray, shape=(n,), dtype=bool, optional, default=None
+        Particles to find layers in, e.g. everything but the solvent that
+        fills the gaps. Other particles get layer -1, and there are no
+        layers when no particle is selected.
+    bin_width : float, optional, default=0.05
+    min_gap : float, optional, default=0.2
+
+    Returns
+    -------
+    layers : np.ndarray, shape=(n,), dtype=int
+        Layer of each particle, counted from the bottom.
+    extents : np.ndarray, shape=(k, 2)
+        Bottom and top of each layer. With a periodic box, the top of a
+        layer cut by the box edge lies above the box.
+    """
+    xyz = np.asarray(xyz, dtype=float)
+    n = len(xyz)
+    mask = np.ones(n, dtype=bool) if mask is None else np.asarray(mask, dtype=bool)
+    if not mask.any():
+        return np.full(n, -1), np.empty((0, 2))
+    if molecules is None:
+        molecules = molecule_ids(n, bonds) if bonds is not None else np.arange(n)
+    molecules = np.asarray(molecules)
+    z = xyz[:, 2]
+    periodic = box is not None and box[2] > 0
+    if periodic:
+        lo, length = 0.0, float(box[2])
+        z = np.mod(z, length)
+    else:
+        lo, length = z[mask].min(), np.ptp(z[mask]) + bin_width
+    n_bins = max(int(np.ceil(length / bin_width)), 1)
+    width = length / n_bins
+    # Unselected particles may lie outside the selected range, so bins are clipped.
+    bins = np.clip(np.floor((z - lo) / width).astype(int), 0, n_bins - 1)
+    occupied = np.bincount(bins[mask], minlength=n_bins) > 0
+
+    # Runs of occupied bins, joined across the edge of a periodic box.
+    edges = np.flatnonzero(np.diff(np.r_[False, occupied, False].astype(np.int8)))
+    starts, ends = edges[::2], edges[1::2]
+    gaps = starts[1:] - ends[:-1]
+    split = np.r_[True, gaps * width >= min_gap]
+    groups = np.cumsum(split) - 1
+    first = starts[split]
+    last = ends[np.r_[split[1:], True]]
+    if periodic and len(first) > 1 and (first[0] + n_bins - last[-1]) * width < min_gap:
+        # The top layer continues through the box edge into the bottom one.
+        groups[groups == groups[-1]] = 0
+        first = np.r_[first[-1] - n_bins, first[1:-1]]
+        last = last[:-1]
+    bin_layer = np.full(n_bins, -1)
+    for run, group in enumerate(groups):
+        bin_layer[starts[run]:ends[run]] = group
+
+    # Whole molecules go to the layer most of their particles are in.
+    n_layers = len(first)
+    _, molecule = np.unique(molecules, return_inverse=True)
+    molecule = molecule.ravel()
+    votes = np.zeros((molecule.max() + 1, n_layers + 1), dtype=int)
+    np.add.at(votes, (molecule, np.where(mask, bin_layer[bins], -1) + 1), 1)
+    choice = votes[:, 1:].argmax(axis=1)
+    choice[votes[:, 1:].sum(axis=1) == 0] = -1
+    layers = np.where(mask, choice[molecule], -1)
+
+    extents = lo + np.column_stack((first, last)) * width
+    order = np.argsort(extents[:, 0], kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(n_layers)
+    return np.where(layers >= 0, rank[np.maximum(layers, 0)], -1), extents[order]
+
+
+def layer_faces(xyz, layers, extents, thickness=0.5, box=None):
+    """Mark the particles near the bottom and top face of their layer.
+
+    Parameters
+    ----------
+    xyz : np.ndarray, shape=(n, 3)
+    layers, extents
+        From `detect_layers`.
+    thickness : float, optional, default=0.5
+        Depth of each face in nm.
+    box : array-like, shape=(3,), optional, default=None
+        The box passed to `detect_layers`.
+
+    Returns
+    -------
+    bottom, top : np.ndarray, shape=(n,), dtype=bool
+    """
+    z = np.asarray(xyz, dtype=float)[:, 2]
+    layers = np.asarray(layers)
+    inside = layers >= 0
+    lower = np.where(inside, extents[np.maximum(layers, 0), 0], np.nan)
+    upper = np.where(inside, extents[np.maximum(layers, 0), 1], np.nan)
+    if box is not None and box[2] > 0:
+        # Bring every height into the span of its layer.
+        z = lower + np.mod(z - lower, box[2])
+    with np.errstate(invalid='ignore'):
+        return inside & (z < lower + thickness), inside & (z > upper - thickness)
+
+
+def layer_groups(layers, bottom=None, top=None, surface=None):
+    """Return 1-based index groups of every layer and, optionally, its frozen faces.
+
+    Parameters
+    ----------
+    layers : np.ndarray, shape=(n,), dtype=int
+        From `detect_layers`.
+    bottom, top : np.ndarray, shape=(n,), dtype=bool, optional, default=None
+        From `layer_faces`.
+    surface : np.ndarray, shape=(n,), dtype=bool, optional, default=None
+        Particles that may be frozen, e.g. not chains. All by default.
+
+    Returns
+    -------
+    groups : dict of np.ndarray
+        ``layer<k>``, and ``layer<k>_bottom`` and ``layer<k>_top`` when the
+        faces are given.
+    """
+    layers = np.asarray(layers)
+    surface = np.ones(len(layers), dtype=bool) if surface is None else np.asarray(surface, dtype=bool)
+    indices = np.arange(1, len(layers) + 1)
+    groups = {}
+    for k in range(layers.max() + 1):
+        members = layers == k
+        groups['layer{}'.format(k)] = indices[members]
+        for face, name in ((bottom, 'bottom'), (top, 'top')):
+            if face is not None:
+                groups['layer{}_{}'.format(k, name)] = indices[members & face & surface]
+    return groups